@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+bench_presentation.py
+
+Benchmark of the presentation loops of the task scripts (mid_BD2.py,
+mid_practice.py, ...), run from start to end by mid_headless on its null
+window, so it needs no display or GPU. The real routine code (show_stim, the
+Cue, Target and Feedback loops, the ITI, ...) runs unchanged; only the flips
+are simulated.
+
+For every frame, the benchmark measures the time the task spent between the
+previous flip and this one (its per-frame overhead: checking the keys,
+drawing, logging, saving, ... everything but waiting for the refresh), and
+the change in allocated memory blocks (sys.getallocatedblocks). Frames that
+follow a wait (a prompt, the trigger wait, core.wait) are left out. The frames
+are grouped by routine, from what they show: Target, Cue, Feedback, Fixation
+or other (wait screens). A second session is run with tracemalloc on, for the
+memory allocated within each frame (its peak above the start of the frame).
+
+For each routine it reports the p50/p99/max overhead (ms), the number of
+frames whose overhead alone is longer than a frame period, and the blocks
+and KiB allocated per frame; and for each run of the session (the frames
+between two prompts that show targets), its trials and the real time taken
+to present it in accelerated time.
+
+Timings depend on the machine: save the baseline on the computer that will
+compare against it (ideally the stimulus computer, or one like it). They also
+depend on the code: the baseline keeps a hash of each script and of the
+modules its loops run (LOOP_MODULES), and --compare refuses a baseline saved
+from other code, so save it again after changing them.
+
+Run from the code directory:
+    python benchmarks/bench_presentation.py             # report
+    python benchmarks/bench_presentation.py --save      # also save as the baseline
+    python benchmarks/bench_presentation.py --compare   # report, and compare with the
+                                                        # baseline (exit 1 on regression,
+                                                        # 2 if it is from other code)
+
+The sessions use a test participant (--participant, 9990 by default), whose
+data directory must not exist yet; it is deleted after each session.
+"""
+
+import argparse
+import datetime
+import hashlib
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+CODE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, CODE_DIR)
+import mid_headless
+
+SCRIPTS = ['mid_BD2.py', 'mid_practice.py', 'mrt_practice.py']
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines',
+                        'presentation.json')
+ROUTINES = ['Target', 'Cue', 'Feedback', 'Fixation', 'other']
+# Modules run by the presentation loops (and the null window), besides the script
+LOOP_MODULES = ['mid_routines.py', 'mid_timing.py', 'mid_io.py', 'mid_profile.py',
+                'mid_headless.py']
+FEEDBACK = {'trial_feedback', 'exp_feedback'}
+
+# A statistic regresses when it is above tolerance * baseline + floor
+TOLERANCE = {'p50_ms': (1.5, 0.02), 'p99_ms': (1.5, 0.1), 'over_frame': (1.0, 0),
+             'blocks_p50': (1.0, 1), 'kib_p50': (1.5, 1.0), 'kib_p99': (1.5, 4.0),
+             'wall_s': (1.5, 0.05)}
+
+
+def routine_of(shown):
+    """The routine a frame belongs to, from the stimuli it shows"""
+    routine = 'other'
+    for stim in shown:
+        if isinstance(stim, mid_headless.Polygon):
+            return 'Target'
+        if isinstance(stim, mid_headless.ImageStim) and stim.condition:
+            routine = 'Cue'
+        elif routine not in ('Cue', 'Feedback'):
+            if getattr(stim, 'name', None) in FEEDBACK:
+                routine = 'Feedback'
+            elif getattr(stim, 'text', None) == '+':
+                routine = 'Fixation'
+    return routine
+
+
+class BenchWindow(mid_headless.NullWindow):
+    """The null window, timing the task code between the flips"""
+
+    def __init__(self, session, *args, **kwargs):
+        mid_headless.NullWindow.__init__(self, session, *args, **kwargs)
+        self.frames = session.frames
+        self.last_flip = None
+        self.resume()
+
+    def resume(self):
+        """Starts timing the next frame"""
+        if self.session.trace_memory:
+            tracemalloc.reset_peak()
+            self.memory = tracemalloc.get_traced_memory()[0]
+        self.blocks = sys.getallocatedblocks()
+        self.t_last = time.perf_counter_ns()
+
+    def flip(self, clearBuffer=True):
+        now = time.perf_counter_ns()
+        blocks = sys.getallocatedblocks()
+        allocated = 0
+        if self.session.trace_memory:
+            allocated = tracemalloc.get_traced_memory()[1] - self.memory
+        routine = routine_of(self._toDraw + self._frame)
+        t = mid_headless.NullWindow.flip(self, clearBuffer)
+        # Only frames shown one refresh after the last one, with nothing
+        # waited for in between
+        if (self.last_flip is not None and
+                t - self.last_flip < 1.5 * self.session.frame_duration):
+            self.frames.append((routine, now - self.t_last, blocks - self.blocks,
+                                allocated))
+        self.last_flip = t
+        self.resume()
+        return t
+
+
+class BenchSession(mid_headless.HeadlessSession):
+    """A HeadlessSession on a BenchWindow, that also times the runs (segments between prompts)"""
+
+    trace_memory = False
+
+    def __init__(self, *args, **kwargs):
+        mid_headless.HeadlessSession.__init__(self, *args, **kwargs)
+        self.frames = []  # (routine, overhead ns, blocks, bytes)
+        self.windows = []
+        self.segments = []
+        self.start_segment()
+
+    def visual_module(self):
+        visual = mid_headless.HeadlessSession.visual_module(self)
+        visual.Window = self.window
+        return visual
+
+    def window(self, *args, **kwargs):
+        self.windows.append(BenchWindow(self, *args, **kwargs))
+        return self.windows[-1]
+
+    def start_segment(self):
+        self.segment = {'targets': self.participant.n_targets, 'frames': self.flips,
+                        'task_s': self.clock.now, 'wall_s': time.perf_counter()}
+
+    def end_segment(self):
+        segment = self.segment
+        segment['targets'] = self.participant.n_targets - segment['targets']
+        segment['frames'] = self.flips - segment['frames']
+        segment['task_s'] = round(self.clock.now - segment['task_s'], 3)
+        segment['wall_s'] = round(time.perf_counter() - segment['wall_s'], 4)
+        if segment['targets']:
+            self.segments.append(segment)
+        self.start_segment()
+
+    def wait_keys(self, *args, **kwargs):
+        self.end_segment()
+        keys = mid_headless.HeadlessSession.wait_keys(self, *args, **kwargs)
+        for win in self.windows:
+            win.last_flip = None
+        return keys
+
+
+def percentile(values, q):
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def summarize(frames, frame_duration):
+    """Statistics of the frames of each routine"""
+    routines = {}
+    for routine in ROUTINES:
+        rows = [frame for frame in frames if frame[0] == routine]
+        if not rows:
+            continue
+        overhead = sorted(row[1] / 1e6 for row in rows)
+        blocks = sorted(row[2] for row in rows)
+        routines[routine] = {
+            'frames': len(rows),
+            'p50_ms': round(percentile(overhead, 0.5), 4),
+            'p99_ms': round(percentile(overhead, 0.99), 4),
+            'max_ms': round(overhead[-1], 4),
+            'over_frame': sum(ms > frame_duration * 1e3 for ms in overhead),
+            'blocks_p50': percentile(blocks, 0.5),
+            'blocks_total': sum(blocks)}
+    return routines
+
+
+def worker(script, participant, trace_memory):
+    """Runs one session of a script (in this process); returns its measurements"""
+    BenchSession.trace_memory = trace_memory
+    if trace_memory:
+        tracemalloc.start()
+    info = {'participant': participant, 'session': '1'}
+    sys.stdout = open(os.devnull, 'w')  # the task's own output
+    t0 = time.perf_counter()
+    try:
+        session = mid_headless.run(os.path.join(CODE_DIR, script), info,
+                                   mid_headless.load_profile(),
+                                   session_class=BenchSession, seed=int(participant))
+    finally:
+        sys.stdout = sys.__stdout__
+    session.end_segment()
+    result = {'frame_duration': session.frame_duration,
+              'session': {'task_s': round(session.clock.now, 3),
+                          'wall_s': round(time.perf_counter() - t0, 4),
+                          'flips': session.flips},
+              'runs': session.segments}
+    if trace_memory:
+        for routine in ROUTINES:
+            kib = sorted(frame[3] / 1024 for frame in session.frames
+                         if frame[0] == routine)
+            if kib:
+                result.setdefault('kib', {})[routine] = {
+                    'kib_p50': round(percentile(kib, 0.5), 2),
+                    'kib_p99': round(percentile(kib, 0.99), 2)}
+    else:
+        result['routines'] = summarize(session.frames, session.frame_duration)
+    return result
+
+
+def data_dir(participant):
+    return os.path.join(CODE_DIR, '..', 'data', str(participant).zfill(4))
+
+
+def measure(script, participant, trace_memory=False):
+    """Runs worker() in a new process (a fresh import of the task), and removes its data"""
+    if os.path.exists(data_dir(participant)):
+        sys.exit(f"{os.path.normpath(data_dir(participant))} exists: "
+                 f"choose another --participant")
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, 'result.json')
+        cmd = [sys.executable, os.path.abspath(__file__), '--worker', script,
+               '--participant', str(participant), '--out', out]
+        if trace_memory:
+            cmd.append('--trace-memory')
+        try:
+            proc = subprocess.run(cmd, cwd=CODE_DIR, capture_output=True, text=True)
+        finally:
+            shutil.rmtree(data_dir(participant), ignore_errors=True)
+        if proc.returncode:
+            sys.exit(f"{script} failed:\n{proc.stderr}")
+        with open(out) as f:
+            return json.load(f)
+
+
+def bench_script(script, participant, repeat):
+    """Best of repeat timed sessions, and the allocations of one traced session"""
+    results = [measure(script, participant) for _ in range(repeat)]
+    best = results[0]
+    for result in results[1:]:
+        for routine, stats in result['routines'].items():
+            for name in ('p50_ms', 'p99_ms', 'max_ms', 'over_frame'):
+                best['routines'][routine][name] = min(best['routines'][routine][name],
+                                                      stats[name])
+        for run, other in zip(best['runs'], result['runs']):
+            run['wall_s'] = min(run['wall_s'], other['wall_s'])
+        best['session']['wall_s'] = min(best['session']['wall_s'],
+                                        result['session']['wall_s'])
+    traced = measure(script, participant, trace_memory=True)
+    for routine, kib in traced.get('kib', {}).items():
+        best['routines'].setdefault(routine, {}).update(kib)
+    return best
+
+
+def code_hash(script):
+    """Hash of a script and of the modules its presentation loops run"""
+    digest = hashlib.sha256()
+    for name in [script] + LOOP_MODULES:
+        with open(os.path.join(CODE_DIR, name), 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def report(script, result):
+    print(f"\n{script}: {result['session']['flips']} flips, "
+          f"{result['session']['task_s']:.0f} s of task time in "
+          f"{result['session']['wall_s']:.2f} s")
+    columns = ['frames', 'p50_ms', 'p99_ms', 'max_ms', 'over_frame', 'blocks_p50',
+               'kib_p50', 'kib_p99']
+    print(f"  {'':10s}" + ''.join(f"{name:>11s}" for name in columns))
+    for routine, stats in result['routines'].items():
+        print(f"  {routine:10s}" + ''.join(f"{stats.get(name, ''):>11}" for name in columns))
+    for i, run in enumerate(result['runs']):
+        print(f"  run {i}: {run['targets']} trials, {run['frames']} frames, "
+              f"{run['task_s']:.1f} s of task time in {run['wall_s'] * 1e3:.0f} ms")
+
+
+def compare(scripts, baseline):
+    """Statistics above their tolerance over the baseline, as a list of strings"""
+    regressions = []
+
+    def check(label, name, value, base):
+        if value is None or base is None:
+            return
+        ratio, floor = TOLERANCE[name]
+        if value > base * ratio + floor:
+            regressions.append(f"{label} {name}: {value} (baseline {base})")
+
+    for script, result in scripts.items():
+        base = baseline['scripts'].get(script)
+        if base is None:
+            print(f"\n{script}: no baseline")
+            continue
+        for routine, stats in result['routines'].items():
+            if routine == 'other':
+                continue
+            for name in TOLERANCE:
+                if name in stats:
+                    check(f"{script} {routine}", name, stats[name],
+                          base['routines'].get(routine, {}).get(name))
+        for i, (run, base_run) in enumerate(zip(result['runs'], base['runs'])):
+            check(f"{script} run {i}", 'wall_s', run['wall_s'], base_run['wall_s'])
+    return regressions
+
+
+def machine():
+    return {'platform': platform.platform(), 'python': platform.python_version(),
+            'processor': platform.processor() or platform.machine()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('scripts', nargs='*',
+                        help="task scripts (default: those of this site among "
+                             + ', '.join(SCRIPTS) + ")")
+    parser.add_argument('--participant', default='9990', help="test participant number")
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timed sessions of each script (the best is kept)")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save', action='store_true', help="save the results as the baseline")
+    parser.add_argument('--compare', action='store_true',
+                        help="compare with the baseline; exit 1 on a regression")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    parser.add_argument('--trace-memory', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--out', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        result = worker(args.worker, args.participant, args.trace_memory)
+        with open(args.out, 'w') as f:
+            json.dump(result, f)
+        return 0
+
+    scripts = args.scripts or [script for script in SCRIPTS
+                               if os.path.exists(os.path.join(CODE_DIR, script))]
+    baseline = None
+    if args.compare:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        stale = [script for script in scripts if script in baseline['scripts'] and
+                 baseline['scripts'][script].get('code') != code_hash(script)]
+        if stale:
+            print(f"the baseline of {', '.join(stale)} ({args.baseline}, "
+                  f"{baseline['created']}) is from other code; save a new one with --save")
+            return 2
+
+    results = {}
+    for script in scripts:
+        results[script] = bench_script(script, args.participant, args.repeat)
+        results[script]['code'] = code_hash(script)
+        report(script, results[script])
+
+    output = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+              'machine': machine(), 'repeat': args.repeat, 'scripts': results}
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(output, f, indent=1)
+    status = 0
+    if args.compare:
+        if baseline['machine'] != output['machine']:
+            print(f"\nwarning: the baseline is from another machine ({baseline['machine']})")
+        regressions = compare(results, baseline)
+        print(f"\n{len(regressions)} regression(s) against {args.baseline} "
+              f"({baseline['created']})")
+        for regression in regressions:
+            print("  " + regression)
+        status = 1 if regressions else 0
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump(output, f, indent=1)
+        print(f"\nsaved {args.baseline}")
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,19 +23,30 @@ To change # of trials during MRT, see line 575
 """
 
 
-from psychopy import gui, visual, core, data, event, logging, monitors
-from psychopy.constants import (NOT_STARTED, STARTED, PLAYING, PAUSED,
-                                STOPPED, FINISHED, PRESSED, RELEASED, FOREVER)
-from numpy.random import random, shuffle
+import time
+startup_t0 = time.perf_counter()
+
+# Only what the participant dialog needs is imported here; see below for the
+# rest of psychopy and pandas
+from psychopy import gui, core, logging
 import random
 import os
-import csv
-import pandas as pd
 import numpy as np
-import time
-from pathlib import Path
 import warnings
 
+import mid_io
+import mid_orders
+import mid_profile
+import mid_routines
+import mid_startup
+import mid_state
+import mid_timing
+
+# Import the modules that are not needed by the dialog while it is open
+startup = mid_startup.StartupTimer(startup_t0)
+preloading = mid_startup.preload(['pandas', 'psychopy.data', 'psychopy.monitors'])
+startup.mark('imports')
+
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 logging.console.setLevel(logging.CRITICAL)
@@ -61,19 +72,43 @@ num_trials = 36
 pre_instructions_duration = 10 # added time before instructions to acclimate to scanner
 initial_fix_duration = 5 # added time to make sure homogenicity of magnetic field is reached
 closing_duration = 8.0 # added time at end of last run to make sure we capture enough
+scanner_TR = None # repetition time (in seconds) to check TTL triggers against; estimated from them if None
 
 # Trial times
 cue_time = 2.0 # How long the cue is displayed (in seconds)
 fix_after_cue_range = [2.0,2.5]  # Inter-stimulus interval
 min_target_dur = 0.1 # Sets the minimum presentation time for target (in seconds)
 inital_target_dur = 0.5 # Initial presentation of target (in seconds)
+max_target_dur = 1.0 # Sets the maximum presentation time for target (in seconds)
 isi_target_isi_time = 4  # Total time between end of cue, and right before feedback
 feedback_time = 2.0 # How long the trial + total reward feedback is displayed (in seconds)
+# Amount won on a hit of a reward cue, or lost on a miss of a loss cue
+trial_rewards = {'reward.high': 5.0, 'reward.low': 1.5, 'reward.neut': 0.0,
+                 'loss.high': -5.0, 'loss.low': -1.5, 'loss.neut': 0.0}
 fix_ITI = [2, 4, 6] * 12  # Inter-trial interval timings
 
+# Trial order, ITIs and fixations after cue of runs 1 and 2, from this order
+# library in stim_dir (see mid_orders.py and optimize_design.py), picked by
+# participant and session. None shuffles stim_conds and fix_ITI every run
+order_library = "orders/mid36-v1"
+
+# Present stimuli by counting screen refreshes instead of polling timers, with
+# every duration converted to a whole number of frames at the start of the run
+frame_based_timing = True
+
+# Time each phase of every frame (keys, draw, flip, addData, logging.flush,
+# ...) and write a Chrome trace of each run (_trace-run1.json, see mid_profile.py)
+profile_frames = False
+
 # Define speed up/down factor for increasing target window time based on performance
 single_speed_factor = 0.02  # This will add or subject 20ms
 
+# Hit rate that drives the target window: taken over the last hit_rate_window
+# trials of each condition, or exponentially weighted with hit_rate_alpha
+# (e.g. 0.3) if that is set. Carried across runs in the target durations files
+hit_rate_window = 8
+hit_rate_alpha = None
+
 
 total_earnings = 0
 total_earnings_goal = 40
@@ -110,11 +145,19 @@ expInfo = {
     'fMRI trigger on TTL? (yes or no)': 'yes',
     'fMRI reverse screen? (yes or no)': 'no',
     'start run (0-2)': '0',
+    'resume run (yes or no)': 'no',
     'task screen': '2',
 }
 dlg = gui.DlgFromDict(dictionary=expInfo, title=expName)
 if dlg.OK == False:
     core.quit()  # user pressed cancel
+startup.mark('dialog')
+
+preloading.join()
+from psychopy import visual, data, event, monitors
+import pandas as pd
+startup.mark('modules')
+
 expInfo['date'] = data.getDateStr()  # add a simple timestamp
 expInfo['expName'] = expName
 sn = int(expInfo['participant'])
@@ -140,6 +183,9 @@ else:
 # Define run number based on experimentor input
 run = int(expInfo['start run (0-2)'])
 
+# Continue the start run from its last checkpoint instead of from trial 1
+resume = expInfo['resume run (yes or no)'].lower() == 'yes'
+
 
 
 # Defining some initialization functions
@@ -190,109 +236,132 @@ def start_datafiles(_thisDir, expName, expInfo, data_dir, sn, session, fmri):
     print('\n\n'+filename+'\n\n')
     return(filename)
 
-# Function for displaying instructions
-def display_instructions_file(inst_file, instructions, run):
+# Instruction pages rendered to textures, keyed by (instructions file, run)
+instruction_pages = {}
+
+# Function for drawing one page of the instructions to the back buffer
+def draw_instruction_page(text, image, run):
+    if run == 0:
+        instructPrompt.setText(text)
+        instructPrompt.draw()
+        
+        # Present image if relevant
+        if image != 'none' and run == 0:
+            inst_target = visual.Polygon(win, edges=3, radius=0.1, 
+                                        fillColor="white", pos=(0,yScr/10))
+            inst_target.draw()
+            
+        instructMove.draw()
+        
+    else:
+        if image == 'none':
+            instructPrompt.setText(text)
+            instructPrompt.draw()
+            instructMove.draw()
+        
+        else:    
+            fix1_exmp = visual.TextStim(win, pos=[-0.65, 0.15], 
+                                        text='+', height=fontH*2, 
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz)
+            cuex_exmp = visual.ImageStim(win, pos=[-0.35,0.15], size=0.2,
+                                         image=stim_dir+"reward_high.png")
+            fix2_exmp = visual.TextStim(win, pos=[-0.15, 0.15], text='+', 
+                                        height=fontH*2, color=text_color, 
+                                        flipHoriz=flipHoriz)
+            targ_exmp = visual.Polygon(win, pos=[0.15,0.15], edges=3, 
+                                       radius=0.1, fillColor="white")
+            fix3_exmp = visual.TextStim(win, pos=[0.35, 0.15], text='+', 
+                                        height=fontH*2, color=text_color, 
+                                        flipHoriz=flipHoriz)
+            fdbk_exmp = visual.TextStim(win, pos=[0.65, 0.15], 
+                                        text='Hit!\n+$5.00', 
+                                        height=fontH*2, 
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz)
+            
+            # Draw bottom row of page
+            fix1_desc = visual.TextStim(win, pos=[-0.65, -0.15], 
+                                        text='Pay attention', 
+                                        height=fontH, wrapWidth=0.1,
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz,
+                                        alignHoriz='center')
+            cuex_desc = visual.TextStim(win, pos=[-0.35, -0.15], 
+                                        text="Cue: don't respond yet", 
+                                        height=fontH, wrapWidth=0.1,
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz, 
+                                        alignHoriz='center')
+            fix2_desc = visual.TextStim(win, pos=[-0.15, -0.15], 
+                                        text='Pay attention', 
+                                        height=fontH, wrapWidth=0.1,
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz, 
+                                        alignHoriz='center')
+            targ_desc = visual.TextStim(win, pos=[0.15, -0.15], 
+                                        text='Respond when solid triangle is on screen', 
+                                        height=fontH, wrapWidth=0.1,
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz, 
+                                        alignHoriz='center')
+            fix3_desc = visual.TextStim(win, pos=[0.35, -0.15], 
+                                        text='Pay attention', 
+                                        height=fontH, wrapWidth=0.1,
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz, 
+                                        alignHoriz='center')
+            fdbk_desc = visual.TextStim(win, pos=[0.65, -0.15], 
+                                        text='Feedback', height=fontH, 
+                                        wrapWidth=0.1, color=text_color, 
+                                        flipHoriz=flipHoriz, 
+                                        alignHoriz='center')
+            
+            fix1_exmp.draw()
+            cuex_exmp.draw()
+            fix2_exmp.draw()
+            targ_exmp.draw()
+            fix3_exmp.draw()
+            fdbk_exmp.draw()
+            fix1_desc.draw()
+            cuex_desc.draw()
+            fix2_desc.draw()
+            targ_desc.draw()
+            fix3_desc.draw()
+            fdbk_desc.draw()
+
+# Function for rendering the instructions once, before they are shown, so
+# turning a page is a single blit of a BufferImageStim
+def compile_instructions(inst_file, instructions, run):
+    if (inst_file, run) in instruction_pages:
+        return instruction_pages[(inst_file, run)]
+    
     inname = _thisDir + os.sep + inst_dir + os.sep + inst_file
     infile = pd.read_csv(inname)
 
     instr_images = list(infile['images'])
+    pages = []
+    for instructLine in range(len(instructions)):
+        win.clearBuffer()
+        draw_instruction_page(instructions[instructLine], 
+                              instr_images[instructLine], run)
+        pages.append(visual.BufferImageStim(win))
+    win.clearBuffer()
+    
+    instruction_pages[(inst_file, run)] = pages
+    return pages
+
+# Function for displaying instructions
+def display_instructions_file(inst_file, instructions, run):
+    pages = compile_instructions(inst_file, instructions, run)
+    
     endOfInstructions = False
     instructLine = 0
 
     while not endOfInstructions:
         
-        if run == 0:
-            instructPrompt.setText(instructions[instructLine])
-            instructPrompt.draw()
-            
-            # Present image if relevant
-            if instr_images[instructLine] != 'none' and run == 0:
-                inst_target = visual.Polygon(win, edges=3, radius=0.1, 
-                                            fillColor="white", pos=(0,yScr/10))
-                inst_target.draw()
-                
-            instructMove.draw()
-            win.flip()
-            
-        else:
-            if instr_images[instructLine] == 'none':
-                instructPrompt.setText(instructions[instructLine])
-                instructPrompt.draw()
-                instructMove.draw()
-                win.flip()
-            
-            else:    
-                fix1_exmp = visual.TextStim(win, pos=[-0.65, 0.15], 
-                                            text='+', height=fontH*2, 
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz)
-                cuex_exmp = visual.ImageStim(win, pos=[-0.35,0.15], size=0.2,
-                                             image=stim_dir+"reward_high.png")
-                fix2_exmp = visual.TextStim(win, pos=[-0.15, 0.15], text='+', 
-                                            height=fontH*2, color=text_color, 
-                                            flipHoriz=flipHoriz)
-                targ_exmp = visual.Polygon(win, pos=[0.15,0.15], edges=3, 
-                                           radius=0.1, fillColor="white")
-                fix3_exmp = visual.TextStim(win, pos=[0.35, 0.15], text='+', 
-                                            height=fontH*2, color=text_color, 
-                                            flipHoriz=flipHoriz)
-                fdbk_exmp = visual.TextStim(win, pos=[0.65, 0.15], 
-                                            text='Hit!\n+$5.00', 
-                                            height=fontH*2, 
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz)
-                
-                # Draw bottom row of page
-                fix1_desc = visual.TextStim(win, pos=[-0.65, -0.15], 
-                                            text='Pay attention', 
-                                            height=fontH, wrapWidth=0.1,
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz,
-                                            alignHoriz='center')
-                cuex_desc = visual.TextStim(win, pos=[-0.35, -0.15], 
-                                            text="Cue: don't respond yet", 
-                                            height=fontH, wrapWidth=0.1,
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz, 
-                                            alignHoriz='center')
-                fix2_desc = visual.TextStim(win, pos=[-0.15, -0.15], 
-                                            text='Pay attention', 
-                                            height=fontH, wrapWidth=0.1,
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz, 
-                                            alignHoriz='center')
-                targ_desc = visual.TextStim(win, pos=[0.15, -0.15], 
-                                            text='Respond when solid triangle is on screen', 
-                                            height=fontH, wrapWidth=0.1,
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz, 
-                                            alignHoriz='center')
-                fix3_desc = visual.TextStim(win, pos=[0.35, -0.15], 
-                                            text='Pay attention', 
-                                            height=fontH, wrapWidth=0.1,
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz, 
-                                            alignHoriz='center')
-                fdbk_desc = visual.TextStim(win, pos=[0.65, -0.15], 
-                                            text='Feedback', height=fontH, 
-                                            wrapWidth=0.1, color=text_color, 
-                                            flipHoriz=flipHoriz, 
-                                            alignHoriz='center')
-                
-                fix1_exmp.draw()
-                cuex_exmp.draw()
-                fix2_exmp.draw()
-                targ_exmp.draw()
-                fix3_exmp.draw()
-                fdbk_exmp.draw()
-                fix1_desc.draw()
-                cuex_desc.draw()
-                fix2_desc.draw()
-                targ_desc.draw()
-                fix3_desc.draw()
-                fdbk_desc.draw()
-                
-                win.flip()
+        pages[instructLine].draw()
+        win.flip()
         
         instructRep = event.waitKeys(keyList=expKeys)
         if instructRep[0] == backKey:
@@ -309,14 +378,13 @@ def display_instructions_file(inst_file, instructions, run):
 filename = start_datafiles(_thisDir, expName, expInfo, data_dir, sn, session, 
                            fmri)
 
-# An ExperimentHandler isn't essential but helps with data saving
-exp = data.ExperimentHandler(name=expName, version=version, 
-                             extraInfo=expInfo, runtimeInfo=None,
-                             originPath=None, savePickle=True, 
-                             saveWideText=True, dataFileName=filename)
+# Trial data is appended to a journal as each trial completes, so a crash
+# loses at most one trial; the CSV is rebuilt from it at the end of each run
+exp = mid_io.TrialWriter(filename, extraInfo=expInfo, append=resume)
 
-# Save a log file for detail verbose info
-logFile = logging.LogFile(filename+'.log', level=logging.EXP)
+# Save a log file for detail verbose info; it is written from a background
+# thread, so logging.flush() does no disk I/O in the presentation loop
+logFile = mid_io.QueuedLogFile(filename+'.log', level=logging.EXP)
 logging.console.setLevel(logging.WARNING)  # this outputs to the screen, not a file
 
 # Setup the window and presentation constants
@@ -327,12 +395,29 @@ fontH = yScr/25
 wrapW = xScr/1.5
 text_color = 'white'
 
-# Store frame rate of monitor if we can measure it
-expInfo['frameRate'] = win.getActualFrameRate()
-if expInfo['frameRate'] != None and expInfo['frameRate'] < 300:
-    frame_duration = 1.0 / round(expInfo['frameRate'])
+startup.mark('window')
+
+# Frame rate of the monitor: from this machine's calibration profile if a
+# short run of flips agrees with it, otherwise measured (and saved)
+calibration_file = mid_startup.profile_name(_thisDir + os.sep + data_dir + 'calibration', 
+                                            win.screen, win_res)
+[expInfo['frameRate'], frame_duration, 
+ expInfo['frameRateSource']] = mid_startup.calibrate(win, calibration_file, win.screen)
+startup.mark('frame_rate')
+
+# Per-frame profiler of the presentation loops (does nothing unless profile_frames)
+if profile_frames:
+    profiler = mid_profile.FrameProfiler(frame_duration)
 else:
-    frame_duration = 1.0 / 60.0  # could not measure, so guess
+    profiler = mid_profile.NullProfiler()
+
+# Intervals between flips, recorded for the whole run and split by routine
+frame_intervals = mid_timing.FrameIntervalTracker(win, frame_duration)
+
+# The adaptive target window lives in whole frames of the measured refresh rate
+speed_factor_frames = max(mid_timing.to_frames(single_speed_factor, frame_duration), 1)
+min_target_frames = mid_timing.to_frames(min_target_dur, frame_duration)
+max_target_frames = mid_timing.to_frames(max_target_dur, frame_duration)
 
 # Create a message at the bottom of the screen to tell subject to proceed
 instructMoveText = f"Press the button to continue."
@@ -346,7 +431,6 @@ instructMove = visual.TextStim(win, text=instructMoveText, height=fontH,
 # Create fixation stimulus
 fix = visual.TextStim(win, pos=[0, 0], text='+', height=fontH*2, 
                       color=text_color, flipHoriz=flipHoriz)
-clock = core.Clock()
 
 # Pre-instructions
 instructPre = visual.TextStim(win, text="Please wait.\n\nThe task instructions will begin soon.",
@@ -387,21 +471,56 @@ cues = {
     'loss.neut':   visual.ImageStim(win, size=0.3, 
                                     image=stim_dir+"loss_neut.png"),
     }
-CueClock = core.Clock()
 
 # Initialize components for Routine "Target"
-TargetClock = core.Clock()
 Target = visual.Polygon(win, edges=3, radius=0.2, fillColor="white", 
 pos=(0,0))
 
 # Initialize components for Routine "Feedback"
-FeedbackClock = core.Clock()
-trial_feedback = visual.TextStim(win=win, name='trial_feedback',
-                                 text='Trial:', font='Arial', 
-                                 pos=(0, 0), height=fontH+yScr/20, 
-                                 wrapWidth=None, ori=0, color='White', 
-                                 colorSpace='rgb', opacity=1, 
-                                 flipHoriz=flipHoriz);
+# Feedback text for the reward of a trial
+def trial_cash_string(r, trial_response, trial_type):
+    if r > 0:
+        return f"Hit!\n+${r:.2f}"
+    elif r < 0:
+        return f"Miss!\n-${abs(r):.2f}"
+    elif trial_response == 1:
+        return f"Hit!\n${r:.2f}"
+    elif trial_type == 'loss.neut':
+        return f"Miss!\n-${r:.2f}"
+    else:
+        return f"Miss!\n${r:.2f}"
+
+def total_cash_string(r):
+    if r < 0:
+        return f"Miss!\n${r:.2f}"
+    else:
+        return f"${r:.2f}"
+
+def make_trial_feedback(text):
+    return visual.TextStim(win=win, name='trial_feedback',
+                           text=text, font='Arial', 
+                           pos=(0, 0), height=fontH+yScr/20, 
+                           wrapWidth=None, ori=0, color='White', 
+                           colorSpace='rgb', opacity=1, 
+                           flipHoriz=flipHoriz)
+
+# Build the trial feedback for every text a trial can end with, drawn once to
+# the back buffer, so feedback onset only swaps in a ready stimulus
+def make_feedback_stims():
+    stims = {}
+    for trial_type, amount in trial_rewards.items():
+        for r in (amount, 0.0):
+            for trial_response in (0, 1):
+                text = trial_cash_string(r, trial_response, trial_type)
+                if text not in stims:
+                    stims[text] = make_trial_feedback(text)
+                    stims[text].draw()
+    win.clearBuffer()
+    return stims
+
+trial_feedback = make_trial_feedback('Trial:')
+feedback_stims = make_feedback_stims()
+
 exp_feedback = visual.TextStim(win=win, name='exp_feedback',
                                text='Total:', font='Arial', 
                                pos=(0, -yScr/16), height=fontH+yScr/20, 
@@ -424,7 +543,11 @@ waitPrompt = visual.TextStim(win, text="Please wait\n\n",
 globalClock = core.Clock()  # to track the time since experiment started
 runClock = core.Clock()  # to track the time since experiment started
 trialClock = core.Clock()  # to track the time since trial started
-routineTimer = core.CountdownTimer()  # to track time remaining of each (non-slip) routine
+
+# Key presses are timestamped as they happen and collected in a background
+# thread, then queried by time window on the run clock, so RTs are measured
+# against the flip-locked stimulus onsets whatever the draw loop is doing
+responses = mid_io.ResponseBox(runClock, ttl_keys=[ttlKey], tr=scanner_TR)
 
 
 # Create the staircase handlers to adjust for individual threshold
@@ -462,47 +585,304 @@ staircase_end = {}
 
 # Useful functions
 
-def get_keypress():
-    keys = event.getKeys()
+def check_responses(t_start):
+    """
+    Checks the key presses since t_start (run clock) for escape and returns
+    the time of the first response key, or None
+    """
+    t_response = None
+    for key, t_key in responses.get_keys(keyList=forwardKeys + escapeKeys, 
+                                         t_start=t_start):
+        if key.lower() in escapeKeys:
+            logging.warning("Escape pressed, exiting early!")
+            shutdown()
+        if t_response is None:
+            t_response = t_key
+    return t_response
+
+def get_target_response(onset, offset=None):
+    """Time of the first response key pressed between onset and offset, or None"""
+    keys = responses.get_keys(keyList=forwardKeys, t_start=onset, t_end=offset)
     if keys:
-        return keys[0]
-    else:
-        return None
+        return keys[0][1]
+    return None
 
 def shutdown():
     print("Logging staircase end values and exiting...")
-    stairs = ['loss.high', 'loss.low', 'loss.neut', 
-              'reward.high', 'reward.low', 'reward.neut']
 
     logging.warning(f"Total earnings: {total_earnings}")
 
+    responses.close()
+    exp.close()
     logging.flush()
+    logFile.close()
     win.close()
     core.quit()
 
 def show_stim(stim, duration):
-    duration = float(duration)
-    t_start = globalClock.getTime()
-    routineTimer.reset()
-    routineTimer.addTime(duration)
-    event.clearEvents(eventType='keyboard')
-    rt = None
-    while routineTimer.getTime() > 0:
-        key = get_keypress()
-        if key and key.lower() in escapeKeys:
-            logging.warning("Escape pressed, exiting early!")
-            shutdown()
-        if not rt and key in forwardKeys:
-            rt = duration - routineTimer.getTime()
-        if stim:
-            stim.draw()
-        win.flip()
-    return rt
-    print('TESTING...'+str(rt)+'\n')
+    """Presents a stimulus (a blank screen if None) for duration seconds"""
+    return routines.show(stim, end_time=runClock.getTime() + float(duration))[0]
 
 def show_fixation(duration):
     return show_stim(fix, duration)
 
+def log_dropped_frames(event_name, trial, dropped, longest, save=True):
+    """
+    Saves the dropped frames and longest frame interval of an event with the
+    trial. The trial is saved on the first frame of its ITI, so the frames of
+    the ITI are saved with the next trial (prev_ITI), and those of the last
+    ITI of a run are only logged.
+    """
+    if save:
+        column = 'prev_ITI' if event_name == 'Fix_ITI' else event_name
+        exp.addData(column+'.DroppedFrames', dropped)
+        exp.addData(column+'.MaxInterval', round(longest, 4))
+        if event_name == 'Tgt':
+            exp.addData('Tgt.FrameDropped', int(dropped > 0))
+    if dropped and event_name == 'Tgt':
+        logging.warning(f"Dropped frame during the target window: {dropped} frame(s) "
+                        f"in trial {trial}, longest interval {longest * 1000:.1f} ms")
+    elif dropped:
+        logging.warning(f"Dropped frames: {dropped} in {event_name} of trial {trial}, "
+                        f"longest interval {longest * 1000:.1f} ms")
+
+def log_onset(event_name, planned):
+    """
+    Logs the measured and planned onset of an event, along with the drift
+    between them (cumulative since the start of the run).
+    """
+    onset = runClock.getTime()
+    profiler.mark(event_name, trial_number)
+    t = profiler.start()
+    closed = frame_intervals.next_event(event_name, trial_number)
+    if closed is not None:
+        log_dropped_frames(*closed)
+    drift = drift_tracker.record(trial_number, event_name, planned, onset)
+    exp.addData(event_name+'.OnsetTime', onset)
+    exp.addData(event_name+'.PlannedOnset', planned)
+    exp.addData(event_name+'.Drift', drift)
+    if triggerOnTTL:
+        # Scanner volumes acquired so far in the run
+        exp.addData(event_name+'.Volume', responses.volume_at(onset))
+    profiler.lap(mid_profile.ADD_DATA, t)
+    return onset
+
+def log_flip_onset(event_name, onset):
+    """
+    Logs the time of the flip that first showed an event (flip-locked, on the
+    run clock), alongside the onset logged before it was drawn.
+    """
+    exp.addData(event_name+'.FlipOnsetTime', onset)
+
+def show_stim_until(stim, end_time):
+    """
+    Presents a stimulus until the run clock reaches end_time (in seconds from
+    run start), so any overrun from the previous routine is absorbed here.
+    """
+    return routines.show(stim, end_time=end_time)[0]
+
+def show_fixation_until(end_time):
+    return show_stim_until(fix, end_time)
+
+def checkpoint_name(run):
+    """File holding the checkpoint of a run, saved after every trial"""
+    if run == 0:
+        return filename+'_checkpoint-MRT.pkl'
+    return filename+'_checkpoint-run'+str(run)+'.pkl'
+
+
+# The routines of a trial, presented by the routine engine as a sequence of
+# phases. Each phase logs the onset of its event; the functions below add the
+# data of the trial as the phases start and end.
+
+def cue_of(trial):
+    return cues[trial.type]
+
+def end_cue(trial, result):
+    exp.addData('Cue.Frames', result.frames)
+    if result.rt:
+        exp.addData('trial.cue_rt', result.rt)
+
+def end_delay(trial, result):
+    # A press before the target is too fast
+    if result.rt:
+        logging.exp(f"too fast rt: {result.rt}")
+        trial.response = 2
+        exp.addData('trial.too_fast_rt', result.rt)
+
+def start_target(trial):
+    trial.cond_slot = cond_state.index[trial.type]
+    trial.target_frames = cond_state.frames[trial.cond_slot]
+    trial.plan['Fix_after_target'] = (trial.plan['Tgt'] + 
+                                      trial.target_frames * frame_duration)
+
+def target_frames_of(trial):
+    return trial.target_frames
+
+def end_target(trial, result):
+    global total_earnings
+    t_profile = profiler.start()
+    # Record the duration the target was actually on screen
+    target_dur_shown = result.frames * frame_duration
+    if result.rt is not None:
+        trial.rt = result.rt
+        if trial.response == 0:
+            trial.response = 1
+    exp.addData('Tgt.Frames', result.frames)
+    
+    # Add the data to the current staircase so it can be used to calculate the next level
+    stairs[trial.type].addResponse(trial.response)
+    
+    # Check responses to add RT
+    if trial.response == 1:
+        exp.addData('trial.rt', trial.rt)
+        exp.addData('trial.target_dur', round(target_dur_shown, 4))
+        logging.exp(f"response: {trial.rt}")
+        trial_RTs.append(trial.rt)
+    elif trial.response == 2 and trial.rt:
+        exp.addData('trial.rt', trial.rt)
+        exp.addData('trial.target_dur', round(target_dur_shown, 4))
+        logging.exp(f"response: {trial.rt}")
+    else:
+        exp.addData('trial.target_dur', round(target_dur_shown, 4))
+        logging.exp("response: none during stim")
+        trial_RTs.append(target_dur_shown)
+    t_profile = profiler.lap(mid_profile.OTHER, t_profile)
+    logging.flush()
+    t_profile = profiler.lap(mid_profile.LOG_FLUSH, t_profile)
+    
+    # Calculate trial condition hit rate
+    hit_rate = cond_state.record(trial.cond_slot, trial.response == 1)
+    
+    # Step by the whole number of frames closest to single_speed_factor
+    if hit_rate >= 0.66:
+        cond_state.step(trial.cond_slot, -1)  # subtract ~20ms
+    else:
+        cond_state.step(trial.cond_slot, 1)  # add ~20ms
+    
+    logging.exp(f"{trial.type} duration is: {cond_state.duration(trial.cond_slot)}")
+
+    reward = 0
+
+    # Update trial components
+    if trial.type == 'reward.high' and trial.response == 1:
+        reward = trial_rewards[trial.type]
+        exp.addData('trial.reward', reward)
+    elif trial.type == 'reward.low' and trial.response == 1:
+        reward = trial_rewards[trial.type]
+        exp.addData('trial.reward', reward)
+    elif trial.type == 'reward.neut' and trial.response == 1:
+        reward = trial_rewards[trial.type]
+        exp.addData('trial.reward', reward)
+    elif trial.type == 'loss.high' and not trial.response == 1:
+        reward = trial_rewards[trial.type]
+        exp.addData('trial.reward', reward)
+    elif trial.type == 'loss.low' and not trial.response == 1:
+        reward = trial_rewards[trial.type]
+        exp.addData('trial.reward', reward)
+    elif trial.type == 'loss.neut' and not trial.response == 1:
+        reward = trial_rewards[trial.type]
+        exp.addData('trial.reward', '-' + str(reward))
+    
+    trial.reward = reward
+    total_earnings += reward
+    if DEBUG:
+        logging.exp(f"{trial.type} result: {trial.response}, reward is {reward} "
+                    f"for total {total_earnings}")
+
+def end_fix_after_target(trial, result):
+    # A press after the target window is too slow
+    if result.rt:
+        logging.exp(f"too slow rt: {result.rt}")
+        trial.response = 3
+        exp.addData('trial.too_slow_rt', result.rt)
+
+def start_feedback(trial):
+    feedback_text = trial_cash_string(trial.reward, trial.response, trial.type)
+    if feedback_text not in feedback_stims:
+        feedback_stims[feedback_text] = make_trial_feedback(feedback_text)
+    trial.feedback = feedback_stims[feedback_text]
+    exp.addData("Tgt.ACC", trial.response)
+    exp.addData('Tgt.ACCfeedback', feedback_text)
+    exp.addData('total_earnings', total_earnings)
+
+def feedback_of(trial):
+    return trial.feedback
+
+def end_feedback(trial, result):
+    exp.addData('Fb.Frames', result.frames)
+
+def start_iti(trial):
+    # Report scanner triggers that went missing or came in extra
+    for volume, flag, n in responses.volumes.pop_flags():
+        logging.warning(f"TTL: {n} {flag} trigger(s) at volume {volume}")
+    
+    # Completed trial, add some data to log file
+    exp.addData('Fix_ITI.Duration', fix_ITI[trial.index])
+    # Trial and global times are taken at the planned end of the ITI
+    iti_left = trial.plan['end'] - runClock.getTime()
+    exp.addData('time.trial', trialClock.getTime() + iti_left)
+    exp.addData('time.global', globalClock.getTime() + iti_left)
+    
+    exp.addData('Winnings', total_earnings)
+    
+    # Save mean RT to output
+    if trial.index == num_trials-1:
+        exp.addData('MRT', np.mean(trial_RTs))
+
+def save_trial(trial, t_first):
+    # Advance to next trial/line in logFile, once the flip-locked onset of
+    # the ITI is in
+    exp.nextEntry()
+    
+    # Write the trial, a checkpoint of the run and the log to disk during
+    # the ITI, which absorbs the time it takes so the next trial still
+    # starts at its planned time
+    t_profile = profiler.start()
+    exp.commit()
+    mid_state.save_checkpoint(checkpoint_name(run), {
+        'run': run, 'trial': trial.index + 1, 'trial_number': trial_number,
+        'random_state': random.getstate(), 'stim_list': stim_list,
+        'fix_ITI': fix_ITI, 'fix_after_cue': fix_after_cue_list,
+        'cond_state': cond_state, 'stairs': stairs,
+        'staircase_end': staircase_end, 'total_earnings': total_earnings,
+        'trial_RTs': trial_RTs, 'num_reruns': num_reruns})
+    t_profile = profiler.lap(mid_profile.COMMIT, t_profile)
+    logging.flush()
+    logFile.drain()
+    profiler.lap(mid_profile.LOG_FLUSH, t_profile)
+
+cue_frames = mid_timing.to_frames(cue_time, frame_duration)
+feedback_frames = mid_timing.to_frames(feedback_time, frame_duration)
+
+# The phases of a trial: the cue, the fixation after it, the target, the
+# fixation after the target (which absorbs the variable target window), the
+# feedback and the ITI
+task_phases = [
+    mid_routines.Phase('Cue', cue_of, until='Dly', frames=cue_frames, end=end_cue),
+    mid_routines.Phase('Dly', fix, until='Tgt', end=end_delay),
+    mid_routines.Phase('Tgt', Target, frames=target_frames_of, keys=mid_routines.TARGET, 
+                       start=start_target, end=end_target),
+    mid_routines.Phase('Fix_after_target', fix, until='Fb', end=end_fix_after_target),
+    mid_routines.Phase('Fb', feedback_of, until='Fix_ITI', frames=feedback_frames, 
+                       keys=mid_routines.NO_KEYS, start=start_feedback, end=end_feedback),
+    mid_routines.Phase('Fix_ITI', fix, until='end', start=start_iti, first=save_trial),
+    ]
+
+# The MRT run has no cue or feedback
+mrt_phases = [
+    mid_routines.Phase('Tgt', Target, frames=target_frames_of, keys=mid_routines.TARGET, 
+                       start=start_target, end=end_target),
+    mid_routines.Phase('Fix_after_target', fix, until='Fix_ITI', end=end_fix_after_target),
+    mid_routines.Phase('Fix_ITI', fix, until='end', start=start_iti, first=save_trial),
+    ]
+
+# The one frame loop of every routine
+routines = mid_routines.RoutineEngine(win, runClock, frame_duration, check_responses, 
+                                      get_target_response, log_onset=log_onset, 
+                                      log_flip_onset=log_flip_onset, collect=responses.collect, 
+                                      frame_based=frame_based_timing, profiler=profiler)
+
 
 
 ############################################################################
@@ -514,9 +894,23 @@ def show_fixation(duration):
 # Create stimulus presentation list
 stim_conds = list(cues.keys())
 
+# Load (and check) the run orders of the participant's counterbalancing slot
+if order_library:
+    orders = mid_orders.OrderLibrary.load(_thisDir + os.sep + stim_dir + order_library, 
+                                          stim_conds, 
+                                          fix_after_cue_range=fix_after_cue_range, 
+                                          cache_dir=_thisDir + os.sep + data_dir + 'cache')
+    expInfo['orderLibrary'] = orders.name
+    expInfo['orderSlot'] = orders.slot(sn, session)
+
 
 # Experiment begins
 
+# Startup is over: report how long each phase took
+startup.mark('stimuli')
+print("startup: " + startup.summary())
+logging.exp("Startup: " + startup.summary())
+
 # Loop the rest of this for num_runs
 while run < num_runs:
     
@@ -550,6 +944,8 @@ while run < num_runs:
         ""]
         
     
+    compile_instructions(inst_file, instructions, run)
+    
     if fmri:
         show_stim(instructPre, pre_instructions_duration)
     
@@ -564,8 +960,6 @@ while run < num_runs:
     print("instructions complete, continuing")
     logging.flush()
     
-    # Reset the non-slip timer for next routine
-    routineTimer.reset()
     event.clearEvents(eventType='keyboard')
     
     # Determine order of stimuli for run
@@ -576,9 +970,6 @@ while run < num_runs:
         
         n_cond_reps = 3
         
-        # Set the fixation after cue buffer to 0
-        fix_after_cue = 0
-        
         
     else:  # run 1 or 2
         # Trials per run
@@ -600,9 +991,62 @@ while run < num_runs:
     random.shuffle(stim_list)
     random.shuffle(fix_ITI)
     
-    # Create a dataframe for the event file
-    order = pd.DataFrame(np.transpose([list(np.arange(1,len(stim_list)+1)), stim_list]),
-                         columns=['trial.num','trial.type'])
+    # Fixation after cue is a random number between two numbers (e.g. 2-2.5s),
+    # set to 0 for the MRT run since there is no cue
+    if run == 0:
+        fix_after_cue_list = [0] * num_trials
+    else:
+        fix_after_cue_list = [random.uniform(fix_after_cue_range[0], 
+                                             fix_after_cue_range[1]) 
+                              for trial in range(num_trials)]
+    
+    # Runs 1 and 2 take theirs from the order library instead
+    if order_library and run > 0:
+        run_order = orders.select(expInfo['orderSlot'], run)
+        num_trials = len(run_order.trial_types)
+        stim_list = list(run_order.trial_types)
+        fix_ITI = list(run_order.fix_ITI)
+        fix_after_cue_list = list(run_order.fix_after_cue)
+        logging.exp(f"Run {run} order: {orders.name}/{run_order.file}")
+    
+    # Resuming an interrupted run: restore its state as of the last trial
+    # completed, and carry on from the next one
+    first_trial = 0
+    checkpoint = None
+    if resume:
+        resume = False
+        checkpoint = mid_state.load_checkpoint(checkpoint_name(run))
+        if checkpoint is None:
+            logging.warning(f"No checkpoint for run {run}, starting it from trial 1")
+    if checkpoint:
+        first_trial = checkpoint['trial']
+        trial_number = checkpoint['trial_number']
+        stim_list = checkpoint['stim_list']
+        fix_ITI = checkpoint['fix_ITI']
+        fix_after_cue_list = checkpoint['fix_after_cue']
+        stairs = checkpoint['stairs']
+        staircase_end = checkpoint['staircase_end']
+        total_earnings = checkpoint['total_earnings']
+        trial_RTs = checkpoint['trial_RTs']
+        num_reruns = checkpoint['num_reruns']
+        random.setstate(checkpoint['random_state'])
+        print(f"resuming run {run} from trial {first_trial + 1}")
+    
+    # Plan the onset of every event in the run before the first TTL, so the
+    # run can be presented against the run clock without drifting
+    schedule = mid_timing.build_run_schedule(stim_list[first_trial:num_trials], 
+                                             fix_ITI[first_trial:], 
+                                             fix_after_cue_list[first_trial:], 
+                                             cue_time, 
+                                             isi_target_isi_time, feedback_time, 
+                                             initial_fix_duration, 
+                                             with_cue=run > 0, 
+                                             with_feedback=run > 0)
+    if frame_based_timing:
+        schedule = mid_timing.quantize_schedule(schedule, frame_duration)
+    drift_tracker = mid_timing.DriftTracker(frame_duration)
+    if DEBUG:
+        print(f"planned run duration: {mid_timing.run_duration(schedule)}")
     
     if fmri and run > 0:
         print(f"waiting for ready, hit {startKeys} after prep scan")
@@ -611,54 +1055,58 @@ while run < num_runs:
         win.flip()
         event.waitKeys(keyList=fMRI_trigger)
     
+    # Record every scanner trigger (volume) of the run from here on
+    responses.volumes.start()
+    
     # Wait for TR signal if in scanner
     if triggerOnTTL:
         print(f"waiting for TTL key {ttlKey} on TR")
         logging.flush()
         wait.draw()
         win.flip()
-        event.waitKeys(keyList=ttlKey)
+        responses.wait_for_volume()
     
     print(f"starting run {run} of {num_runs-1}")
     logging.flush()
     
     runClock.reset()
+    frame_intervals.start()
+    profiler.reset()
     if run == 0:
         globalClock.reset() # to align actual time with virtual time keeper
     
     if DEBUG:
         print(f"actual start {globalClock.getTime()}")
     
-    # Track hit accuracy
-    if run == 0:
-        target_durs = pd.DataFrame(columns=stairs.keys())
-        target_durs.loc[0] = inital_target_dur
-        
+    # Track target windows (in whole frames) and hit accuracy per condition
+    cond_state = mid_state.ConditionState(stairs.keys(), frame_duration, 
+                                          min_target_frames, max_target_frames, 
+                                          speed_factor_frames, 
+                                          window=hit_rate_window, 
+                                          alpha=hit_rate_alpha)
+    if checkpoint:
+        cond_state = checkpoint['cond_state']
+    elif run == 0:
+        cond_state.set_all(inital_target_dur)
     elif run == 1:
-        target_durs = pd.read_csv(filename+'_target_durs-MRT.csv')
+        cond_state.read_csv(filename+'_target_durs-MRT.csv')
     else:
-        target_durs = pd.read_csv(filename+'_target_durs-run'+str(run-1)+'.csv')
-    
-    hit_tracker = pd.DataFrame(columns=stairs.keys())
+        cond_state.read_csv(filename+'_target_durs-run'+str(run-1)+'.csv')
     
     # present initial fixation
     if run == 0:
         print('initial fix duration: '+str(initial_fix_duration))
-    show_fixation(initial_fix_duration)
+    show_fixation_until(initial_fix_duration)
 
-    for trial in range(0, num_trials):
+    for trial in range(first_trial, num_trials):
         if DEBUG:
             print(f'\n trial {trial + 1} of {num_trials}')
         
         # Total trial number along all runs
         trial_number += 1
-        trial_details = order.iloc[trial]
-        trial_type = trial_details['trial.type']
-        trial_response = 0
-        
-        trial_stairs = stairs[trial_type]
+        trial_type = stim_list[trial]
         
-        trial_duration_frames = trial_stairs.next()
+        trial_duration_frames = stairs[trial_type].next()
         staircase_end[trial_type] = trial_duration_frames
         
         exp.addData('subid', sn)
@@ -671,305 +1119,72 @@ while run < num_runs:
         exp.addData('trial.number', trial_number)
         exp.addData('trial.type', trial_type)
         
-        def log_detail(x):
-            print(f"{x}: {trial_details[x]}")
-        
-        
-        # ------Prepare to start Routine "Cue"-------
-        if run > 0:
-            cue = cues[trial_type]
-
-            # Log cue onset time
-            exp.addData('Cue.OnsetTime', runClock.getTime())
-            #exp.addData('Cue.Duration', cue_time)
-            cue_rt = show_stim(cue, cue_time)  # Is this needed?
-            if cue_rt:
-                exp.addData('trial.cue_rt', cue_rt)
-            
-            
-            # Fixation after cue is a random number between two numbers (e.g. 2-2.5s)
-            fix_after_cue = random.uniform(fix_after_cue_range[0], 
-                                           fix_after_cue_range[1])
-            
-            too_fast_rt = show_fixation(fix_after_cue)
-            if too_fast_rt:
-                print('too fast rt: ', too_fast_rt)
-                trial_response = 2
-                exp.addData('trial.too_fast_rt', too_fast_rt)
-            
-            # Log fixation after cue onset
-            exp.addData('Dly.OnsetTime', runClock.getTime())
-        
-        
-        # ------Prepare to start Routine "Target"-------
-        t = 0
-        TargetClock.reset()  # clock
-
-        # Reset the non-slip timer for next routine
-        routineTimer.reset()
-        continueRoutine = True
-           
-        routineTimer.addTime(target_durs.loc[0,trial_type])
-        
-        # Update component parameters for each repeat
-        target_response = event.BuilderKeyResponse()
-        rt = None
-        
-        # Keep track of which components have finished
-        TargetComponents = [Target, target_response]
-        for thisComponent in TargetComponents:
-            if hasattr(thisComponent, 'status'):
-                thisComponent.status = NOT_STARTED
-                
-        
-        # -------Start Routine "Target"-------
-        # Log target onset time
-        exp.addData('Tgt.OnsetTime', runClock.getTime())
-        
-        while continueRoutine and routineTimer.getTime() > 0:
-            # Get current time
-            t = TargetClock.getTime()
-            
-            # Selection screen updates
-            if t >= 0.0 and Target.status == NOT_STARTED:
-                # Keep track of start time/frame for later
-                Target.tStart = t
-                # Display target
-                Target.setAutoDraw(True)
-                # Open response options
-                target_response.tStart = t
-                target_response.status = STARTED
-                # Keyboard checking is just starting
-                win.callOnFlip(target_response.clock.reset)  # t=0 on next screen flip
-                event.clearEvents(eventType='keyboard')
-                theseKeys = []
-                
-            if Target.status == STARTED and t <= target_durs.loc[0,trial_type]:
-                Target.setAutoDraw(True)
-                theseKeys = event.getKeys(keyList=forwardKeys)
-
-                if len(theseKeys) > 0:  
-                    rt = target_response.clock.getTime()
-                    target_response.rt = rt
-                    if trial_response == 0:
-                        trial_response = 1
-            
-            # Check if all components have finished
-            if not continueRoutine:
-                break
-            continueRoutine = False
-            for thisComponent in TargetComponents:
-                if hasattr(thisComponent, "status") and thisComponent.status != FINISHED:
-                    continueRoutine = True
-                    break  # At least one component has not yet finished
-            
-            # Draw fixation if we're done, so we don't leave a blank screen for any frames
-            if not continueRoutine:
-                fix.draw()
-            win.flip()
-                
-                
-        # -------Ending Routine "Target"-------
-        for thisComponent in TargetComponents:
-            if hasattr(thisComponent, "setAutoDraw"):
-                thisComponent.setAutoDraw(False)
-        
-        # Add the data to the current staircase so it can be used to calculate the next level
-        trial_stairs.addResponse(trial_response)
-        
-        # Check responses to add RT
-        trial_type_count = hit_tracker[trial_type].count()
-        if trial_response == 1:
-            exp.addData('trial.rt', target_response.rt)
-            exp.addData('trial.target_dur', round(target_durs.loc[0,trial_type], 
-                                                  3))
-            print(f"response: {target_response.rt}")
-            hit_tracker.loc[trial_type_count,trial_type] = 1
-            trial_RTs.append(rt)
-        elif trial_response == 2 and rt:
-            exp.addData('trial.rt', target_response.rt)
-            exp.addData('trial.target_dur', round(target_durs.loc[0,trial_type], 
-                                                  3))
-            print(f"response: {target_response.rt}")
-            hit_tracker.loc[trial_type_count,trial_type] = 0
-        else:
-            exp.addData('trial.target_dur', round(target_durs.loc[0,trial_type], 
-                                                  3))
-            print(f"response: none during stim")
-            hit_tracker.loc[trial_type_count,trial_type] = 0
-            trial_RTs.append(target_durs.loc[0,trial_type])
-        logging.flush()
-        
-        # Calculate trial condition hit rate
-        hit_rate = hit_tracker[trial_type].sum() / hit_tracker[trial_type].count()
-        
-        if hit_rate >= 0.66:
-            target_durs.loc[0,trial_type] -= single_speed_factor  # subtract 20ms
-        else:
-            target_durs.loc[0,trial_type] += single_speed_factor  # add 20ms
-        
-        print(trial_type + ' duration is: '+str(target_durs.loc[0,trial_type]))
-        if target_durs.loc[0,trial_type] < min_target_dur:
-            target_durs.loc[0,trial_type] = min_target_dur
-        routineTimer.addTime(target_durs.loc[0,trial_type])
-
-        reward = 0
-
-        # Update trial components
-        if trial_type == 'reward.high' and trial_response == 1:
-            reward = 5.0
-            exp.addData('trial.reward', reward)
-        elif trial_type == 'reward.low' and trial_response == 1:
-            reward = 1.5
-            exp.addData('trial.reward', reward)
-        elif trial_type == 'reward.neut' and trial_response == 1:
-            reward = 0.0
-            exp.addData('trial.reward', reward)
-        elif trial_type == 'loss.high' and not trial_response == 1:
-            reward = -5.0
-            exp.addData('trial.reward', reward)
-        elif trial_type == 'loss.low' and not trial_response == 1:
-            reward = -1.5
-            exp.addData('trial.reward', reward)
-        elif trial_type == 'loss.neut' and not trial_response == 1:
-            reward = 0.0
-            exp.addData('trial.reward', '-' + str(reward))
-        
-        total_earnings += reward
-        if DEBUG:
-            print(f"{trial_type} result: {trial_response}, reward is {reward} for total {total_earnings}" )
-        
-        # Fixation after stim target
-        
-        exp.addData('Fix_after_target.OnsetTime', runClock.getTime())
-        
-        # Set the fixation after target by accounting for the variable target
-        # time window
-        if rt:
-            fix_after_target = isi_target_isi_time - fix_after_cue - rt
-        else:
-            fix_after_target = isi_target_isi_time - fix_after_cue - target_durs.loc[0,trial_type]
-        
-        too_slow_rt = show_fixation(fix_after_target)
-        if too_slow_rt:
-            print('too slow rt: ', too_slow_rt)
-            trial_response = 3
-            exp.addData('trial.too_slow_rt', too_slow_rt)
-        
-        
-        # ------Prepare to start Routine "Feedback"-------
-        if run > 0:
-            t = 0
-            FeedbackClock.reset()  # clock
-            # Reset the non-slip timer for next routine
-            routineTimer.reset()
-            continueRoutine = True
-            routineTimer.addTime(feedback_time)
-            
-            def trial_cash_string(r, trial_response):
-                if r > 0:
-                    return f"Hit!\n+${r:.2f}"
-                elif r < 0:
-                    return f"Miss!\n-${abs(r):.2f}"
-                elif trial_response == 1:
-                    return f"Hit!\n${r:.2f}"
-                elif trial_type == 'loss.neut':
-                    return f"Miss!\n-${r:.2f}"
-                else:
-                    return f"Miss!\n${r:.2f}"
-            
-            def total_cash_string(r):
-                if r < 0:
-                    return f"Miss!\n${r:.2f}"
-                else:
-                    return f"${r:.2f}"
-
-            trial_feedback.setText(trial_cash_string(reward, trial_response))        
-            exp.addData("Tgt.ACC", trial_response)
-            exp.addData('Tgt.ACCfeedback', trial_cash_string(reward, trial_response))
-            exp.addData('total_earnings', total_earnings)
-            
-            # Keep track of which components have finished
-            FeedbackComponents = [trial_feedback, exp_feedback]
-            for thisComponent in FeedbackComponents:
-                if hasattr(thisComponent, 'status'):
-                    thisComponent.status = NOT_STARTED
-            
-            
-            # -------Start Routine "Feedback"-------
-            
-            # Log feedback onset time
-            exp.addData('Fb.OnsetTime', runClock.getTime())
-            
-            while continueRoutine and routineTimer.getTime() > 0:
-                # Get current time
-                t = FeedbackClock.getTime()
-
-                # Feedback screen updates
-                if t >= 0.0 and trial_feedback.status == NOT_STARTED:
-                    # Keep track of start time/frame for later
-                    trial_feedback.tStart = t
-                    trial_feedback.setAutoDraw(True)
-                frameRemains = 0.0 + feedback_time - win.monitorFramePeriod * 0.75  # most of one frame period left
-                if trial_feedback.status == STARTED and t >= frameRemains:
-                    trial_feedback.setAutoDraw(False)
-
-                # Check if all components have finished
-                if not continueRoutine:
-                    break
-                continueRoutine = False
-                for thisComponent in FeedbackComponents:
-                    if hasattr(thisComponent, "status") and thisComponent.status != FINISHED:
-                        continueRoutine = True
-                        break  # At least one component has not yet finished
-
-                # Refresh the screen
-                if continueRoutine:  # Don't flip if this routine is over or we'll get a blank screen
-                    win.flip()
-        
-            # -------Ending Routine "Feedback"-------
-            for thisComponent in FeedbackComponents:
-                if hasattr(thisComponent, "setAutoDraw"):
-                    thisComponent.setAutoDraw(False)
-        
-        # Fixation after stim target
-        # We want this to be altered so that the length
-        # of the trial is adjusted by the stim difference from 0.5s...
-
-        trial_time = trialClock.getTime()
-                
-        # Log inter trial interval fixation time
-        exp.addData('Fix_ITI.OnsetTime', runClock.getTime())
-        
-        show_fixation(fix_ITI[trial])
-        
-        # Completed trial, add some data to log file
-        exp.addData('Fix_ITI.Duration', fix_ITI[trial])
-        exp.addData('time.trial', trialClock.getTime())
-        exp.addData('time.global', globalClock.getTime())
-        
-        exp.addData('Winnings', total_earnings)
-        
-        
-        # Save mean RT to output
-        if trial == num_trials-1:
-            exp.addData('MRT', np.mean(trial_RTs))
-        
-        
-        # Advance to next trial/line in logFile
-        exp.nextEntry()
+        # Present the routines of the trial
+        routines.run_trial(task_phases if run > 0 else mrt_phases, 
+                           mid_routines.Trial(trial_number, trial, trial_type, 
+                                              schedule[trial - first_trial]))
     
+    # The last ITI was presented after its trial was saved
+    closed = frame_intervals.stop()
+    if closed is not None:
+        log_dropped_frames(*closed, save=False)
+    print(f"dropped frames: {frame_intervals.report()['dropped']}")
     
     if run == 0:
-        # Set target durations for the average across all conditions
-        target_durs.loc[0] = target_durs.loc[0].mean()
+        # Set target durations for the average across all conditions; the
+        # MRT hit history is not condition specific, so start run 1 fresh
+        cond_state.average()
+        cond_state.reset_history()
     
     # Export target durations and run data
     if run == 0:
-        target_durs.to_csv(filename+'_target_durs-MRT.csv', index=False)
+        cond_state.to_csv(filename+'_target_durs-MRT.csv')
+    else:
+        cond_state.to_csv(filename+'_target_durs-run'+str(run)+'.csv')
+    
+    # Rebuild the full task CSV from the trial journal
+    exp.export()
+    
+    # The run is complete, so there is nothing left to resume
+    if os.path.exists(checkpoint_name(run)):
+        os.remove(checkpoint_name(run))
+    
+    # Export the per-frame profile of the run as a Chrome trace
+    profile = None
+    if profile_frames:
+        if run == 0:
+            profile = profiler.write_trace(filename+'_trace-MRT.json', {'run': run})
+        else:
+            profile = profiler.write_trace(filename+'_trace-run'+str(run)+'.json', {'run': run})
+        print(f"frames: {profile['frames']}, overruns: {profile['overruns']} "+
+              f"{profile['overrun_culprits']}")
+    
+    # Export the planned vs actual timing report for the run
+    if run == 0:
+        timing = drift_tracker.write_report(filename+'_timing-MRT.json', 
+                                            extra={'logging': logFile.metrics(), 
+                                                   'startup': startup.report(), 
+                                                   'profile': profile, 
+                                                   'frames': frame_intervals.report()})
     else:
-        target_durs.to_csv(filename+'_target_durs-run'+str(run)+'.csv', index=False)
+        timing = drift_tracker.write_report(filename+'_timing-run'+str(run)+'.json', 
+                                            extra={'logging': logFile.metrics(), 
+                                                   'startup': startup.report(), 
+                                                   'profile': profile, 
+                                                   'frames': frame_intervals.report()})
     
+    # Export the table of scanner volumes acquired during the run
+    if responses.volumes.count:
+        if run == 0:
+            responses.write_volumes(filename+'_volumes-MRT.csv')
+        else:
+            responses.write_volumes(filename+'_volumes-run'+str(run)+'.csv')
+        if DEBUG:
+            print(f"volumes: {responses.volumes.count}, missed: {responses.volumes.n_missed}, "+
+                  f"extra: {responses.volumes.n_extra}")
+    if DEBUG and timing['n_events']:
+        print(f"max drift: {timing['max_drift']:.4f}, mean drift: {timing['mean_drift']:.4f}, "+
+              f"worst: trial {timing['worst']['trial']} {timing['worst']['event']}")
     
     
     
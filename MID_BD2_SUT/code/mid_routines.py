@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""
+mid_routines.py
+
+Routine engine of the MID task scripts (mid_BD2.py, mid_practice.py).
+
+A trial is declared as a sequence of Phases: the cue, the fixation after it,
+the target, the fixation after the target, the feedback and the ITI. Each is
+a stimulus shown from its onset (logged under the name of its event) for a
+number of frames or until the planned onset of a later event, with the key
+presses it collects. Anything a phase needs that changes from trial to trial
+(the cue image, the target window, the feedback text, ...) is a function of
+the Trial, resolved once when the phase starts, and the data of the trial is
+added by the start and end functions of the phases:
+
+    phases = [Phase('Cue', cue_of, until='Dly', frames=cue_frames, end=end_cue),
+              Phase('Dly', fix, until='Tgt', end=end_delay),
+              Phase('Tgt', Target, frames=target_frames_of, keys=TARGET,
+                    start=start_target, end=end_target),
+              ...]
+    routines.run_trial(phases, Trial(trial_number, trial, trial_type, plan))
+
+RoutineEngine.show() is the only frame loop: it checks the keys, draws the
+stimulus and flips, counting the flips. No component status is set or
+scanned and nothing is switched to autoDraw.
+
+The time of the first flip of a phase is taken by a function the window
+calls as soon as the flip is done (win.callOnFlip), on the run clock, so it
+is when the stimulus appeared on the screen: the onset logged before the
+phase is taken before it is drawn, up to a frame earlier. RTs are measured
+from it, and keys are only polled once it is known; a press between the
+start of the phase and its first flip (while the previous phase was still on
+screen) is timed from the start of the phase, so no RT is negative.
+
+The last frame of the target stays on screen until the first flip of the
+next phase, so the target window is closed (and the target phase ended) right
+after that flip: a press during the last target frame is a hit.
+"""
+
+import collections
+import math
+
+import mid_profile
+import mid_timing
+
+# Key presses collected by a phase
+NO_KEYS = 'none'  # none (they are left for the next phase)
+POLL = 'poll'  # escape, and the first response, timed from the first flip
+TARGET = 'target'  # the first response from the first flip until the next phase replaces it
+
+# What a phase measured: its onset as logged (None if not logged), the RT of
+# its first response (or None), the times of its first (flip-locked) and last
+# flip, and the number of frames its stimulus was on screen
+PhaseResult = collections.namedtuple('PhaseResult', ['onset', 'rt', 't_first', 't_last',
+                                                     'frames'])
+
+
+class Phase:
+    """
+    One routine of a trial:
+        event  - the event its onset is logged as, and planned at, in the run
+                 schedule (e.g. 'Cue'); None to not log it
+        stim   - stimulus drawn on every frame (None: a blank screen), or a
+                 function of the Trial that returns it
+        until  - event of the schedule at whose planned onset it ends
+        frames - or its length in frames: a number, or a function of the
+                 Trial. A phase with both is counted in frames with
+                 frame-based timing, and ends at until otherwise
+        keys   - key presses it collects: NO_KEYS, POLL or TARGET
+        start  - function of the Trial, called after the onset is logged
+        first  - function of the Trial and the time of the first flip, called
+                 right after the first flip (or at the end, with None, if no
+                 frame was shown)
+        end    - function of the Trial and the PhaseResult, called at the end
+                 (of a TARGET phase: right after the first flip of the next
+                 phase, which closes its window)
+    """
+
+    __slots__ = ('event', 'stim', 'until', 'frames', 'keys', 'start', 'first', 'end')
+
+    def __init__(self, event, stim, until=None, frames=None, keys=POLL, start=None,
+                 first=None, end=None):
+        if until is None and frames is None:
+            raise ValueError(f"phase {event} needs until or frames")
+        self.event = event
+        self.stim = stim
+        self.until = until
+        self.frames = frames
+        self.keys = keys
+        self.start = start
+        self.first = first
+        self.end = end
+
+    def __repr__(self):
+        return f"Phase({self.event!r}, until={self.until!r}, frames={self.frames!r})"
+
+
+class Trial:
+    """
+    The state of a trial, shared by its phases: its number (across runs),
+    index (in the run), type and planned onsets, the response (0 none, 1 hit,
+    2 too fast, 3 too slow) and its RT, and the PhaseResult of each event.
+    The start and end functions of the phases can add anything else.
+    """
+
+    def __init__(self, number, index, trial_type, plan):
+        self.number = number
+        self.index = index
+        self.type = trial_type
+        self.plan = plan
+        self.response = 0
+        self.rt = None
+        self.results = {}
+
+
+class RoutineEngine:
+    """
+    Presents the phases of the trials of a run on win, timed on clock (the run
+    clock). The script provides how key presses are read:
+        poll(t_start)             - checks the keys pressed since t_start
+                                    (exiting on escape) and returns the time
+                                    of the first response, or None
+        first_response(onset, offset=None)
+                                  - the time of the first response pressed
+                                    between onset and offset, or None
+        log_onset(event, planned) - logs the onset of an event; returns it
+        log_flip_onset(event, onset)
+                                  - logs the time of the first flip of an event
+        collect()                 - gets the presses still waiting in the
+                                    device (e.g. not yet collected by a
+                                    background thread), before a target
+                                    window is closed
+    """
+
+    def __init__(self, win, clock, frame_duration, poll, first_response,
+                 log_onset=None, log_flip_onset=None, frame_based=True, profiler=None,
+                 collect=None):
+        self.win = win
+        self.clock = clock
+        self.frame_duration = frame_duration
+        self.poll = poll
+        self.first_response = first_response
+        self.log_onset = log_onset
+        self.log_flip_onset = log_flip_onset
+        self.frame_based = frame_based
+        self.profiler = profiler or mid_profile.NullProfiler()
+        self.collect = collect
+        self.t_flip = None
+        self.pending = None  # (phase, trial) of a target window still open
+
+    def on_flip(self):
+        """Called by the window right after a flip: notes its time"""
+        self.t_flip = self.clock.getTime()
+
+    def show(self, stim, n_frames=None, end_time=None, keys=POLL, first=None):
+        """
+        Presents stim for n_frames screen refreshes, or until the clock
+        reaches end_time (with frame-based timing, for the whole number of
+        frames left until it), so any overrun of the previous routine is
+        absorbed here. first is called with the time of the first flip right
+        after it. Returns (rt, time of the first flip, time of the last flip,
+        frames the stimulus was on screen, from the flip times).
+        """
+        clock, win, profiler = self.clock, self.win, self.profiler
+        t_start = clock.getTime()
+        t_stop = math.inf
+        if n_frames is None:
+            if self.frame_based:
+                # Count the frames left until the planned end instead of polling
+                n_frames = mid_timing.to_frames(end_time - t_start, self.frame_duration)
+            else:
+                # Stop with most of one frame period left so the next event lands on time
+                n_frames = math.inf
+                t_stop = end_time - self.frame_duration * 0.75
+        poll = keys == POLL
+        target = keys == TARGET
+        rt = t_first = t_last = None
+        frame = 0
+        while frame < n_frames and (t_stop == math.inf or clock.getTime() < t_stop):
+            t = profiler.start()
+            if poll and t_first is not None:
+                t_key = self.poll(t_start)
+                if rt is None and t_key is not None:
+                    rt = t_key - (t_first if t_key >= t_first else t_start)
+            elif target and rt is None and t_first is not None:
+                t_key = self.first_response(t_first)
+                if t_key is not None:
+                    rt = t_key - t_first
+            t = profiler.lap(mid_profile.KEYS, t)
+            if stim is not None:
+                stim.draw()
+            t = profiler.lap(mid_profile.DRAW, t)
+            if t_first is None:
+                win.callOnFlip(self.on_flip)
+            win.flip()
+            profiler.lap(mid_profile.FLIP, t)
+            frame += 1
+            t_last = clock.getTime()
+            if t_first is None:
+                t_first = self.t_flip
+                if first is not None:
+                    first(t_first)
+        frames = mid_timing.frames_between(t_first, t_last, self.frame_duration)
+        return rt, t_first, t_last, frames
+
+    def close_target(self, t_end):
+        """
+        Closes the pending target window at t_end, when the next flip took
+        the target off the screen: checks the presses during its last frame
+        (not polled yet) and ends the target phase.
+        """
+        if self.pending is None:
+            return
+        phase, trial = self.pending
+        self.pending = None
+        result = trial.results[phase.event]
+        if result.rt is None:
+            if self.collect is not None:
+                # A press during the last frame may not have been collected yet
+                self.collect()
+            t_key = self.first_response(result.t_first, t_end)
+            if t_key is not None:
+                result = result._replace(rt=t_key - result.t_first)
+                trial.results[phase.event] = result
+        if phase.end is not None:
+            phase.end(trial, result)
+
+    def run_phase(self, phase, trial):
+        """
+        Presents one phase of a trial; returns its PhaseResult (for a TARGET
+        phase, the RT of a press during its last frame is only in
+        trial.results once the next phase has flipped)
+        """
+        onset = None
+        if phase.event is not None and self.log_onset is not None:
+            onset = self.log_onset(phase.event, trial.plan[phase.event])
+        if phase.start is not None:
+            phase.start(trial)
+        stim = phase.stim(trial) if callable(phase.stim) else phase.stim
+        n_frames = phase.frames(trial) if callable(phase.frames) else phase.frames
+        end_time = None
+        if phase.until is not None and (n_frames is None or not self.frame_based):
+            n_frames = None
+            end_time = trial.plan[phase.until]
+
+        def first(t_first):
+            self.close_target(self.clock.getTime() if t_first is None else t_first)
+            if t_first is not None and phase.event is not None and self.log_flip_onset is not None:
+                self.log_flip_onset(phase.event, t_first)
+            if phase.first is not None:
+                phase.first(trial, t_first)
+
+        result = PhaseResult(onset, *self.show(stim, n_frames, end_time, phase.keys, first))
+        if result.t_first is None:
+            first(None)
+        trial.results[phase.event] = result
+        if phase.keys == TARGET and result.t_first is not None:
+            # Ended by the first flip of the next phase
+            self.pending = (phase, trial)
+        elif phase.end is not None:
+            phase.end(trial, result)
+        return result
+
+    def run_trial(self, phases, trial):
+        """Presents the phases of a trial in order; returns the Trial"""
+        for phase in phases:
+            self.run_phase(phase, trial)
+        self.close_target(self.clock.getTime())
+        return trial
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+"""
+mid_timing.py
+
+Timing helpers shared by the MID task scripts (mid_BD2.py, mid_practice.py).
+
+The run schedule is computed before the first TTL, so every event of a run has
+an absolute planned onset relative to the start of the run (runClock = 0).
+Each routine then presents until the planned onset of the next event instead
+of starting its own countdown, so overruns in one routine are absorbed by the
+following fixation and never carry over into later trials.
+
+Every event's planned and measured onset is collected by a DriftTracker, which
+writes a compact timing report at the end of each run. A FrameIntervalTracker
+splits the frame intervals recorded by the window between the events, for the
+dropped frames of each routine of each trial.
+"""
+
+import json
+
+
+def build_run_schedule(stim_list, fix_ITI, fix_after_cue, cue_time,
+                       isi_target_isi_time, feedback_time, initial_fix_duration,
+                       with_cue=True, with_feedback=True):
+    """
+    Returns a list with the planned onsets (in seconds from run start) of the
+    events of each trial.
+
+    Keys of each trial dict:
+        'Cue'     - cue onset (only if with_cue)
+        'Dly'     - fixation after cue onset (only if with_cue)
+        'Tgt'     - target onset
+        'Fb'      - feedback onset (only if with_feedback)
+        'Fix_ITI' - inter trial interval fixation onset
+        'end'     - end of the ITI, i.e. the onset of the next trial
+
+    The fixation after the target has no fixed onset since the target window
+    is adaptive; it always ends at 'Fb' (or at 'Fix_ITI' when there is no
+    feedback), isi_target_isi_time after the end of the cue.
+    """
+    schedule = []
+    t = float(initial_fix_duration)
+    for trial, trial_type in enumerate(stim_list):
+        planned = {'trial.type': trial_type}
+        if with_cue:
+            planned['Cue'] = t
+            planned['Dly'] = t + cue_time
+            planned['Tgt'] = planned['Dly'] + fix_after_cue[trial]
+            isi_start = planned['Dly']
+        else:
+            planned['Tgt'] = t
+            isi_start = t
+
+        if with_feedback:
+            planned['Fb'] = isi_start + isi_target_isi_time
+            planned['Fix_ITI'] = planned['Fb'] + feedback_time
+        else:
+            planned['Fix_ITI'] = isi_start + isi_target_isi_time
+
+        t = planned['Fix_ITI'] + fix_ITI[trial]
+        planned['end'] = t
+        schedule.append(planned)
+    return schedule
+
+
+def to_frames(duration, frame_duration):
+    """Converts a duration (in seconds) to the nearest whole number of frames"""
+    return max(int(round(duration / frame_duration)), 0)
+
+
+def frames_between(t_first, t_last, frame_duration):
+    """
+    Number of screen refreshes a stimulus was actually on screen for, given
+    the times of its first and last flip (None if it was never flipped).
+    """
+    if t_first is None:
+        return 0
+    return int(round((t_last - t_first) / frame_duration)) + 1
+
+
+def quantize_schedule(schedule, frame_duration):
+    """
+    Snaps every planned onset of a schedule to the frame grid of the display,
+    so each duration in the run (cue, feedback, ITIs, ...) is an exact number
+    of frames. Adds a 'frames' dict per trial with the planned frame index of
+    each event.
+    """
+    for planned in schedule:
+        planned['frames'] = {}
+        for event, onset in list(planned.items()):
+            if event in ('trial.type', 'frames'):
+                continue
+            frame = to_frames(onset, frame_duration)
+            planned['frames'][event] = frame
+            planned[event] = frame * frame_duration
+    return schedule
+
+
+def run_duration(schedule):
+    """Planned length of a run (in seconds), from the run start to the end of the last ITI"""
+    if not schedule:
+        return 0.0
+    return schedule[-1]['end']
+
+
+class DriftTracker:
+    """
+    Collects the planned and measured onset of every event in a run.
+
+    Since the schedule is anchored to the run start, the drift of an event
+    (measured - planned onset) is the cumulative drift at that point of the
+    run. Positive values mean the event started late.
+    """
+
+    # Upper edges (in frames) of the onset drift histogram bins
+    hist_bins = [0.5, 1.5, 2.5]
+    hist_labels = ['0', '1', '2', '3+']
+
+    def __init__(self, frame_duration):
+        self.frame_duration = frame_duration
+        self.records = []
+
+    def record(self, trial, event, planned, actual):
+        """Stores one event onset and returns its drift (in seconds)"""
+        drift = actual - planned
+        self.records.append((trial, event, planned, actual, drift))
+        return drift
+
+    def report(self):
+        """Summarizes the drift of the run as a dictionary"""
+        summary = {'frame_duration': self.frame_duration,
+                   'n_events': len(self.records)}
+        if not self.records:
+            return summary
+        drifts = [r[4] for r in self.records]
+        worst = max(self.records, key=lambda r: abs(r[4]))
+        summary['max_drift'] = max(drifts)
+        summary['min_drift'] = min(drifts)
+        summary['mean_drift'] = sum(drifts) / len(drifts)
+        summary['mean_abs_drift'] = sum(abs(d) for d in drifts) / len(drifts)
+        summary['worst'] = {'trial': worst[0], 'event': worst[1],
+                            'planned': worst[2], 'actual': worst[3],
+                            'drift': worst[4]}
+
+        # Per routine histogram of how late each routine started, in frames
+        routines = {}
+        for trial, event, planned, actual, drift in self.records:
+            routine = routines.setdefault(event, {
+                'n': 0, 'max_drift': drift, 'mean_drift': 0.0,
+                'overrun_frames': dict.fromkeys(self.hist_labels, 0)})
+            routine['n'] += 1
+            routine['max_drift'] = max(routine['max_drift'], drift)
+            routine['mean_drift'] += drift
+            frames = max(drift, 0) / self.frame_duration
+            label = self.hist_labels[-1]
+            for edge, bin_label in zip(self.hist_bins, self.hist_labels):
+                if frames < edge:
+                    label = bin_label
+                    break
+            routine['overrun_frames'][label] += 1
+        for routine in routines.values():
+            routine['mean_drift'] /= routine['n']
+        summary['routines'] = routines
+        return summary
+
+    def write_report(self, fname, extra=None):
+        """Writes the report (plus any extra entries) as a JSON file and returns it"""
+        summary = self.report()
+        if extra:
+            summary.update(extra)
+        with open(fname, 'w') as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+
+class FrameIntervalTracker:
+    """
+    Splits the intervals between flips that the window records
+    (win.frameIntervals, kept on for the whole run) by event, so the dropped
+    frames of each routine of each trial can be saved with the trial.
+
+    An interval longer than threshold frame periods (1.2, as PsychoPy's
+    refreshThreshold) is a dropped frame, which missed round(interval / frame
+    period) - 1 refreshes. The frames of an event are the intervals from the
+    one ending at its first flip to the one ending at its last.
+    """
+
+    # Intervals (in whole frames) of the histograms
+    hist_labels = ['1', '2', '3', '4+']
+
+    def __init__(self, win, frame_duration, threshold=1.2):
+        self.win = win
+        self.frame_duration = frame_duration
+        self.threshold = threshold
+        self.first = 0
+        self.current = None  # (event, trial) being presented
+        self.routines = {}
+
+    def start(self):
+        """Starts recording at the start of a run (the first flip has no interval)"""
+        self.win.frameIntervals = []
+        self.win.recordFrameIntervals = True
+        self.first = 0
+        self.current = None  # (event, trial) being presented
+        self.routines = {}
+
+    def next_event(self, event, trial):
+        """
+        Closes the frames of the event being presented (see close()) and
+        starts those of event.
+        """
+        closed = self.close()
+        self.current = (event, trial)
+        return closed
+
+    def close(self):
+        """
+        Returns (event, trial, dropped frames, longest interval) of the event
+        being presented, or None if there is none, and adds its intervals to
+        the run summary
+        """
+        n = len(self.win.frameIntervals)
+        intervals = self.win.frameIntervals[self.first:n]
+        self.first = n
+        if self.current is None:
+            return None
+        event, trial = self.current
+        self.current = None
+
+        routine = self.routines.setdefault(event, {
+            'intervals': 0, 'dropped': 0, 'trials_with_drops': 0, 'max_interval': 0.0,
+            'histogram': dict.fromkeys(self.hist_labels, 0)})
+        limit = self.threshold * self.frame_duration
+        late = [interval for interval in intervals if interval > limit]
+        dropped = 0
+        routine['histogram']['1'] += len(intervals) - len(late)
+        for interval in late:
+            frames = max(int(round(interval / self.frame_duration)), 2)
+            dropped += frames - 1
+            label = str(frames) if frames < 4 else self.hist_labels[-1]
+            routine['histogram'][label] += 1
+        longest = max(intervals, default=0.0)
+        routine['intervals'] += len(intervals)
+        routine['dropped'] += dropped
+        routine['trials_with_drops'] += dropped > 0
+        routine['max_interval'] = max(routine['max_interval'], longest)
+        return event, trial, dropped, longest
+
+    def stop(self):
+        """Closes the last event of a run (see close()) and stops recording"""
+        closed = self.close()
+        self.win.recordFrameIntervals = False
+        return closed
+
+    def report(self):
+        """Dropped frames and interval histogram (in frames) of each routine of the run"""
+        return {'threshold': self.threshold,
+                'dropped': sum(routine['dropped'] for routine in self.routines.values()),
+                'routines': self.routines}
@@ -0,0 +1,321 @@
+# -*- coding: utf-8 -*-
+"""
+merge_sessions.py
+
+Merges the trial data files of each session into one canonical trial table.
+
+When the task is restarted with the same participant and session, its data
+goes to new files with an _1, _2, ... suffix (e.g. MID1.1_fmri_0999_ses-1.csv,
+MID1.1_fmri_0999_ses-1_3.csv), so the trials of a session end up spread over
+several files, some with runs that were aborted or run again. This script
+scans the data directory, groups the files by expName, mode, subject and
+session, splits each file into run segments using the run and trial.number
+columns, and picks one segment per run:
+    - the latest complete segment of the run, or
+    - if every segment of the run was aborted, the longest (latest on ties).
+A segment is complete when it reached the trials of a complete run of the
+task (TASK_TRIALS, or --trials). A run whose number of trials is not known
+cannot be verified: its longest segment is used, marked neither complete nor
+aborted.
+
+For each session it writes, next to the data files:
+    <expName>_<mode>_<subject>_ses-<session>_merged.csv  - the selected trials
+    <expName>_<mode>_<subject>_ses-<session>_merged.json - index of the files,
+        the segments found in them and which one was used for each run
+
+It is incremental: a cache (.merge_cache.json in the data directory) keeps the
+size and modification time of the files of each session, and sessions whose
+files (and --trials) did not change are skipped.
+
+Usage:
+    python merge_sessions.py [data_dir] [--force] [--trials RUN=N ...]
+"""
+
+import argparse
+import csv
+import json
+import os
+import re
+import sys
+
+# Trial data files of a session, e.g. MID1.1_fmri_0999_ses-1_3.csv; the
+# journal (.jsonl) of an attempt is used when there is one, since it is
+# written as the task goes
+DATA_FILE = re.compile(r'^(?P<exp>.+?)_(?P<mode>behavioral|fmri|practice)_'
+                       r'(?P<subject>\d+)_ses-(?P<session>\d+)'
+                       r'(?:_(?P<attempt>\d+))?\.(?P<ext>csv|jsonl)$')
+CACHE_NAME = '.merge_cache.json'
+
+# Trials in a complete run of each task (expName without its version) and
+# mode, by run: num_trials in mid_BD2.py, mid_practice.py and mrt_practice.py
+TASK_TRIALS = {
+    ('MID', 'behavioral'): {0: 15, 1: 36, 2: 36},
+    ('MID', 'fmri'): {0: 15, 1: 36, 2: 36},
+    ('MID', 'practice'): {0: 6},
+    ('MRT', 'practice'): {0: 15},
+}
+
+
+def find_sessions(data_dir):
+    """
+    Returns {(expName, mode, subject, session): [file info, ...]}, the files
+    of each attempt sorted by attempt number (no suffix = attempt 0).
+    """
+    sessions = {}
+    for folder, dirs, files in os.walk(data_dir):
+        dirs.sort()
+        attempts = {}
+        for name in sorted(files):
+            match = DATA_FILE.match(name)
+            if not match:
+                continue
+            key = (match['exp'], match['mode'], match['subject'], match['session'])
+            attempt = int(match['attempt'] or 0)
+            # Prefer the journal over the CSV rebuilt from it
+            if (key, attempt) in attempts and match['ext'] == 'csv':
+                continue
+            path = os.path.join(folder, name)
+            stat = os.stat(path)
+            attempts[(key, attempt)] = {'file': path, 'attempt': attempt,
+                                        'size': stat.st_size,
+                                        'mtime': stat.st_mtime_ns}
+        for (key, attempt), info in attempts.items():
+            sessions.setdefault(key, []).append(info)
+    for files in sessions.values():
+        files.sort(key=lambda info: info['attempt'])
+    return sessions
+
+
+def read_rows(fname):
+    """Reads the trial rows of a data file (.csv or .jsonl) as dicts"""
+    rows = []
+    if fname.endswith('.jsonl'):
+        with open(fname) as f:
+            for line in f:
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    continue  # cut short by a crash
+        return rows
+    with open(fname, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = next(reader, [])
+        for values in reader:
+            row = {}
+            for name, value in zip(header, values):
+                # Skip the blank trailing column and repeated extraInfo columns
+                if name and name not in row:
+                    row[name] = value
+            rows.append(row)
+    return rows
+
+
+def as_int(value):
+    try:
+        return int(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def split_segments(rows):
+    """
+    Splits the rows of a file into run segments: consecutive trials of the
+    same run with increasing trial numbers. A run that starts again (trial
+    number going down) starts a new segment; a repeated trial number
+    replaces the earlier row.
+    """
+    segments = []
+    current = None
+    for row in rows:
+        run = as_int(row.get('run'))
+        trial = as_int(row.get('trial.number'))
+        if run is None or trial is None:
+            continue
+        if current is None or run != current['run'] or trial < current['last_trial']:
+            current = {'run': run, 'first_trial': trial, 'last_trial': trial,
+                       'rows': []}
+            segments.append(current)
+        elif trial == current['last_trial'] and current['rows']:
+            current['rows'].pop()
+        current['rows'].append(row)
+        current['last_trial'] = trial
+    return segments
+
+
+def expected_trials(exp, mode, trials_per_run=None):
+    """
+    Trials in a complete run of the task of expName exp (e.g. MID1.1) in
+    mode, by run: TASK_TRIALS, updated with trials_per_run
+    """
+    task = exp.rstrip('0123456789.')
+    trials = dict(TASK_TRIALS.get((task, mode), {}))
+    trials.update(trials_per_run or {})
+    return trials
+
+
+def merge_session(files, trials_per_run=None, exp='', mode=None):
+    """
+    Merges the files of one session (of expName exp, in mode). Returns the
+    selected rows and the index describing every segment found. complete is
+    None for a run whose number of trials is not known.
+    """
+    trials_per_run = expected_trials(exp, mode, trials_per_run)
+    segments = []
+    for info in files:
+        for n, segment in enumerate(split_segments(read_rows(info['file']))):
+            segment['file'] = os.path.basename(info['file'])
+            segment['attempt'] = info['attempt']
+            segment['segment'] = n
+            segments.append(segment)
+
+    runs = {}
+    for segment in segments:
+        runs.setdefault(segment['run'], []).append(segment)
+
+    index_runs = {}
+    selected_rows = []
+    for run in sorted(runs):
+        candidates = runs[run]
+        expected = trials_per_run.get(run)
+        for segment in candidates:
+            segment['complete'] = (None if expected is None
+                                   else segment['last_trial'] >= expected)
+        complete = [s for s in candidates if s['complete']]
+        if complete:
+            chosen = complete[-1]
+        else:
+            # Latest of the longest aborted (or unverifiable) segments
+            chosen = max(reversed(candidates), key=lambda s: len(s['rows']))
+        for segment in candidates:
+            if segment is not chosen:
+                segment['status'] = 'superseded'
+            elif segment['complete'] is None:
+                segment['status'] = 'unverified'
+            else:
+                segment['status'] = 'selected' if segment['complete'] else 'aborted'
+        index_runs[str(run)] = {'file': chosen['file'],
+                                'segment': chosen['segment'],
+                                'n_trials': len(chosen['rows']),
+                                'expected_trials': expected,
+                                'complete': chosen['complete'],
+                                'n_segments': len(candidates)}
+        for row in chosen['rows']:
+            row = dict(row)
+            row['source_file'] = chosen['file']
+            selected_rows.append(row)
+
+    index = {
+        'files': [{'file': os.path.basename(info['file']),
+                   'attempt': info['attempt'], 'size': info['size'],
+                   'mtime': info['mtime']} for info in files],
+        'segments': [{key: segment[key] for key in
+                      ('file', 'segment', 'run', 'first_trial', 'last_trial',
+                       'complete', 'status')} for segment in segments],
+        'runs': index_runs,
+        'n_trials': len(selected_rows),
+    }
+    for entry, segment in zip(index['segments'], segments):
+        entry['n_trials'] = len(segment['rows'])
+    return selected_rows, index
+
+
+def write_atomic(fname, write):
+    """Calls write(file) on a temporary file, then renames it to fname"""
+    tmp = fname+'.tmp'
+    with open(tmp, 'w', newline='') as f:
+        write(f)
+    os.replace(tmp, fname)
+
+
+def write_session(prefix, rows, index):
+    """Writes the merged trial table and index of a session"""
+    columns = []
+    seen = set()
+    for row in rows:
+        for name in row:
+            if name not in seen:
+                seen.add(name)
+                columns.append(name)
+
+    def write_table(f):
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+    write_atomic(prefix+'_merged.csv', write_table)
+    write_atomic(prefix+'_merged.json', lambda f: json.dump(index, f, indent=2))
+
+
+def load_cache(data_dir):
+    fname = os.path.join(data_dir, CACHE_NAME)
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return {}
+
+
+def merge_all(data_dir, force=False, trials_per_run=None, verbose=True):
+    """Merges every session found in data_dir; returns (n merged, n skipped)"""
+    cache = load_cache(data_dir)
+    merged = skipped = 0
+    sessions = find_sessions(data_dir)
+    for key, files in sorted(sessions.items()):
+        exp, mode, subject, session = key
+        folder = os.path.dirname(files[0]['file'])
+        prefix = os.path.join(folder, f"{exp}_{mode}_{subject}_ses-{session}")
+        cache_key = os.path.relpath(prefix, data_dir)
+        # The merge only depends on the files and the trials per run
+        signature = [[os.path.basename(info['file']), info['size'], info['mtime']]
+                     for info in files]
+        signature.append(sorted(expected_trials(exp, mode, trials_per_run).items()))
+        signature = json.loads(json.dumps(signature))
+        if (not force and cache.get(cache_key) == signature and
+                os.path.exists(prefix+'_merged.csv')):
+            skipped += 1
+            continue
+        rows, index = merge_session(files, trials_per_run, exp, mode)
+        write_session(prefix, rows, index)
+        cache[cache_key] = signature
+        merged += 1
+        if verbose:
+            runs = ', '.join(f"run {run}: {info['n_trials']}"
+                             + {True: '', False: ' (aborted)',
+                                None: ' (not verifiable)'}[info['complete']]
+                             for run, info in index['runs'].items())
+            print(f"{cache_key}: {len(files)} file(s), {runs or 'no trials'}")
+    write_atomic(os.path.join(data_dir, CACHE_NAME),
+                 lambda f: json.dump(cache, f, indent=1, sort_keys=True))
+    return merged, skipped
+
+
+def parse_trials(values):
+    """Parses RUN=N pairs given with --trials"""
+    trials = {}
+    for value in values or []:
+        run, n = value.split('=')
+        trials[int(run)] = int(n)
+    return trials
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('data_dir', nargs='?',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data'),
+                        help="data directory to scan (default: ../data)")
+    parser.add_argument('--force', action='store_true',
+                        help="merge every session, even if its files did not change")
+    parser.add_argument('--trials', nargs='*', metavar='RUN=N',
+                        help="trials in a complete run (default: those of the "
+                             "task, TASK_TRIALS)")
+    args = parser.parse_args(argv)
+    merged, skipped = merge_all(args.data_dir, args.force, parse_trials(args.trials))
+    print(f"merged {merged} session(s), {skipped} unchanged")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,476 @@
+# -*- coding: utf-8 -*-
+"""
+mid_io.py
+
+Input and data output helpers shared by the MID task scripts (mid_BD2.py,
+mid_practice.py).
+
+Key presses come from psychopy.hardware.keyboard, which stamps each key press
+when it happens (with the Psychtoolbox backend this is done in a background
+process) instead of when the script gets around to polling for it. Presses
+are kept in a buffer and handed out by time window, on the same clock as the
+flip-locked stimulus onsets, so every RT in the task is simply the difference
+between a key press time and an onset time.
+
+With the Psychtoolbox keyboard backend, an InputCollector thread drains the
+keyboard every millisecond into a deque, so presses are picked up even while
+the draw loop is busy (texture uploads, log flushes, ...). The deque is the
+only thing shared between the threads: the collector only appends and the
+task only pops from the other end, which are both atomic, so no lock is held
+by either side.
+
+Scanner triggers (TTL pulses sent as a key press, e.g. '5') are kept apart from
+the responses by a VolumeRecorder, which timestamps every volume of the run.
+
+Trial data is written by a TrialWriter as each trial completes, instead of all
+at once when the task exits, and the log file is written from a background
+thread by a QueuedLogFile.
+"""
+
+import csv
+import json
+import os
+import queue
+import threading
+import time
+from bisect import bisect_right
+from collections import deque
+
+
+class VolumeRecorder:
+    """
+    Times of the scanner triggers (one per volume) of the current run.
+
+    Triggers are added as they are collected, so `count` is a live count of
+    the volumes acquired since the run started. Each trigger interval is
+    checked against the repetition time (TR; estimated from the median trigger
+    interval when not given): an interval of about n TRs means n-1 triggers
+    were missed, and one shorter than half a TR is an extra trigger.
+
+    The trigger times are only ever appended to, and a run is marked by the
+    index of its first trigger, so triggers can be added from the collector
+    thread while the task reads them.
+    """
+
+    def __init__(self, tr=None):
+        self.tr = tr
+        self.times = []  # absolute time of every trigger
+        self.first = 0  # index of the first trigger of the run
+        self.n_missed = 0
+        self.n_extra = 0
+        self.new_flags = deque()  # (volume, flag, n triggers) not reported yet
+
+    @property
+    def count(self):
+        """Number of volumes acquired in the run so far"""
+        return len(self.times) - self.first
+
+    def start(self):
+        """Starts a new run; triggers from now on are its volumes"""
+        self.first = len(self.times)
+        self.n_missed = self.n_extra = 0
+        self.new_flags.clear()
+
+    def intervals(self):
+        """Time between consecutive triggers of the run"""
+        times = self.times[self.first:]
+        return [t - prev for prev, t in zip(times, times[1:])]
+
+    def estimate_tr(self):
+        """The TR if given, else the median trigger interval (None if too few)"""
+        if self.tr:
+            return self.tr
+        intervals = sorted(self.intervals())
+        if len(intervals) < 3:
+            return None
+        return intervals[len(intervals) // 2]
+
+    @staticmethod
+    def classify(interval, tr):
+        """Returns the flag ('', 'missed' or 'extra') and number of triggers concerned"""
+        if tr is None:
+            return '', 0
+        if interval < 0.5 * tr:
+            return 'extra', 1
+        missed = int(round(interval / tr)) - 1
+        if missed > 0:
+            return 'missed', missed
+        return '', 0
+
+    def add(self, t):
+        """Adds a trigger (absolute time) and checks its interval"""
+        self.times.append(t)
+        if self.count < 2:
+            return
+        flag, n = self.classify(t - self.times[-2], self.estimate_tr())
+        if flag == 'missed':
+            self.n_missed += n
+        elif flag == 'extra':
+            self.n_extra += n
+        if flag:
+            self.new_flags.append((self.count, flag, n))
+
+    def pop_flags(self):
+        """Missed/extra triggers flagged since the last call"""
+        flags = []
+        while self.new_flags:
+            flags.append(self.new_flags.popleft())
+        return flags
+
+    def volume_at(self, t):
+        """Number of volumes of the run acquired by absolute time t"""
+        return bisect_right(self.times, t, self.first) - self.first
+
+    def to_csv(self, fname, offset=0.0):
+        """
+        Writes the volume table of the run: onset of each volume (relative to
+        offset, the absolute run start time), interval from the previous one,
+        and missed/extra trigger flags based on the TR of the whole run.
+        """
+        times = self.times[self.first:]
+        tr = self.estimate_tr()
+        with open(fname, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['volume', 'onset', 'interval', 'flag', 'n_flagged'])
+            for volume, t in enumerate(times):
+                if volume == 0:
+                    writer.writerow([volume + 1, t - offset, '', '', 0])
+                    continue
+                interval = t - times[volume - 1]
+                flag, n = self.classify(interval, tr)
+                writer.writerow([volume + 1, t - offset, interval, flag, n])
+
+
+class InputCollector(threading.Thread):
+    """
+    Background thread moving key presses from a keyboard into a deque of
+    (key name, absolute time), oldest first. collect() can also be called
+    from the main thread, to get the presses still waiting in the keyboard
+    without waiting for the thread.
+    """
+
+    def __init__(self, keyboard, clock, ptb=False, interval=0.001,
+                 ttl_keys=(), volumes=None):
+        threading.Thread.__init__(self, name='InputCollector', daemon=True)
+        self.kb = keyboard
+        self.clock = clock
+        self.interval = interval
+        self.queue = deque()
+        self.ttl_keys = ttl_keys
+        self.volumes = volumes
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+        # With the Psychtoolbox backend, tDown is relative to the (never reset)
+        # default log clock, so it does not depend on resets of clock, which
+        # may happen while a press is being processed in this thread
+        self.base_clock = None
+        if ptb:
+            from psychopy import logging
+            self.base_clock = logging.defaultClock
+
+    def collect(self):
+        """Moves the presses waiting in the keyboard into the queue"""
+        with self._lock:
+            for key in self.kb.getKeys(waitRelease=False, clear=True):
+                if self.base_clock is not None:
+                    t = key.tDown + self.base_clock.getLastResetTime()
+                else:
+                    # key.rt is relative to the last reset of clock
+                    t = key.rt + self.clock.getLastResetTime()
+                if key.name in self.ttl_keys:
+                    self.volumes.add(t)
+                else:
+                    self.queue.append((key.name, t))
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            self.collect()
+
+    def stop(self):
+        self._stopping.set()
+        if self.is_alive():
+            self.join()
+
+
+class ResponseBox:
+    """
+    Timestamped keyboard/button box input.
+
+    Times are stored as absolute times and given back on `clock` (the run
+    clock), so presses stay correct when the run clock is reset.
+
+    If background is None, presses are collected in a background thread when
+    the keyboard uses the Psychtoolbox backend; the other backends read
+    window events, which must happen in the main thread, so there presses are
+    collected whenever the task asks for them.
+
+    Presses of ttl_keys are scanner triggers: they go to `volumes` (a
+    VolumeRecorder) instead of the responses.
+    """
+
+    def __init__(self, clock, keyboard=None, background=None, ttl_keys=(),
+                 tr=None):
+        if keyboard is None:
+            from psychopy.hardware import keyboard as hw_keyboard
+            keyboard = hw_keyboard.Keyboard(clock=clock)
+        ptb = getattr(keyboard, 'getBackend', lambda: None)() == 'ptb'
+        if background is None:
+            background = ptb
+        self.clock = clock
+        self.kb = keyboard
+        self.buffer = []  # (key name, absolute time of the press)
+        self.volumes = VolumeRecorder(tr)
+        self.collector = InputCollector(keyboard, clock, ptb=ptb,
+                                        ttl_keys=ttl_keys, volumes=self.volumes)
+        if background:
+            self.collector.start()
+
+    def clear(self):
+        """Drops every key press received so far"""
+        self.drain()
+        self.buffer = []
+
+    def drain(self):
+        """Moves the key presses collected so far into the buffer"""
+        if not self.collector.is_alive():
+            self.collector.collect()
+        queue = self.collector.queue
+        while queue:
+            self.buffer.append(queue.popleft())
+
+    def collect(self):
+        """
+        Moves every key press received so far into the buffer, including
+        those the background thread has not collected yet
+        """
+        self.collector.collect()
+        self.drain()
+
+    def wait_for_volume(self, interval=0.001):
+        """Waits for the first scanner trigger of the run (see VolumeRecorder.start)"""
+        while True:
+            self.drain()
+            if self.volumes.count:
+                return
+            time.sleep(interval)
+
+    def volume_at(self, t):
+        """Number of volumes acquired by run clock time t"""
+        return self.volumes.volume_at(t + self.clock.getLastResetTime())
+
+    def write_volumes(self, fname):
+        """Writes the volume table of the run, with onsets on the run clock"""
+        self.drain()
+        self.volumes.to_csv(fname, self.clock.getLastResetTime())
+
+    def close(self):
+        """Stops the background collector"""
+        self.collector.stop()
+
+    def get_keys(self, keyList=None, t_start=None, t_end=None):
+        """
+        Returns the (key name, time) of the presses of keyList keys between
+        t_start and t_end (run clock times; None = no limit), oldest first.
+        Those presses are removed from the buffer, as are presses of any key
+        from before t_start. Later presses are kept for the next query.
+        """
+        self.drain()
+        offset = self.clock.getLastResetTime()
+        found = []
+        keep = []
+        for name, t_abs in self.buffer:
+            t = t_abs - offset
+            if t_start is not None and t < t_start:
+                continue
+            if (t_end is None or t <= t_end) and (keyList is None or name in keyList):
+                found.append((name, t))
+            else:
+                keep.append((name, t_abs))
+        self.buffer = keep
+        found.sort(key=lambda key: key[1])
+        return found
+
+
+class TrialWriter:
+    """
+    Crash-safe trial data writer, with the addData/nextEntry interface of a
+    psychopy ExperimentHandler.
+
+    Each completed row (plus the extraInfo columns) is appended to a JSON
+    Lines journal, <fname>.jsonl, and commit() flushes and fsyncs it to disk,
+    so a crash or power loss loses at most the trial in progress. Only the
+    current row is kept in memory. export() rebuilds the wide <fname>.csv from
+    the journal into a temporary file and renames it into place, so the CSV on
+    disk is always a complete version.
+
+    If the data files already exist, _1, _2, ... is added to fname, unless
+    append is set (e.g. to resume an interrupted run into the same files).
+    """
+
+    def __init__(self, fname, extraInfo=None, append=False):
+        base = fname
+        n = 0
+        while not append and (os.path.exists(fname+'.jsonl') or 
+                              os.path.exists(fname+'.csv')):
+            n += 1
+            fname = base+'_'+str(n)
+        self.fname = fname
+        self.extraInfo = extraInfo if extraInfo is not None else {}
+        self.row = {}
+        self.pending = 0
+        folder = os.path.dirname(fname)
+        if folder and not os.path.isdir(folder):
+            os.makedirs(folder)
+        self.journal = open(fname+'.jsonl', 'a')
+
+    def addData(self, name, value):
+        self.row[name] = value
+
+    def nextEntry(self):
+        """Completes the current row and appends it to the journal"""
+        row = dict(self.row)
+        for name, value in self.extraInfo.items():
+            row.setdefault(name, value)
+        self.journal.write(json.dumps(row, default=str)+'\n')
+        self.row = {}
+        self.pending += 1
+
+    def commit(self):
+        """Makes every completed row durable (flush + fsync)"""
+        if not self.pending:
+            return
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.pending = 0
+
+    def rows(self):
+        """Iterates over the rows in the journal"""
+        with open(self.fname+'.jsonl') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # Empty, or cut short by a crash while it was written
+                    continue
+
+    def export(self):
+        """Atomically rewrites <fname>.csv with every row written so far"""
+        self.commit()
+        columns = []
+        seen = set()
+        for row in self.rows():
+            for name in row:
+                if name not in seen:
+                    seen.add(name)
+                    columns.append(name)
+        tmp = self.fname+'.csv.tmp'
+        with open(tmp, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            for row in self.rows():
+                writer.writerow(row)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.fname+'.csv')
+
+    def close(self):
+        """Exports the CSV and closes the journal"""
+        if self.journal.closed:
+            return
+        self.export()
+        self.journal.close()
+
+
+class QueuedLogFile:
+    """
+    psychopy logging target writing to a file from a background thread.
+
+    A drop-in replacement for logging.LogFile: logging.flush() only puts the
+    formatted lines on a bounded in-memory queue, and a writer thread does the
+    disk I/O, so flushing the log no longer blocks the presentation loop. If
+    the queue is full, logging.flush() waits for room rather than dropping
+    lines (counted in the 'overflows' metric). drain() waits until everything
+    queued is on disk; call it when there is time to spare (e.g. the ITI) and
+    close() at shutdown.
+    """
+
+    def __init__(self, f, level=None, filemode='a', maxsize=10000, logger=None):
+        from psychopy import logging
+        self.level = logging.WARNING if level is None else level
+        self.file = open(f, filemode, encoding='utf8')
+        # logging.flush() calls stream.flush() after the writes; the writer
+        # thread flushes the file itself, so this does nothing
+        self.stream = self
+        self.queue = queue.Queue(maxsize)
+        self.n_written = 0
+        self.n_overflows = 0
+        self.max_depth = 0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        self.writer = threading.Thread(target=self._write_loop,
+                                       name='QueuedLogFile', daemon=True)
+        self.writer.start()
+        self.logger = logging.root if logger is None else logger
+        self.logger.addTarget(self)
+
+    def setLevel(self, level):
+        self.level = level
+        self.logger._calcLowestTarget()
+
+    def write(self, txt):
+        """Queues a line of the log (called by logging.flush())"""
+        item = (time.perf_counter(), txt)
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            self.n_overflows += 1
+            self.queue.put(item)
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def flush(self):
+        pass
+
+    def _write_loop(self):
+        while True:
+            batch = [self.queue.get()]
+            # Write everything queued so far in one go
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            lines = [item for item in batch if item is not None]
+            if lines:
+                self.file.write(''.join(txt for t, txt in lines))
+                self.file.flush()
+                now = time.perf_counter()
+                for t, txt in lines:
+                    self.max_latency = max(self.max_latency, now - t)
+                    self.total_latency += now - t
+                self.n_written += len(lines)
+            for item in batch:
+                self.queue.task_done()
+            if len(lines) < len(batch):
+                return  # close() was called
+
+    def drain(self):
+        """Waits until every queued line has been written to the file"""
+        self.queue.join()
+
+    def metrics(self):
+        """Queue depth and write latency (from queueing to on disk, in seconds)"""
+        return {'depth': self.queue.qsize(),
+                'max_depth': self.max_depth,
+                'lines_written': self.n_written,
+                'overflows': self.n_overflows,
+                'max_latency': self.max_latency,
+                'mean_latency': self.total_latency / self.n_written if self.n_written else 0.0}
+
+    def close(self):
+        """Writes out the queue, stops the writer thread and closes the file"""
+        if self.file.closed:
+            return
+        self.logger.removeTarget(self)
+        self.queue.put(None)
+        self.writer.join()
+        self.file.close()
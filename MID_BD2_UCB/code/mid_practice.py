@@ -11,19 +11,27 @@ Based on code originally written by @nivreggev, see README
 Modified by Haroon Popal (hspopal on GitHub)
 """
 
-from psychopy import gui, visual, core, data, event, logging, monitors
-from psychopy.constants import (NOT_STARTED, STARTED, PLAYING, PAUSED,
-                                STOPPED, FINISHED, PRESSED, RELEASED, FOREVER)
-from numpy.random import random, shuffle
+import time
+startup_t0 = time.perf_counter()
+
+# Only what the participant dialog needs is imported here; see below for the
+# rest of psychopy and pandas
+from psychopy import gui, core, logging
 import random
 import os
-import csv
-import pandas as pd
-import numpy as np
-import time
-from pathlib import Path
 import warnings
 
+import mid_io
+import mid_routines
+import mid_startup
+import mid_state
+import mid_timing
+
+# Import the modules that are not needed by the dialog while it is open
+startup = mid_startup.StartupTimer(startup_t0)
+preloading = mid_startup.preload(['pandas', 'psychopy.data', 'psychopy.monitors'])
+startup.mark('imports')
+
 warnings.filterwarnings("ignore", category=DeprecationWarning) 
 
 ############################################################################
@@ -46,22 +54,37 @@ num_trials = 6
 
 initial_fix_duration = 5  # Added time to make sure homogenicity of magnetic field is reached
 closing_duration = 8.0  # Added time at end of last run to make sure we capture enough
+scanner_TR = None  # Repetition time (in seconds) to check TTL triggers against; estimated from them if None
 
 # Trial times
 cue_time = 2.0  # How long the cue is displayed (in seconds)
 fix_after_cue_range = [2.0,2.5]  # Inter-stimulus interval
 min_target_dur = 0.1  # Sets the minimum presentation time for target (in seconds)
 inital_target_dur = 0.5  # Initial presentation of target (in seconds)
+max_target_dur = 1.0  # Sets the maximum presentation time for target (in seconds)
 isi_target_isi_time = 4  # Total time between end of cue, and right before feedback
 feedback_time = 2.0  # How long the trial + total reward feedback is displayed (in seconds)
+# Amount won on a hit of a reward cue, or lost on a miss of a loss cue
+trial_rewards = {'reward.high': 5.0, 'reward.low': 1.25, 'reward.neut': 0.0,
+                 'loss.high': -5.0, 'loss.low': -1.25, 'loss.neut': 0.0}
 fix_ITI = [2, 4, 6] * 16  # Inter-trial interval timings
 
+# Present stimuli by counting screen refreshes instead of polling timers, with
+# every duration converted to a whole number of frames at the start of the run
+frame_based_timing = True
+
 # Shuffle ITIs
 random.shuffle(fix_ITI)
 
 # How much to speed up/down target windows (not necessary for practice)
 single_speed_factor = 0.02  
 
+# Hit rate that drives the target window: taken over the last hit_rate_window
+# trials of each condition, or exponentially weighted with hit_rate_alpha
+# (e.g. 0.3) if that is set
+hit_rate_window = 8
+hit_rate_alpha = None
+
 total_earnings = 0
 
 
@@ -129,8 +152,146 @@ def start_datafiles(_thisDir, expName, expInfo, data_dir, sn, session, fmri):
     print('\n\n'+filename+'\n\n')
     return(filename)
 
-# Define function for displaying instructions
-def display_instructions_file(inst_file, instructions, run):
+# Instruction pages rendered to textures, keyed by (instructions file, run)
+instruction_pages = {}
+
+# Define function for drawing one page of the instructions to the back buffer
+def draw_instruction_page(text, image, run):
+    # Print the instructions on the screen
+    instructPrompt.setText(text)
+    instructPrompt.draw()
+    
+    # Present image if relevant
+    
+    # Create the task order page. This is "hard coded" instead of using
+    # an image so that there is consitent resolution on different screens
+    if image == 'task_order':
+            fix1_exmp = visual.TextStim(win, pos=[-0.65, 0.15], 
+                                        text='+', height=fontH*2, 
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz)
+            cuex_exmp = visual.ImageStim(win, pos=[-0.35,0.15], size=0.2,
+                                         image=stim_dir+"reward_high.png")
+            fix2_exmp = visual.TextStim(win, pos=[-0.15, 0.15], text='+', 
+                                        height=fontH*2, color=text_color, 
+                                        flipHoriz=flipHoriz)
+            targ_exmp = visual.Polygon(win, pos=[0.15,0.15], edges=3, 
+                                       radius=0.1, fillColor="white")
+            fix3_exmp = visual.TextStim(win, pos=[0.35, 0.15], text='+', 
+                                        height=fontH*2, 
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz)
+            fdbk_exmp = visual.TextStim(win, pos=[0.65, 0.15], 
+                                        text='Hit!\n+$5.00', 
+                                        height=fontH*2, 
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz)
+            
+            # Draw bottom row of page
+            fix1_desc = visual.TextStim(win, pos=[-0.65, -0.15], 
+                                        text='Pay attention', 
+                                        height=fontH, wrapWidth=0.15,
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz,
+                                        alignText='center')
+            cuex_desc = visual.TextStim(win, pos=[-0.35, -0.15], 
+                                        text="Cue: don't respond yet", 
+                                        height=fontH, wrapWidth=0.15,
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz, 
+                                        alignText='center')
+            fix2_desc = visual.TextStim(win, pos=[-0.15, -0.15], 
+                                        text='Pay attention', 
+                                        height=fontH, wrapWidth=0.15,
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz, 
+                                        alignText='center')
+            targ_desc = visual.TextStim(win, pos=[0.15, -0.15], 
+                                        text='Respond when solid triangle is on screen', 
+                                        height=fontH, wrapWidth=0.15,
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz, 
+                                        alignText='center')
+            fix3_desc = visual.TextStim(win, pos=[0.35, -0.15], 
+                                        text='Pay attention', 
+                                        height=fontH, wrapWidth=0.15,
+                                        color=text_color, 
+                                        flipHoriz=flipHoriz, 
+                                        alignText='center')
+            fdbk_desc = visual.TextStim(win, pos=[0.65, -0.15], 
+                                        text='Feedback', height=fontH, 
+                                        wrapWidth=0.15, color=text_color, 
+                                        flipHoriz=flipHoriz, 
+                                        alignText='center')
+            
+            fix1_exmp.draw()
+            cuex_exmp.draw()
+            fix2_exmp.draw()
+            targ_exmp.draw()
+            fix3_exmp.draw()
+            fdbk_exmp.draw()
+            fix1_desc.draw()
+            cuex_desc.draw()
+            fix2_desc.draw()
+            targ_desc.draw()
+            fix3_desc.draw()
+            fdbk_desc.draw()
+            
+    # Create the example cues instructions page
+    elif 'example' in image:
+        temp_cues = dict(cues)
+        if image.split('_')[-1] == 'cues':
+            temp_instr_images = list(temp_cues.keys())
+            # Define the layout of the stimuli
+            temp_positions = [[xScr/10*-2,yScr/30], [0,yScr/30], 
+                              [xScr/10*2,yScr/30], [xScr/10*-2,yScr/10*-2], 
+                              [0,yScr/10*-2], [xScr/10*2,yScr/10*-2]]
+            temp_size = -0.1
+        
+        else:
+            cue_type = image.split('_')[-1]
+            temp_instr_images = [x for x in list(temp_cues.keys()) if cue_type in x]
+            
+            if len(temp_instr_images) == 3:
+                temp_positions = [[xScr/10*-2,0], [0,0], [xScr/10*2,0]]
+                
+            elif len(temp_instr_images) == 2:
+                temp_positions = [[xScr/10*-1,0], [xScr/10*1,0]]
+            
+            temp_size = 0
+        
+        # Draw out stimuli
+        for n in range(len(temp_instr_images)):
+            temp_image = temp_cues[temp_instr_images[n]]
+            temp_image.pos = temp_positions[n]
+            temp_image.size += temp_size
+            
+            temp_image.draw()
+        
+    
+    elif image != 'none' and run == 0:
+        # Create the probe image
+        if image == 'probe.png':
+            inst_target = visual.Polygon(win, edges=3, radius=0.1, fillColor="white", 
+                                    pos=(0,yScr/10))
+            inst_target.draw()
+        # Display the imported image
+        else:
+            size = 0.4
+            position_y = -yScr/20
+            instr_image = visual.ImageStim(win, size=size, 
+                                       pos=(0, position_y),
+                                       image=inst_dir+image)
+            instr_image.draw()
+    
+    instructMove.draw()
+
+# Define function for rendering the instructions once, before they are shown,
+# so turning a page is a single blit of a BufferImageStim
+def compile_instructions(inst_file, instructions, run):
+    if (inst_file, run) in instruction_pages:
+        return instruction_pages[(inst_file, run)]
+    
     # Input a file to be read
     inname = _thisDir + os.sep + inst_dir + os.sep + inst_file
     infile = pd.read_csv(inname)
@@ -138,140 +299,35 @@ def display_instructions_file(inst_file, instructions, run):
     # Pull out the column that specifies the images for each page of the instructions
     instr_images = list(infile['images'])
     
+    # The example cue pages move and resize the cues; keep their task layout
+    cue_layout = {name: (list(cue.pos), cue.size.copy()) for name, cue in cues.items()}
+    
+    pages = []
+    for instructLine in range(len(instructions)):
+        win.clearBuffer()
+        draw_instruction_page(instructions[instructLine], 
+                              instr_images[instructLine], run)
+        pages.append(visual.BufferImageStim(win))
+    win.clearBuffer()
+    
+    for name, (pos, size) in cue_layout.items():
+        cues[name].pos = pos
+        cues[name].size = size
+    
+    instruction_pages[(inst_file, run)] = pages
+    return pages
+
+# Define function for displaying instructions
+def display_instructions_file(inst_file, instructions, run):
+    pages = compile_instructions(inst_file, instructions, run)
+    
     endOfInstructions = False
     instructLine = 0
     
     # Loop through instructions
     while not endOfInstructions:
         
-        # Print the instructions on the screen
-        instructPrompt.setText(instructions[instructLine])
-        instructPrompt.draw()
-        
-        # Present image if relevant
-        
-        # Create the task order page. This is "hard coded" instead of using
-        # an image so that there is consitent resolution on different screens
-        if instr_images[instructLine] == 'task_order':
-                fix1_exmp = visual.TextStim(win, pos=[-0.65, 0.15], 
-                                            text='+', height=fontH*2, 
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz)
-                cuex_exmp = visual.ImageStim(win, pos=[-0.35,0.15], size=0.2,
-                                             image=stim_dir+"reward_high.png")
-                fix2_exmp = visual.TextStim(win, pos=[-0.15, 0.15], text='+', 
-                                            height=fontH*2, color=text_color, 
-                                            flipHoriz=flipHoriz)
-                targ_exmp = visual.Polygon(win, pos=[0.15,0.15], edges=3, 
-                                           radius=0.1, fillColor="white")
-                fix3_exmp = visual.TextStim(win, pos=[0.35, 0.15], text='+', 
-                                            height=fontH*2, 
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz)
-                fdbk_exmp = visual.TextStim(win, pos=[0.65, 0.15], 
-                                            text='Hit!\n+$5.00', 
-                                            height=fontH*2, 
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz)
-                
-                # Draw bottom row of page
-                fix1_desc = visual.TextStim(win, pos=[-0.65, -0.15], 
-                                            text='Pay attention', 
-                                            height=fontH, wrapWidth=0.15,
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz,
-                                            alignText='center')
-                cuex_desc = visual.TextStim(win, pos=[-0.35, -0.15], 
-                                            text="Cue: don't respond yet", 
-                                            height=fontH, wrapWidth=0.15,
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz, 
-                                            alignText='center')
-                fix2_desc = visual.TextStim(win, pos=[-0.15, -0.15], 
-                                            text='Pay attention', 
-                                            height=fontH, wrapWidth=0.15,
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz, 
-                                            alignText='center')
-                targ_desc = visual.TextStim(win, pos=[0.15, -0.15], 
-                                            text='Respond when solid triangle is on screen', 
-                                            height=fontH, wrapWidth=0.15,
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz, 
-                                            alignText='center')
-                fix3_desc = visual.TextStim(win, pos=[0.35, -0.15], 
-                                            text='Pay attention', 
-                                            height=fontH, wrapWidth=0.15,
-                                            color=text_color, 
-                                            flipHoriz=flipHoriz, 
-                                            alignText='center')
-                fdbk_desc = visual.TextStim(win, pos=[0.65, -0.15], 
-                                            text='Feedback', height=fontH, 
-                                            wrapWidth=0.15, color=text_color, 
-                                            flipHoriz=flipHoriz, 
-                                            alignText='center')
-                
-                fix1_exmp.draw()
-                cuex_exmp.draw()
-                fix2_exmp.draw()
-                targ_exmp.draw()
-                fix3_exmp.draw()
-                fdbk_exmp.draw()
-                fix1_desc.draw()
-                cuex_desc.draw()
-                fix2_desc.draw()
-                targ_desc.draw()
-                fix3_desc.draw()
-                fdbk_desc.draw()
-                
-        # Create the example cues instructions page
-        elif 'example' in instr_images[instructLine]:
-            temp_cues = dict(cues)
-            if instr_images[instructLine].split('_')[-1] == 'cues':
-                temp_instr_images = list(temp_cues.keys())
-                # Define the layout of the stimuli
-                temp_positions = [[xScr/10*-2,yScr/30], [0,yScr/30], 
-                                  [xScr/10*2,yScr/30], [xScr/10*-2,yScr/10*-2], 
-                                  [0,yScr/10*-2], [xScr/10*2,yScr/10*-2]]
-                temp_size = -0.1
-            
-            else:
-                cue_type = instr_images[instructLine].split('_')[-1]
-                temp_instr_images = [x for x in list(temp_cues.keys()) if cue_type in x]
-                
-                if len(temp_instr_images) == 3:
-                    temp_positions = [[xScr/10*-2,0], [0,0], [xScr/10*2,0]]
-                    
-                elif len(temp_instr_images) == 2:
-                    temp_positions = [[xScr/10*-1,0], [xScr/10*1,0]]
-                
-                temp_size = 0
-            
-            # Draw out stimuli
-            for n in range(len(temp_instr_images)):
-                temp_image = temp_cues[temp_instr_images[n]]
-                temp_image.pos = temp_positions[n]
-                temp_image.size += temp_size
-                
-                temp_image.draw()
-            
-        
-        elif instr_images[instructLine] != 'none' and run == 0:
-            # Create the probe image
-            if instr_images[instructLine] == 'probe.png':
-                inst_target = visual.Polygon(win, edges=3, radius=0.1, fillColor="white", 
-                                        pos=(0,yScr/10))
-                inst_target.draw()
-            # Display the imported image
-            else:
-                size = 0.4
-                position_y = -yScr/20
-                instr_image = visual.ImageStim(win, size=size, 
-                                           pos=(0, position_y),
-                                           image=inst_dir+instr_images[instructLine])
-                instr_image.draw()
-        
-        instructMove.draw()
+        pages[instructLine].draw()
         win.flip()
         
         # Navigate through the instruction pages
@@ -303,6 +359,13 @@ expInfo = {
 dlg = gui.DlgFromDict(dictionary=expInfo, title=expName)
 if dlg.OK == False:
     core.quit()  # User pressed cancel
+startup.mark('dialog')
+
+preloading.join()
+from psychopy import visual, data, event, monitors
+import pandas as pd
+startup.mark('modules')
+
 expInfo['date'] = data.getDateStr()  # Add a simple timestamp
 expInfo['expName'] = expName
 sn = int(expInfo['participant'])
@@ -332,14 +395,13 @@ run = 0
 filename = start_datafiles(_thisDir, expName, expInfo, data_dir, sn, session, 
                            fmri)
 
-# An ExperimentHandler isn't essential but helps with data saving
-exp = data.ExperimentHandler(name=expName, version=version, 
-                             extraInfo=expInfo, runtimeInfo=None,
-                             originPath=None, savePickle=True, 
-                             saveWideText=True, dataFileName=filename)
+# Trial data is appended to a journal as each trial completes, so a crash
+# loses at most one trial; the CSV is rebuilt from it at the end of each run
+exp = mid_io.TrialWriter(filename, extraInfo=expInfo)
 
-# Save a log file for detail verbose info
-logFile = logging.LogFile(filename+'.log', level=logging.EXP)
+# Save a log file for detail verbose info; it is written from a background
+# thread, so logging.flush() does no disk I/O in the presentation loop
+logFile = mid_io.QueuedLogFile(filename+'.log', level=logging.EXP)
 logging.console.setLevel(logging.WARNING)  # This outputs to the screen, not a file
 
 # Setup the window and presentation constants
@@ -349,12 +411,23 @@ xScr = float(win_res[0])/win_res[1]
 fontH = yScr/25
 wrapW = xScr/1.5
 text_color = 'white'
-# Store frame rate of monitor if we can measure it
-expInfo['frameRate'] = win.getActualFrameRate()
-if expInfo['frameRate'] != None and expInfo['frameRate'] < 300:
-    frame_duration = 1.0 / round(expInfo['frameRate'])
-else:
-    frame_duration = 1.0 / 60.0  # Could not measure, so guess
+startup.mark('window')
+
+# Frame rate of the monitor: from this machine's calibration profile if a
+# short run of flips agrees with it, otherwise measured (and saved)
+calibration_file = mid_startup.profile_name(_thisDir + os.sep + data_dir + 'calibration', 
+                                            win.screen, win_res)
+[expInfo['frameRate'], frame_duration, 
+ expInfo['frameRateSource']] = mid_startup.calibrate(win, calibration_file, win.screen)
+startup.mark('frame_rate')
+
+# Intervals between flips, recorded for the whole run and split by routine
+frame_intervals = mid_timing.FrameIntervalTracker(win, frame_duration)
+
+# The adaptive target window lives in whole frames of the measured refresh rate
+speed_factor_frames = max(mid_timing.to_frames(single_speed_factor, frame_duration), 1)
+min_target_frames = mid_timing.to_frames(min_target_dur, frame_duration)
+max_target_frames = mid_timing.to_frames(max_target_dur, frame_duration)
 
 # Set random seed - participant and session dependent
 random.seed(sn * (session + 1100))
@@ -372,7 +445,6 @@ instructMove = visual.TextStim(win, text=instructMoveText, height=fontH,
 # Create fixation stimulus
 fix = visual.TextStim(win, pos=[0, 0], text='+', height=fontH*2, 
                       color=text_color, flipHoriz=flipHoriz)
-clock = core.Clock()
 
 
 # Pre-instructions
@@ -414,23 +486,56 @@ cues = {
                                     image=stim_dir+"loss_low_125.png"),
     'loss.high':   visual.ImageStim(win, size=0.3, pos=[0,0],
                                     image=stim_dir+"loss_high.png")}
-CueClock = core.Clock()
 
 
 # Initialize components for Routine "Target"
-TargetClock = core.Clock()
 Target = visual.Polygon(win, edges=3, radius=0.2, fillColor="white", 
 pos=(0,0))
 
 
 # Initialize components for Routine "Feedback"
-FeedbackClock = core.Clock()
-trial_feedback = visual.TextStim(win=win, name='trial_feedback',
-                                 text='Trial:', font='Arial', 
-                                 pos=(0, 0), height=fontH+yScr/20, 
-                                 wrapWidth=None, ori=0, color='White', 
-                                 colorSpace='rgb', opacity=1, 
-                                 flipHoriz=flipHoriz);
+# Feedback text for the reward of a trial
+def trial_cash_string(r, trial_response):
+    if r > 0:
+        return f"Hit!\n+${r:.2f}"
+    elif r < 0:
+        return f"Miss!\n-${abs(r):.2f}"
+    elif trial_response == 1:
+        return f"Hit!\n${r:.2f}"
+    else:
+        return f"Miss!\n${r:.2f}"
+
+def total_cash_string(r):
+    if r < 0:
+        return f"Miss!\n${r:.2f}"
+    else:
+        return f"${r:.2f}"
+
+def make_trial_feedback(text):
+    return visual.TextStim(win=win, name='trial_feedback',
+                           text=text, font='Arial', 
+                           pos=(0, 0), height=fontH+yScr/20, 
+                           wrapWidth=None, ori=0, color='White', 
+                           colorSpace='rgb', opacity=1, 
+                           flipHoriz=flipHoriz)
+
+# Build the trial feedback for every text a trial can end with, drawn once to
+# the back buffer, so feedback onset only swaps in a ready stimulus
+def make_feedback_stims():
+    stims = {}
+    for trial_type, amount in trial_rewards.items():
+        for r in (amount, 0.0):
+            for trial_response in (0, 1):
+                text = trial_cash_string(r, trial_response)
+                if text not in stims:
+                    stims[text] = make_trial_feedback(text)
+                    stims[text].draw()
+    win.clearBuffer()
+    return stims
+
+trial_feedback = make_trial_feedback('Trial:')
+feedback_stims = make_feedback_stims()
+
 exp_feedback = visual.TextStim(win=win, name='exp_feedback',
                                text='Total:', font='Arial', 
                                pos=(0, -yScr/16), height=fontH+yScr/20, 
@@ -453,7 +558,11 @@ waitPrompt = visual.TextStim(win, text="Please wait\n\n",
 globalClock = core.Clock()  # To track the time since experiment started
 runClock = core.Clock()  # To track the time since experiment started
 trialClock = core.Clock()  # To track the time since trial started
-routineTimer = core.CountdownTimer()  # To track time remaining of each (non-slip) routine
+
+# Key presses are timestamped as they happen and collected in a background
+# thread, then queried by time window on the run clock, so RTs are measured
+# against the flip-locked stimulus onsets whatever the draw loop is doing
+responses = mid_io.ResponseBox(runClock, ttl_keys=[ttlKey], tr=scanner_TR)
 
 # Create the staircase handlers to adjust for individual threshold
 # (stairs defined in units of screen frames; actual minimum presentation
@@ -489,45 +598,258 @@ staircase_end = {}
 
 # Useful functions
 
-def get_keypress():
-    keys = event.getKeys()
+def check_responses(t_start):
+    """
+    Checks the key presses since t_start (run clock) for escape and returns
+    the time of the first response key, or None
+    """
+    t_response = None
+    for key, t_key in responses.get_keys(keyList=forwardKeys + escapeKeys, 
+                                         t_start=t_start):
+        if key.lower() in escapeKeys:
+            logging.warning("Escape pressed, exiting early!")
+            shutdown()
+        if t_response is None:
+            t_response = t_key
+    return t_response
+
+def get_target_response(onset, offset=None):
+    """Time of the first response key pressed between onset and offset, or None"""
+    keys = responses.get_keys(keyList=forwardKeys, t_start=onset, t_end=offset)
     if keys:
-        return keys[0]
-    else:
-        return None
+        return keys[0][1]
+    return None
 
 def shutdown():
     print("Logging staircase end values and exiting...")
-    stairs = ['loss.high', 'loss.low', 'loss.neut', 
-              'reward.high', 'reward.low', 'reward.neut']
     logging.warning(f"Total earnings: {total_earnings}")
+    responses.close()
+    exp.close()
     logging.flush()
+    logFile.close()
     win.close()
     core.quit()
 
-def show_stim(stim, duration, pos=[0,0]):
-    duration = float(duration)
-    t_start = globalClock.getTime()
-    routineTimer.reset()
-    routineTimer.addTime(duration)
-    event.clearEvents(eventType='keyboard')
-    rt = None
-    while routineTimer.getTime() > 0:
-        key = get_keypress()
-        if key and key.lower() in escapeKeys:
-            logging.warning("Escape pressed, exiting early!")
-            shutdown()
-        if not rt and key in forwardKeys:
-            rt = duration - routineTimer.getTime()
-        if stim:
-            stim.pos = pos
-            stim.draw()
-        win.flip()
-    return rt
-    print('TESTING...'+str(rt)+'\n')
+def show_stim(stim, duration):
+    """Presents a stimulus (a blank screen if None) for duration seconds"""
+    return routines.show(stim, end_time=runClock.getTime() + float(duration))[0]
 
 def show_fixation(duration):
-    return show_stim(fix, duration, pos=[0,0])
+    return show_stim(fix, duration)
+
+def log_dropped_frames(event_name, trial, dropped, longest, save=True):
+    """
+    Saves the dropped frames and longest frame interval of an event with the
+    trial. The trial is saved on the first frame of its ITI, so the frames of
+    the ITI are saved with the next trial (prev_ITI), and those of the last
+    ITI of a run are only logged.
+    """
+    if save:
+        column = 'prev_ITI' if event_name == 'Fix_ITI' else event_name
+        exp.addData(column+'.DroppedFrames', dropped)
+        exp.addData(column+'.MaxInterval', round(longest, 4))
+        if event_name == 'Tgt':
+            exp.addData('Tgt.FrameDropped', int(dropped > 0))
+    if dropped and event_name == 'Tgt':
+        logging.warning(f"Dropped frame during the target window: {dropped} frame(s) "
+                        f"in trial {trial}, longest interval {longest * 1000:.1f} ms")
+    elif dropped:
+        logging.warning(f"Dropped frames: {dropped} in {event_name} of trial {trial}, "
+                        f"longest interval {longest * 1000:.1f} ms")
+
+def log_onset(event_name, planned):
+    """
+    Logs the measured and planned onset of an event, along with the drift
+    between them (cumulative since the start of the run).
+    """
+    onset = runClock.getTime()
+    closed = frame_intervals.next_event(event_name, trial_number)
+    if closed is not None:
+        log_dropped_frames(*closed)
+    drift = drift_tracker.record(trial_number, event_name, planned, onset)
+    exp.addData(event_name+'.OnsetTime', onset)
+    exp.addData(event_name+'.PlannedOnset', planned)
+    exp.addData(event_name+'.Drift', drift)
+    if triggerOnTTL:
+        # Scanner volumes acquired so far in the run
+        exp.addData(event_name+'.Volume', responses.volume_at(onset))
+    return onset
+
+def log_flip_onset(event_name, onset):
+    """
+    Logs the time of the flip that first showed an event (flip-locked, on the
+    run clock), alongside the onset logged before it was drawn.
+    """
+    exp.addData(event_name+'.FlipOnsetTime', onset)
+
+def show_stim_until(stim, end_time):
+    """
+    Presents a stimulus until the run clock reaches end_time (in seconds from
+    run start), so any overrun from the previous routine is absorbed here.
+    """
+    return routines.show(stim, end_time=end_time)[0]
+
+def show_fixation_until(end_time):
+    return show_stim_until(fix, end_time)
+
+
+# The routines of a trial, presented by the routine engine as a sequence of
+# phases. Each phase logs the onset of its event; the functions below add the
+# data of the trial as the phases start and end.
+
+def cue_of(trial):
+    return cues[trial.type]
+
+def end_cue(trial, result):
+    exp.addData('Cue.Frames', result.frames)
+    if result.rt:
+        exp.addData('trial.cue_rt', result.rt)
+
+def end_delay(trial, result):
+    # If RT was too fast
+    if result.rt:
+        logging.exp(f"too fast rt: {result.rt}")
+        trial.response = 2
+        exp.addData('trial.too_fast_rt', result.rt)
+
+def start_target(trial):
+    trial.cond_slot = cond_state.index[trial.type]
+    trial.target_frames = cond_state.frames[trial.cond_slot]
+    trial.plan['Fix_after_target'] = (trial.plan['Tgt'] + 
+                                      trial.target_frames * frame_duration)
+
+def target_frames_of(trial):
+    return trial.target_frames
+
+def end_target(trial, result):
+    global total_earnings
+    # Record the duration the target was actually on screen
+    target_dur_shown = result.frames * frame_duration
+    if result.rt is not None:
+        trial.rt = result.rt
+        if trial.response == 0:
+            trial.response = 1
+    exp.addData('Tgt.Frames', result.frames)
+    
+    # Add the data to the current staircase so it can be used to calculate the next level
+    stairs[trial.type].addResponse(trial.response)
+
+    # Check responses to add RT
+    if trial.response == 1:
+        exp.addData('trial.rt', trial.rt)
+        exp.addData('trial.target_dur', round(target_dur_shown, 4))
+        logging.exp(f"response: {trial.rt}")
+    elif trial.response == 2 and trial.rt:
+        exp.addData('trial.rt', trial.rt)
+        exp.addData('trial.target_dur', round(target_dur_shown, 4))
+        logging.exp(f"response: {trial.rt}")
+    else:
+        exp.addData('trial.target_dur', round(target_dur_shown, 4))
+        logging.exp("response: none during stim")
+    logging.flush()
+    
+    # Calculate trial condition hit rate
+    hit_rate = cond_state.record(trial.cond_slot, trial.response == 1)        
+    
+    # Step by the whole number of frames closest to single_speed_factor
+    if hit_rate >= 0.66:
+        cond_state.step(trial.cond_slot, -1)  # Subtract ~20ms
+    else:
+        cond_state.step(trial.cond_slot, 1)  # Add ~20ms
+    
+    logging.exp(f"{trial.type} duration is: {cond_state.duration(trial.cond_slot)}")
+
+    reward = 0
+
+    # Update trial components
+    if trial.type == 'reward.high' and trial.response == 1:
+        reward = trial_rewards[trial.type]
+    elif trial.type == 'reward.low' and trial.response == 1:
+        reward = trial_rewards[trial.type]
+    elif trial.type == 'reward.neut' and trial.response == 1:
+        reward = trial_rewards[trial.type]
+    elif trial.type == 'loss.high' and not trial.response == 1:
+        reward = trial_rewards[trial.type]
+    elif trial.type == 'loss.low' and not trial.response == 1:
+        reward = trial_rewards[trial.type]
+    elif trial.type == 'loss.neut' and not trial.response ==1:
+        reward = trial_rewards[trial.type]
+
+    exp.addData('trial.reward', reward)
+    trial.reward = reward
+    total_earnings += reward
+    if DEBUG:
+        logging.exp(f"{trial.type} result: {trial.response}, reward is {reward} "
+                    f"for total {total_earnings}")
+
+def end_fix_after_target(trial, result):
+    if result.rt:
+        logging.exp(f"too slow rt: {result.rt}")
+        trial.response = 3
+        exp.addData('trial.too_slow_rt', result.rt)
+
+def start_feedback(trial):
+    feedback_text = trial_cash_string(trial.reward, trial.response)
+    if feedback_text not in feedback_stims:
+        feedback_stims[feedback_text] = make_trial_feedback(feedback_text)
+    trial.feedback = feedback_stims[feedback_text]
+    
+    exp.addData("Tgt.ACC", trial.response)
+    exp.addData('Tgt.ACCfeedback', feedback_text)
+    exp.addData('total_earnings', total_earnings)
+
+def feedback_of(trial):
+    return trial.feedback
+
+def end_feedback(trial, result):
+    exp.addData('Fb.Frames', result.frames)
+
+def start_iti(trial):
+    # Report scanner triggers that went missing or came in extra
+    for volume, flag, n in responses.volumes.pop_flags():
+        logging.warning(f"TTL: {n} {flag} trigger(s) at volume {volume}")
+    
+    # Completed trial, add some data to log file
+    exp.addData('Fix_ITI.Duration', fix_ITI[trial.index])
+    # Trial and global times are taken at the planned end of the ITI
+    iti_left = trial.plan['end'] - runClock.getTime()
+    exp.addData('time.trial', trialClock.getTime() + iti_left)
+    exp.addData('time.global', globalClock.getTime() + iti_left)
+    exp.addData('Winnings', total_earnings)
+
+def save_trial(trial, t_first):
+    # Advance to next trial/line in logFile, once the flip-locked onset of
+    # the ITI is in
+    exp.nextEntry()
+    
+    # Write the trial and the log to disk during the ITI, which absorbs
+    # the time it takes so the next trial still starts at its planned time
+    exp.commit()
+    logging.flush()
+    logFile.drain()
+
+cue_frames = mid_timing.to_frames(cue_time, frame_duration)
+feedback_frames = mid_timing.to_frames(feedback_time, frame_duration)
+
+# The phases of a trial: the cue, the fixation after it, the target, the
+# fixation after the target (which absorbs the variable target window), the
+# feedback and the ITI
+trial_phases = [
+    mid_routines.Phase('Cue', cue_of, until='Dly', frames=cue_frames, end=end_cue),
+    mid_routines.Phase('Dly', fix, until='Tgt', end=end_delay),
+    mid_routines.Phase('Tgt', Target, frames=target_frames_of, keys=mid_routines.TARGET, 
+                       start=start_target, end=end_target),
+    mid_routines.Phase('Fix_after_target', fix, until='Fb', end=end_fix_after_target),
+    mid_routines.Phase('Fb', feedback_of, until='Fix_ITI', frames=feedback_frames, 
+                       keys=mid_routines.NO_KEYS, start=start_feedback, end=end_feedback),
+    mid_routines.Phase('Fix_ITI', fix, until='end', start=start_iti, first=save_trial),
+    ]
+
+# The one frame loop of every routine
+routines = mid_routines.RoutineEngine(win, runClock, frame_duration, check_responses, 
+                                      get_target_response, log_onset=log_onset, 
+                                      log_flip_onset=log_flip_onset, collect=responses.collect, 
+                                      frame_based=frame_based_timing)
 
 
 
@@ -547,6 +869,11 @@ def speed_up(duration):
     return float(duration) * single_speed_factor
 
 
+# Startup is over: report how long each phase took
+startup.mark('stimuli')
+print("startup: " + startup.summary())
+logging.exp("Startup: " + startup.summary())
+
 # Loop the rest of this for num_runs
 while run < num_runs:
     
@@ -582,8 +909,6 @@ while run < num_runs:
     print("instructions complete, continuing")
     logging.flush()
     
-    # Reset the non-slip timer for next routine
-    routineTimer.reset()
     event.clearEvents(eventType='keyboard')
     
     
@@ -607,10 +932,21 @@ while run < num_runs:
     
     # Randomize stimuli order
     random.shuffle(stim_list)
-
-    # Create a dataframe for the event file
-    order = pd.DataFrame(np.transpose([list(np.arange(1,len(stim_list)+1)), stim_list]),
-                         columns=['trial.num','trial.type'])
+    
+    # Fixation after cue is a random number between two numbers (e.g. 2-2.5s)
+    fix_after_cue_list = [random.uniform(fix_after_cue_range[0], 
+                                         fix_after_cue_range[1]) 
+                          for trial in range(num_trials)]
+
+    # Plan the onset of every event in the run before it starts, so the run
+    # can be presented against the run clock without drifting
+    schedule = mid_timing.build_run_schedule(stim_list[:num_trials], fix_ITI, 
+                                             fix_after_cue_list, cue_time, 
+                                             isi_target_isi_time, feedback_time, 
+                                             initial_fix_duration)
+    if frame_based_timing:
+        schedule = mid_timing.quantize_schedule(schedule, frame_duration)
+    drift_tracker = mid_timing.DriftTracker(frame_duration)
     
     # Could delete, but keeping to be similar to the scanner task
     if fmri:
@@ -620,19 +956,23 @@ while run < num_runs:
         win.flip()
         event.waitKeys(keyList=fMRI_trigger)
 
+    # Record every scanner trigger (volume) of the run from here on
+    responses.volumes.start()
+    
     # Wait for TR signal if in scanner
     if triggerOnTTL:
         print(f"waiting for TTL key {ttlKey} on TR")
         logging.flush()
         wait.draw()
         win.flip()
-        event.waitKeys(keyList=ttlKey)
+        responses.wait_for_volume()
     
     
     print(f"starting run {run} of {num_runs-1}")
     logging.flush()
 
     runClock.reset()
+    frame_intervals.start()
     if run == 0:
         globalClock.reset()  # To align actual time with virtual time keeper
     
@@ -641,18 +981,20 @@ while run < num_runs:
         print(f"actual start {globalClock.getTime()}")
     
     
-    # Track hit accuracy
+    # Track target windows (in whole frames) and hit accuracy per condition
+    cond_state = mid_state.ConditionState(stairs.keys(), frame_duration, 
+                                          min_target_frames, max_target_frames, 
+                                          speed_factor_frames, 
+                                          window=hit_rate_window, 
+                                          alpha=hit_rate_alpha)
     if run == 0:
-        target_durs = pd.DataFrame(columns=stairs.keys())
-        target_durs.loc[0] = inital_target_dur
-    
-    hit_tracker = pd.DataFrame(columns=stairs.keys())
+        cond_state.set_all(inital_target_dur)
     
     
     # Present initial fixation
     if run == 0:
         print('initial fix duration: '+str(initial_fix_duration))
-    show_fixation(initial_fix_duration)
+    show_fixation_until(initial_fix_duration)
     
     # Loop through the trials
     for trial in range(0, num_trials):
@@ -661,13 +1003,9 @@ while run < num_runs:
         
         # Total trial number along all runs
         trial_number += 1
-        trial_details = order.iloc[trial]
-        trial_type = trial_details['trial.type']
-        trial_response = 0
+        trial_type = stim_list[trial]
         
-        trial_stairs = stairs[trial_type]
-
-        trial_duration_frames = trial_stairs.next()
+        trial_duration_frames = stairs[trial_type].next()
         staircase_end[trial_type] = trial_duration_frames
         
         # Add data to the experiment handler
@@ -681,282 +1019,55 @@ while run < num_runs:
         exp.addData('trial.number', trial_number)
         exp.addData('trial.type', trial_type)
         
-        
-        def log_detail(x):
-            print(f"{x}: {trial_details[x]}")
-        
-        # ------Prepare to start Routine "Cue"-------
-        cue = cues[trial_type]
-        
-        # Log cue onset time
-        exp.addData('Cue.OnsetTime', runClock.getTime())
-        cue_rt = show_stim(cue, cue_time, [0,0])  # Is this needed?
-        if cue_rt:
-            exp.addData('trial.cue_rt', cue_rt)
-        
-        # Fixation after cue is a random number between two numbers (e.g. 2-2.5s)
-        fix_after_cue = random.uniform(fix_after_cue_range[0], 
-                                       fix_after_cue_range[1])
-        
-        # If RT was too fast
-        too_fast_rt = show_fixation(fix_after_cue)
-        if too_fast_rt:
-            print('too fast rt: ', too_fast_rt)
-            trial_response = 2
-            exp.addData('trial.too_fast_rt', too_fast_rt)
-        
-        # Log fixation after cue onset
-        exp.addData('Dly.OnsetTime', runClock.getTime())
-        
-        
-        # ------Prepare to start Routine "Target"-------
-        t = 0
-        TargetClock.reset()  # clock
-
-        # Reset the non-slip timer for next routine
-        routineTimer.reset()
-        continueRoutine = True
-        
-        routineTimer.addTime(target_durs.loc[0,trial_type])
-        
-        # Update component parameters for each repeat
-        target_response = event.BuilderKeyResponse()
-        rt = None
-        
-        # Keep track of which components have finished
-        TargetComponents = [Target, target_response]
-        for thisComponent in TargetComponents:
-            if hasattr(thisComponent, 'status'):
-                thisComponent.status = NOT_STARTED
-        
-        
-        # -------Start Routine "Target"-------
-        # Log target onset time
-        exp.addData('Tgt.OnsetTime', runClock.getTime())
-        
-        while continueRoutine and routineTimer.getTime() > 0:
-            # Get current time
-            t = TargetClock.getTime()
-
-            # Selection screen updates
-            if t >= 0.0 and Target.status == NOT_STARTED:
-                # Keep track of start time/frame for later
-                Target.tStart = t
-                # Display target
-                Target.setAutoDraw(True)
-                # Open response options
-                target_response.tStart = t
-                target_response.status = STARTED
-                # Keyboard checking is just starting
-                win.callOnFlip(target_response.clock.reset)  # t=0 on next screen flip
-                event.clearEvents(eventType='keyboard')
-                theseKeys = []
-            
-            if Target.status == STARTED and t <= target_durs.loc[0,trial_type]:
-                Target.setAutoDraw(True)
-                theseKeys = event.getKeys(keyList=forwardKeys)
-                
-                if len(theseKeys) > 0:  
-                    rt = target_response.clock.getTime()
-                    target_response.rt = rt
-                    if trial_response == 0:
-                        trial_response = 1
-            
-            # Check if all components have finished
-            if not continueRoutine:
-                break
-            continueRoutine = False
-            for thisComponent in TargetComponents:
-                if hasattr(thisComponent, "status") and thisComponent.status != FINISHED:
-                    continueRoutine = True
-                    break  # At least one component has not yet finished
-
-            # Draw fixation if we're done, so we don't leave a blank screen for any frames
-            if not continueRoutine:
-                fix.draw()
-            win.flip()
-            
-            
-        # -------Ending Routine "Target"-------
-        for thisComponent in TargetComponents:
-            if hasattr(thisComponent, "setAutoDraw"):
-                thisComponent.setAutoDraw(False)
-        
-        # Add the data to the current staircase so it can be used to calculate the next level
-        trial_stairs.addResponse(trial_response)
-
-        # Check responses to add RT
-        trial_type_count = hit_tracker[trial_type].count()
-        if trial_response == 1:
-            exp.addData('trial.rt', target_response.rt)
-            exp.addData('trial.target_dur', target_response.rt)
-            print(f"response: {target_response.rt}")
-            hit_tracker.loc[trial_type_count,trial_type] = 1
-        elif trial_response == 2 and rt:
-            exp.addData('trial.rt', target_response.rt)
-            exp.addData('trial.target_dur', target_response.rt)
-            print(f"response: {target_response.rt}")
-            hit_tracker.loc[trial_type_count,trial_type] = 0
-        else:
-            exp.addData('trial.target_dur', target_durs.loc[0,trial_type])
-            print(f"response: none during stim")
-            hit_tracker.loc[trial_type_count,trial_type] = 0
-        logging.flush()
-        
-        # Calculate trial condition hit rate
-        hit_rate = hit_tracker[trial_type].sum() / hit_tracker[trial_type].count()        
-        
-        if hit_rate >= 0.66:
-            target_durs.loc[0,trial_type] -= single_speed_factor  # Subtract 20ms
-        else:
-            target_durs.loc[0,trial_type] += single_speed_factor  # Add 20ms
-        
-        print(trial_type + ' duration is: '+str(target_durs.loc[0,trial_type]))
-        if target_durs.loc[0,trial_type] < min_target_dur:
-            target_durs.loc[0,trial_type] = min_target_dur
-        routineTimer.addTime(target_durs.loc[0,trial_type])
-
-        reward = 0
-
-        # Update trial components
-        if trial_type == 'reward.high' and trial_response == 1:
-            reward = 5.0
-        elif trial_type == 'reward.low' and trial_response == 1:
-            reward = 1.25
-        elif trial_type == 'reward.neut' and trial_response == 1:
-            reward = 0.0
-        elif trial_type == 'loss.high' and not trial_response == 1:
-            reward = -5.0
-        elif trial_type == 'loss.low' and not trial_response == 1:
-            reward = -1.25
-        elif trial_type == 'loss.neut' and not trial_response ==1:
-            reward = 0.0
-
-        exp.addData('trial.reward', reward)
-        total_earnings += reward
-        if DEBUG:
-            print(f"{trial_type} result: {trial_response}, reward is {reward} for total {total_earnings}" )
-
-        # Fixation after stim target
-        exp.addData('Fix_after_target.OnsetTime', runClock.getTime())
-        
-        # Set the fixation after target by accounting for the variable target
-        # time window
-        if rt:
-            fix_after_target = isi_target_isi_time - fix_after_cue - rt
-        else:
-            fix_after_target = isi_target_isi_time - fix_after_cue - target_durs.loc[0,trial_type]
-        
-        too_slow_rt = show_fixation(fix_after_target)
-        if too_slow_rt:
-            print('too slow rt: ', too_slow_rt)
-            trial_response = 3
-            exp.addData('trial.too_slow_rt', too_slow_rt)
-        
-        
-        # ------Prepare to start Routine "Feedback"-------
-        t = 0
-        FeedbackClock.reset()  # clock
-        # Reset the non-slip timer for next routine
-        routineTimer.reset()
-        continueRoutine = True
-        routineTimer.addTime(feedback_time)
-
-        def trial_cash_string(r, trial_response):
-            if r > 0:
-                return f"Hit!\n+${r:.2f}"
-            elif r < 0:
-                return f"Miss!\n-${abs(r):.2f}"
-            elif trial_response == 1:
-                return f"Hit!\n${r:.2f}"
-            else:
-                return f"Miss!\n${r:.2f}"
-
-        def total_cash_string(r):
-            if r < 0:
-                return f"Miss!\n${r:.2f}"
-            else:
-                return f"${r:.2f}"
-
-        trial_feedback.setText(trial_cash_string(reward, trial_response))
-        
-        exp.addData("Tgt.ACC", trial_response)
-        exp.addData('Tgt.ACCfeedback', trial_cash_string(reward, trial_response))
-        exp.addData('total_earnings', total_earnings)
-
-        # Keep track of which components have finished
-        FeedbackComponents = [trial_feedback, exp_feedback]
-        for thisComponent in FeedbackComponents:
-            if hasattr(thisComponent, 'status'):
-                thisComponent.status = NOT_STARTED
-        
-        
-        # Start routine feedback 
-        # Log feedback onset time
-        exp.addData('Fb.OnsetTime', runClock.getTime())
-        
-        while continueRoutine and routineTimer.getTime() > 0:
-            # Get current time
-            t = FeedbackClock.getTime()
-
-            # Feedback screen updates
-            if t >= 0.0 and trial_feedback.status == NOT_STARTED:
-                # Keep track of start time/frame for later
-                trial_feedback.tStart = t
-                trial_feedback.setAutoDraw(True)
-            frameRemains = 0.0 + feedback_time - win.monitorFramePeriod * 0.75  # most of one frame period left
-            if trial_feedback.status == STARTED and t >= frameRemains:
-                trial_feedback.setAutoDraw(False)
-
-            # Check if all components have finished
-            if not continueRoutine:
-                break
-            continueRoutine = False
-            for thisComponent in FeedbackComponents:
-                if hasattr(thisComponent, "status") and thisComponent.status != FINISHED:
-                    continueRoutine = True
-                    break  # At least one component has not yet finished
-
-            # Refresh the screen
-            if continueRoutine:  # Don't flip if this routine is over or we'll get a blank screen
-                win.flip()
-        
-        # End routine feedback
-        for thisComponent in FeedbackComponents:
-            if hasattr(thisComponent, "setAutoDraw"):
-                thisComponent.setAutoDraw(False)
-
-        # Fixation after stim target
-        # We want this to be altered so that the length
-        # of the trial is adjusted by the stim difference from 0.5s...
-        
-        trial_time = trialClock.getTime()
-                
-        # Log inter trial interval fixation time
-        exp.addData('Fix_ITI.OnsetTime', runClock.getTime())
-        
-        show_fixation(fix_ITI[trial])
-
-        # Completed trial, add some data to log file
-        exp.addData('Fix_ITI.Duration', fix_ITI[trial])
-        exp.addData('time.trial', trialClock.getTime())
-        exp.addData('time.global', globalClock.getTime())
-        exp.addData('Winnings', total_earnings)
-        
-        # Advance to next trial/line in logFile
-        exp.nextEntry()
+        # Present the routines of the trial
+        routines.run_trial(trial_phases, 
+                           mid_routines.Trial(trial_number, trial, trial_type, schedule[trial]))
     
+    # The last ITI was presented after its trial was saved
+    closed = frame_intervals.stop()
+    if closed is not None:
+        log_dropped_frames(*closed, save=False)
+    print(f"dropped frames: {frame_intervals.report()['dropped']}")
     
     # Start task end routine
     if run == 0:
         # Set target durations for the average across all conditions
-        target_durs.loc[0] = target_durs.loc[0].mean()
+        cond_state.average()
+        cond_state.reset_history()
     
     # Export target durations
     if run == 0:
-        target_durs.to_csv(filename+'_target_durs-practice.csv', index=False)
+        cond_state.to_csv(filename+'_target_durs-practice.csv')
+    else:
+        cond_state.to_csv(filename+'_target_durs-run'+str(run)+'.csv')
+    
+    # Rebuild the full task CSV from the trial journal
+    exp.export()
+    
+    # Export the planned vs actual timing report for the run
+    if run == 0:
+        timing = drift_tracker.write_report(filename+'_timing-practice.json', 
+                                            extra={'logging': logFile.metrics(), 
+                                                   'startup': startup.report(), 
+                                                   'frames': frame_intervals.report()})
     else:
-        target_durs.to_csv(filename+'_target_durs-run'+str(run)+'.csv', index=False)
+        timing = drift_tracker.write_report(filename+'_timing-run'+str(run)+'.json', 
+                                            extra={'logging': logFile.metrics(), 
+                                                   'startup': startup.report(), 
+                                                   'frames': frame_intervals.report()})
+    
+    # Export the table of scanner volumes acquired during the run
+    if responses.volumes.count:
+        if run == 0:
+            responses.write_volumes(filename+'_volumes-practice.csv')
+        else:
+            responses.write_volumes(filename+'_volumes-run'+str(run)+'.csv')
+        if DEBUG:
+            print(f"volumes: {responses.volumes.count}, missed: {responses.volumes.n_missed}, "+
+                  f"extra: {responses.volumes.n_extra}")
+    if DEBUG and timing['n_events']:
+        print(f"max drift: {timing['max_drift']:.4f}, mean drift: {timing['mean_drift']:.4f}, "+
+              f"worst: trial {timing['worst']['trial']} {timing['worst']['event']}")
     
     
     if run == 0:
@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+mid_profile.py
+
+Opt-in per-frame profiler for the MID task scripts (mid_BD2.py).
+
+The presentation loops time each phase of every frame (checking the keys,
+drawing, flipping, adding data, flushing the log, ...) with lap():
+
+    t = profiler.start()
+    rt = check_responses(...)
+    t = profiler.lap(KEYS, t)
+    stim.draw()
+    t = profiler.lap(DRAW, t)
+    win.flip()
+    profiler.lap(FLIP, t)
+
+Each lap stores the phase and its start and end (time.perf_counter_ns) in
+arrays allocated once for the whole run, so profiling a frame allocates
+nothing but the timestamps. The routine (event) and trial being presented are
+set by mark(), once per event.
+
+At the end of a run, write_trace() saves the laps as a Chrome trace (JSON
+trace event format; open it in chrome://tracing or https://ui.perfetto.dev):
+one track with the phases of every frame, one with the routines, and an
+instant "overrun" event on every frame that took longer than the frame
+budget (1.5 frame periods), naming the phase that took longest in it.
+summary() gives the p50/p99/max of each phase and the overruns per culprit
+phase for the timing report.
+
+When profiling is off the scripts use a NullProfiler, whose methods do
+nothing.
+"""
+
+import json
+import time
+from array import array
+
+# Phases of a frame
+KEYS, DRAW, FLIP, ADD_DATA, LOG_FLUSH, COMMIT, OTHER = range(7)
+PHASES = ['keys', 'draw', 'flip', 'addData', 'logging.flush', 'commit', 'other']
+
+
+class FrameProfiler:
+    """Phase timings of every frame of a run, in preallocated arrays"""
+
+    def __init__(self, frame_duration, capacity=500000, budget=1.5):
+        self.frame_duration = frame_duration
+        self.budget_ns = int(frame_duration * budget * 1e9)
+        self.capacity = capacity
+        self.phase = array('b', bytes(capacity))
+        self.t_start = array('q', bytes(8 * capacity))
+        self.t_end = array('q', bytes(8 * capacity))
+        self.frame_of = array('l', bytes(array('l').itemsize * capacity))
+        self.reset()
+
+    def reset(self):
+        """Starts a new run: forgets the laps and routines, and sets the time origin"""
+        self.n = 0
+        self.n_lost = 0
+        self.frame = 0
+        self.marks = []  # (time, routine, trial)
+        self.t0 = time.perf_counter_ns()
+
+    def start(self):
+        return time.perf_counter_ns()
+
+    def lap(self, phase, t):
+        """Records a phase that started at t; returns the time it ended"""
+        now = time.perf_counter_ns()
+        i = self.n
+        if i < self.capacity:
+            self.phase[i] = phase
+            self.t_start[i] = t
+            self.t_end[i] = now
+            self.frame_of[i] = self.frame
+            self.n = i + 1
+        else:
+            self.n_lost += 1
+        if phase == FLIP:
+            self.frame += 1
+        return now
+
+    def mark(self, routine, trial=None):
+        """Notes the start of a routine (event) of a trial"""
+        self.marks.append((time.perf_counter_ns(), routine, trial))
+
+    def durations(self):
+        """Duration (ns) of the laps of each phase"""
+        durations = {name: [] for name in PHASES}
+        for i in range(self.n):
+            durations[PHASES[self.phase[i]]].append(self.t_end[i] - self.t_start[i])
+        return durations
+
+    def overruns(self):
+        """
+        (flip time, interval, frame, culprit phase, its duration) of each frame
+        whose flip came more than the budget after the previous flip
+        """
+        overruns = []
+        last_flip = None
+        longest = {}  # frame -> (duration, phase) of its longest non-flip lap
+        for i in range(self.n):
+            phase = self.phase[i]
+            frame = self.frame_of[i]
+            duration = self.t_end[i] - self.t_start[i]
+            if phase != FLIP:
+                if duration > longest.get(frame, (-1, None))[0]:
+                    longest[frame] = (duration, phase)
+                continue
+            if last_flip is not None and self.t_end[i] - last_flip > self.budget_ns:
+                d, culprit = longest.get(frame, (duration, FLIP))
+                if duration > d:
+                    d, culprit = duration, FLIP
+                overruns.append((self.t_end[i], self.t_end[i] - last_flip, frame,
+                                 PHASES[culprit], d))
+            last_flip = self.t_end[i]
+        return overruns
+
+    def summary(self):
+        """p50/p99/max (ms) and count of each phase, and the overruns by culprit"""
+        phases = {}
+        for name, durations in self.durations().items():
+            if not durations:
+                continue
+            durations.sort()
+            n = len(durations)
+            phases[name] = {'n': n,
+                            'p50': round(durations[n // 2] / 1e6, 4),
+                            'p99': round(durations[min(int(n * 0.99), n - 1)] / 1e6, 4),
+                            'max': round(durations[-1] / 1e6, 4)}
+        culprits = {}
+        overruns = self.overruns()
+        for overrun in overruns:
+            culprits[overrun[3]] = culprits.get(overrun[3], 0) + 1
+        return {'frames': self.frame, 'laps': self.n, 'lost_laps': self.n_lost,
+                'phases': phases, 'overruns': len(overruns), 'overrun_culprits': culprits}
+
+    def trace_events(self):
+        """The laps, routines and overruns as Chrome trace events"""
+        us = lambda t: round((t - self.t0) / 1000, 1)
+        meta = [{'name': 'process_name', 'ph': 'M', 'pid': 1, 'args': {'name': 'MID run'}},
+                {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 1, 'args': {'name': 'frames'}},
+                {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 2, 'args': {'name': 'routines'}}]
+        events = []
+        for i in range(self.n):
+            events.append({'name': PHASES[self.phase[i]], 'ph': 'X', 'pid': 1, 'tid': 1,
+                           'ts': us(self.t_start[i]),
+                           'dur': round((self.t_end[i] - self.t_start[i]) / 1000, 1),
+                           'args': {'frame': self.frame_of[i]}})
+        t_end = max(self.t_end[self.n - 1] if self.n else self.t0,
+                    self.marks[-1][0] if self.marks else self.t0)
+        for (t, routine, trial), following in zip(self.marks, self.marks[1:] + [(t_end,)]):
+            events.append({'name': routine, 'ph': 'X', 'pid': 1, 'tid': 2, 'ts': us(t),
+                           'dur': round((following[0] - t) / 1000, 1),
+                           'args': {'trial': trial}})
+        for t, interval, frame, culprit, duration in self.overruns():
+            events.append({'name': 'overrun', 'ph': 'i', 's': 't', 'pid': 1, 'tid': 1,
+                           'ts': us(t), 'args': {'frame': frame,
+                                                 'interval_ms': round(interval / 1e6, 3),
+                                                 'culprit': culprit,
+                                                 'culprit_ms': round(duration / 1e6, 3)}})
+        return meta + events
+
+    def write_trace(self, fname, metadata=None):
+        """Writes the run as a Chrome trace; returns the summary"""
+        summary = self.summary()
+        with open(fname, 'w') as f:
+            json.dump({'traceEvents': self.trace_events(), 'displayTimeUnit': 'ms',
+                       'otherData': dict(metadata or {}, frame_duration=self.frame_duration,
+                                         summary=summary)}, f)
+        return summary
+
+
+class NullProfiler:
+    """Stands in for a FrameProfiler when profiling is off"""
+
+    def reset(self):
+        pass
+
+    def start(self):
+        return 0
+
+    def lap(self, phase, t):
+        return 0
+
+    def mark(self, routine, trial=None):
+        pass
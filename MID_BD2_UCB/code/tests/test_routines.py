@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+Tests of the routine engine (mid_routines.py) on a simulated window, whose
+flips move a virtual clock to the next screen refresh.
+"""
+
+import mid_routines
+from mid_routines import Phase, RoutineEngine, Trial
+
+FRAME = 0.01
+
+
+class Clock:
+    def __init__(self):
+        self.t = 0.0
+
+    def getTime(self):
+        return self.t
+
+
+class Window:
+    """Flips at every FRAME, pressing the keys due before each refresh"""
+
+    def __init__(self, clock, keys):
+        self.clock = clock
+        self.keys = keys
+        self.pressed = []
+        self.to_call = []
+
+    def callOnFlip(self, function):
+        self.to_call.append(function)
+
+    def flip(self):
+        refresh = (round(self.clock.t / FRAME) + 1) * FRAME
+        # Presses during the frame on screen until this refresh
+        self.pressed += [t for t in self.keys if self.clock.t <= t < refresh]
+        self.clock.t = refresh
+        for function in self.to_call:
+            function()
+        self.to_call = []
+
+
+def make_engine(keys, waiting=()):
+    """
+    An engine on the simulated window; the presses in waiting are still in
+    the device until collect() is called, as if the background thread had
+    not collected them yet
+    """
+    clock = Clock()
+    win = Window(clock, keys)
+    device = list(waiting)
+
+    def collect():
+        win.pressed += device
+        device.clear()
+
+    def first_response(onset, offset=None):
+        found = [t for t in win.pressed if t >= onset and (offset is None or t <= offset)]
+        for t in found:
+            win.pressed.remove(t)
+        return min(found) if found else None
+
+    return RoutineEngine(win, clock, FRAME, first_response, first_response,
+                         collect=collect), clock
+
+
+def run_target(keys, target_frames=3, waiting=()):
+    engine, clock = make_engine(keys, waiting)
+    ended = []
+    phases = [Phase('Tgt', None, frames=target_frames, keys=mid_routines.TARGET,
+                    end=lambda trial, result: ended.append(result)),
+              Phase('Fix', None, frames=5)]
+    trial = engine.run_trial(phases, Trial(1, 0, 'reward.high', {'Tgt': 0.0, 'Fix': 0.0}))
+    return trial, ended
+
+
+def test_press_during_last_target_frame_is_a_hit():
+    # The target is flipped at 0.01 and shown for 3 frames, the last one
+    # from 0.03 until the fixation is flipped at 0.04
+    trial, ended = run_target([0.035])
+    assert len(ended) == 1
+    assert abs(ended[0].rt - 0.025) < 1e-9
+    assert trial.results['Fix'].rt is None
+
+
+def test_press_not_collected_by_the_flip_is_a_hit():
+    # Pressed during the last target frame, but still in the device when
+    # the fixation is flipped
+    trial, ended = run_target([], waiting=[0.035])
+    assert abs(ended[0].rt - 0.025) < 1e-9
+    assert trial.results['Fix'].rt is None
+
+
+def test_target_window_closes_at_the_next_flip():
+    trial, ended = run_target([0.045])
+    assert ended[0].rt is None
+    assert abs(trial.results['Fix'].rt - 0.005) < 1e-9
+
+
+def test_press_before_the_first_flip_is_timed_from_the_start():
+    # The cue is flipped at 0.01 and 0.02; the delay starts at 0.02 and is
+    # first flipped at 0.03, after a press during the last cue frame
+    engine, clock = make_engine([0.025])
+    phases = [Phase('Cue', None, frames=2), Phase('Dly', None, frames=3)]
+    trial = engine.run_trial(phases, Trial(1, 0, 'reward.high', {'Cue': 0.0, 'Dly': 0.0}))
+    assert trial.results['Cue'].rt is None
+    assert abs(trial.results['Dly'].rt - 0.005) < 1e-9
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+bench_condition_state.py
+
+Micro-benchmark of the per-frame and per-trial cost of the adaptive target
+state, comparing the old pandas version (target_durs.loc[...] read on every
+frame of the Target loop, hit_tracker grown by enlargement on every trial)
+with the array-backed mid_state.ConditionState.
+
+Run from the code directory:
+    python benchmarks/bench_condition_state.py
+"""
+
+import os
+import sys
+import timeit
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mid_state
+
+
+conditions = ['loss.high', 'loss.low', 'loss.neut',
+              'reward.high', 'reward.low', 'reward.neut']
+frame_duration = 1.0 / 60.0
+num_trials = 36
+frames_per_target = 30  # ~0.5 s target window at 60 Hz
+repeats = 20
+
+
+def old_frame(target_durs, trial_type, t):
+    # What the Target loop evaluated on every frame
+    return t <= target_durs.loc[0, trial_type]
+
+
+def new_frame(trial_target_dur, t):
+    return t <= trial_target_dur
+
+
+def old_run():
+    target_durs = pd.DataFrame(columns=conditions)
+    target_durs.loc[0] = 0.5
+    hit_tracker = pd.DataFrame(columns=conditions)
+    for trial in range(num_trials):
+        trial_type = conditions[trial % len(conditions)]
+        for frame in range(frames_per_target):
+            old_frame(target_durs, trial_type, frame * frame_duration)
+        trial_type_count = hit_tracker[trial_type].count()
+        hit_tracker.loc[trial_type_count, trial_type] = trial % 3 != 0
+        hit_rate = hit_tracker[trial_type].sum() / hit_tracker[trial_type].count()
+        if hit_rate >= 0.66:
+            target_durs.loc[0, trial_type] -= 0.02
+        else:
+            target_durs.loc[0, trial_type] += 0.02
+
+
+def new_run():
+    cond_state = mid_state.ConditionState(conditions, frame_duration, 6, 60, 1)
+    cond_state.set_all(0.5)
+    for trial in range(num_trials):
+        cond_slot = cond_state.index[conditions[trial % len(conditions)]]
+        trial_target_dur = cond_state.frames[cond_slot] * frame_duration
+        for frame in range(frames_per_target):
+            new_frame(trial_target_dur, frame * frame_duration)
+        hit_rate = cond_state.record(cond_slot, trial % 3 != 0)
+        if hit_rate >= 0.66:
+            cond_state.step(cond_slot, -1)
+        else:
+            cond_state.step(cond_slot, 1)
+
+
+def per_call(stmt, n, **namespace):
+    """Best time per call (in microseconds) over a few repeats"""
+    timer = timeit.Timer(stmt, globals=dict(globals(), **namespace))
+    return min(timer.repeat(repeat=5, number=n)) / n * 1e6
+
+
+if __name__ == '__main__':
+    target_durs = pd.DataFrame(columns=conditions)
+    target_durs.loc[0] = 0.5
+    cond_state = mid_state.ConditionState(conditions, frame_duration, 6, 60, 1)
+    cond_state.set_all(0.5)
+
+    frame_old = per_call("old_frame(target_durs, 'reward.high', 0.2)", 20000,
+                         target_durs=target_durs)
+    frame_new = per_call("new_frame(cond_state.frames[3] * frame_duration, 0.2)",
+                         20000, cond_state=cond_state)
+    run_old = per_call("old_run()", repeats)
+    run_new = per_call("new_run()", repeats)
+
+    print(f"{'':28s}{'before':>12s}{'after':>12s}")
+    print(f"{'per frame (us)':28s}{frame_old:12.2f}{frame_new:12.2f}")
+    print(f"{'per run, {0} trials (ms)'.format(num_trials):28s}"
+          f"{run_old / 1e3:12.2f}{run_new / 1e3:12.2f}")
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+mid_startup.py
+
+Startup helpers shared by the MID task scripts (mid_BD2.py, mid_practice.py).
+
+The modules that are only needed once the participant dialog is closed
+(pandas, psychopy.data, psychopy.monitors) are imported by preload() in a
+background thread while the experimenter fills in the dialog. The modules
+that touch the GL context (psychopy.visual, psychopy.event) are still
+imported on the main thread, after the dialog.
+
+Measuring the frame rate of a display from scratch takes seconds and often
+fails ("Couldn't measure a consistent frame rate!"), leaving the task with a
+guess. The frame rate and window size measured on a machine are saved in a
+calibration profile (one JSON file per machine, screen and resolution), and
+later launches only check the profile against a short run of flips. The full
+measurement is redone when there is no profile or when the check fails.
+
+StartupTimer records how long each startup phase took, for the timing report.
+"""
+
+import importlib
+import json
+import os
+import socket
+import threading
+import time
+
+
+class StartupTimer:
+    """Wall clock time of each startup phase, in the order they are marked"""
+
+    def __init__(self, t0=None):
+        self.t0 = time.perf_counter() if t0 is None else t0
+        self.last = self.t0
+        self.phases = {}
+
+    def mark(self, phase):
+        """Ends a phase that started at the previous mark; returns its duration"""
+        now = time.perf_counter()
+        self.phases[phase] = round(now - self.last, 4)
+        self.last = now
+        return self.phases[phase]
+
+    def report(self):
+        return {'phases': dict(self.phases),
+                'total': round(self.last - self.t0, 4)}
+
+    def summary(self):
+        return ', '.join(f"{phase} {t:.2f}s" for phase, t in self.phases.items()) + \
+            f" (total {self.last - self.t0:.2f}s)"
+
+
+def preload(modules):
+    """
+    Imports modules in a background thread. A later import of the same module
+    on the main thread waits for the one in progress, so nothing is imported
+    twice; an import that fails here is left for the main thread to raise.
+    """
+    def run():
+        for name in modules:
+            try:
+                importlib.import_module(name)
+            except Exception:
+                pass
+
+    thread = threading.Thread(target=run, name='preload', daemon=True)
+    thread.start()
+    return thread
+
+
+def profile_name(profile_dir, screen, win_res):
+    """Calibration profile of this machine for a screen and resolution"""
+    host = socket.gethostname().split('.')[0] or 'unknown'
+    return os.path.join(profile_dir,
+                        f"{host}_screen{screen}_{win_res[0]}x{win_res[1]}.json")
+
+
+def load_profile(fname):
+    """Returns the saved profile, or None if there is none (or it is corrupt)"""
+    if not os.path.exists(fname):
+        return None
+    with open(fname) as f:
+        try:
+            return json.load(f)
+        except ValueError:
+            return None
+
+
+def save_profile(fname, profile):
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    tmp = fname+'.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(profile, f, indent=1)
+    os.replace(tmp, fname)
+
+
+def sample_frame_duration(win, n_frames=30, n_warmup=5):
+    """
+    Median interval between n_frames flips (after n_warmup flips), or None if
+    the flips are not synchronised to the screen refresh.
+    """
+    for n in range(n_warmup):
+        win.flip()
+    flips = [win.flip() for n in range(n_frames + 1)]
+    if None in flips:
+        return None
+    intervals = sorted(b - a for a, b in zip(flips, flips[1:]))
+    median = intervals[len(intervals) // 2]
+    return median if median > 0 else None
+
+
+def calibrate(win, fname, screen, tolerance=0.1, n_frames=30, max_rate=300):
+    """
+    Returns (frame_rate, frame_duration, source) for the window, where source
+    says where the frame rate came from:
+        'profile'   - the saved profile, confirmed by a short run of flips
+        'measured'  - win.getActualFrameRate(), saved as the new profile
+        'estimated' - the short run of flips, the full measurement failed
+        'guess'     - nothing could be measured, 60 Hz is assumed
+    The profile is used when the window has the same size and the median
+    flip interval is within tolerance (a fraction of a frame) of it.
+    """
+    profile = load_profile(fname)
+    sampled = sample_frame_duration(win, n_frames)
+    size = [int(x) for x in win.size]
+    if (profile and profile.get('size') == size and sampled and
+            abs(sampled - profile['frame_duration']) <= tolerance * profile['frame_duration']):
+        return profile['frame_rate'], profile['frame_duration'], 'profile'
+
+    frame_rate = win.getActualFrameRate()
+    if frame_rate is not None and frame_rate < max_rate:
+        frame_duration = 1.0 / round(frame_rate)
+        save_profile(fname, {'host': socket.gethostname(), 'screen': screen,
+                             'size': size, 'frame_rate': frame_rate,
+                             'frame_duration': frame_duration,
+                             'measured': time.strftime('%Y-%m-%d %H:%M:%S')})
+        return frame_rate, frame_duration, 'measured'
+    if sampled and sampled > 1.0 / max_rate:
+        return 1.0 / sampled, 1.0 / round(1.0 / sampled), 'estimated'
+    return None, 1.0 / 60.0, 'guess'
@@ -0,0 +1,555 @@
+# -*- coding: utf-8 -*-
+"""
+mid_headless.py
+
+Runs a MID task script (mid_BD2.py, mid_practice.py, ...) from start to end
+without a display or a participant, faster than real time, to check a change
+to the task before it goes to the scanner.
+
+The task script is run unchanged (with runpy), after swapping:
+    - psychopy.visual for null stimuli and a NullWindow, so no GL context
+      (nor pyglet) is needed. A flip moves a virtual clock to the next screen
+      refresh instead of waiting for it.
+    - the psychopy clock for that virtual clock, so every Clock, timer and
+      log timestamp of the task runs on it
+    - the participant dialog for the values given on the command line
+    - event.waitKeys (instructions and experimenter prompts) for an answer
+      given right away: the next --answer key if it is accepted, else the
+      first key accepted
+    - psychopy.hardware.keyboard.Keyboard for a SimulatedKeyboard, fed by:
+        - a SimulatedParticipant, who watches the frames the task flips,
+          notes the condition of each cue and presses the response key after
+          each target, with an RT drawn from the distribution of that
+          condition; some targets are missed (lapses) and some cues are
+          followed by a press before the target (anticipations)
+        - a SimulatedScanner, which sends a TTL trigger every TR from when
+          the task waits for the first one until the next experimenter prompt
+
+Everything else (staircases, target duration files, the MRT rerun, trial
+journal, checkpoints, timing reports, ...) is the real task code, and the
+output files are the same as in a real session, in the same data directory,
+so use a test participant number.
+
+Usage:
+    python mid_headless.py mid_BD2.py --participant 9999
+    python mid_headless.py mid_BD2.py --participant 9999 --slow-mrt
+    python mid_headless.py mid_practice.py --participant 9999 --answer r
+    python mid_headless.py mid_BD2.py --participant 9999 --profile subject.json
+
+A participant profile (--profile) is a JSON file with any of the keys of
+DEFAULT_PARTICIPANT, e.g. {"rt": {"loss.high": [0.22, 0.03, 0.03]}}.
+"""
+
+import argparse
+import copy
+import json
+import math
+import os
+import random
+import re
+import runpy
+import sys
+import time
+import types
+
+import numpy as np
+
+# Condition of a cue image, e.g. reward_high.png -> reward.high
+CUE_IMAGE = re.compile(r'(reward|loss)_(high|low|neut)\.\w+$')
+
+DEFAULT_PARTICIPANT = {
+    # Ex-Gaussian RT (mu, sigma, tau; in seconds) per condition: 'mrt' is for
+    # targets without a cue (the MRT run), 'default' for any condition not
+    # listed
+    'rt': {
+        'default': [0.24, 0.03, 0.04],
+        'mrt': [0.24, 0.03, 0.04],
+        'reward.high': [0.22, 0.03, 0.03],
+        'loss.high': [0.22, 0.03, 0.03],
+        'reward.neut': [0.26, 0.035, 0.05],
+        'loss.neut': [0.26, 0.035, 0.05],
+    },
+    'min_rt': 0.1,
+    'lapse_rate': 0.02,  # targets with no response at all
+    'anticipation_rate': 0.02,  # cues followed by a press before the target
+    'key': '1',  # response key
+}
+
+# Mean MRT above the 0.350 s rerun threshold of mid_BD2.py
+SLOW_MRT = [0.38, 0.03, 0.04]
+
+
+class VirtualClock:
+    """Simulated time (in seconds), only moved forward by the task's flips and waits"""
+
+    def __init__(self, t0=0.0):
+        self.now = t0
+
+    def getTime(self, *args, **kwargs):
+        return self.now
+
+    def advance(self, dt):
+        self.now += max(dt, 0.0)
+
+
+class SimulatedScanner:
+    """
+    Sends a TTL trigger key every TR. The scan is started when the task waits
+    for a trigger (after a short delay, as if the operator started it then),
+    and stopped at the next experimenter prompt. missed_rate is the fraction
+    of triggers that are lost.
+    """
+
+    def __init__(self, clock, tr=2.0, key='5', delay=1.0, missed_rate=0.0,
+                 rng=None):
+        self.clock = clock
+        self.tr = tr
+        self.key = key
+        self.delay = delay
+        self.missed_rate = missed_rate
+        self.rng = rng or random.Random()
+        self.next = None  # time of the next trigger, None when not scanning
+        self.n_sent = 0
+
+    def start(self):
+        if self.next is None:
+            self.next = self.clock.now + self.delay
+
+    def stop(self):
+        self.next = None
+
+    def presses(self, until):
+        """(key, time) of the triggers due by until"""
+        presses = []
+        while self.next is not None and self.next <= until:
+            if self.rng.random() >= self.missed_rate:
+                presses.append((self.key, self.next))
+                self.n_sent += 1
+            self.next += self.tr
+        return presses
+
+
+class SimulatedParticipant:
+    """Reacts to the cues and targets flipped on the NullWindow (see module doc)"""
+
+    def __init__(self, profile, rng=None):
+        self.profile = profile
+        self.rng = rng or random.Random()
+        self.condition = None  # of the last cue seen, until its target
+        self.previous = []  # stimuli on the previous frame
+        self.pending = []  # (key, time) of presses not delivered yet
+        self.n_targets = self.n_presses = self.n_lapses = self.n_anticipations = 0
+
+    def sample_rt(self, condition):
+        rts = self.profile['rt']
+        mu, sigma, tau = rts.get(condition or 'mrt', rts['default'])
+        rt = self.rng.gauss(mu, sigma)
+        if tau > 0:
+            rt += self.rng.expovariate(1.0 / tau)
+        return max(rt, self.profile['min_rt'])
+
+    def press(self, t):
+        self.pending.append((self.profile['key'], t))
+        self.n_presses += 1
+
+    def on_flip(self, t, shown):
+        """Called with the time of a flip and the stimuli it put on screen"""
+        for stim in shown:
+            if any(stim is previous for previous in self.previous):
+                continue  # not an onset
+            if isinstance(stim, ImageStim) and stim.condition:
+                self.condition = stim.condition
+                if self.rng.random() < self.profile['anticipation_rate']:
+                    self.press(t + self.rng.uniform(0.2, 2.0))
+                    self.n_anticipations += 1
+            elif isinstance(stim, Polygon):
+                self.n_targets += 1
+                if self.rng.random() < self.profile['lapse_rate']:
+                    self.n_lapses += 1
+                else:
+                    self.press(t + self.sample_rt(self.condition))
+                self.condition = None
+        self.previous = list(shown)
+
+    def presses(self, until):
+        """(key, time) of the presses due by until"""
+        due = [press for press in self.pending if press[1] <= until]
+        self.pending = [press for press in self.pending if press[1] > until]
+        return due
+
+
+class SimulatedKeyPress:
+    def __init__(self, name, rt, tDown):
+        self.name = name
+        self.rt = rt
+        self.tDown = tDown
+        self.duration = None
+
+
+class SimulatedKeyboard:
+    """
+    Stands in for psychopy.hardware.keyboard.Keyboard (with a backend other
+    than Psychtoolbox, so presses are collected in the main thread). Presses
+    are delivered once the virtual clock has reached them, timed on clock.
+    """
+
+    def __init__(self, session, clock=None, **kwargs):
+        self.session = session
+        self.clock = clock
+
+    def getBackend(self):
+        return 'headless'
+
+    def getKeys(self, keyList=None, ignoreKeys=None, waitRelease=True,
+                clear=True):
+        now = self.session.clock.now
+        due = self.session.participant.presses(now) + self.session.scanner.presses(now)
+        due.sort(key=lambda press: press[1])
+        offset = self.clock.getLastResetTime() if self.clock is not None else 0.0
+        return [SimulatedKeyPress(name, t - offset, t) for name, t in due
+                if keyList is None or name in keyList]
+
+    def clearEvents(self, eventType=None):
+        pass
+
+
+class NullWindow:
+    """
+    visual.Window without a screen: stimuli are only recorded as drawn, and
+    flip() moves the virtual clock to the next refresh, skipping one now and
+    then if the session drops frames. Flips are passed on to the participant.
+    """
+
+    def __init__(self, session, size=(800, 600), screen=0, units='height',
+                 **kwargs):
+        self.session = session
+        self.size = np.array(size)
+        self.screen = f"headless{screen}"  # keeps its own calibration profile
+        self.units = units
+        self.color = kwargs.get('color')
+        self.monitorFramePeriod = session.frame_duration
+        self._recordFrameIntervals = False
+        self.frameIntervals = []
+        self.nDroppedFrames = 0
+        self.lastFrameT = None
+        self.mouseVisible = True
+        self._toDraw = []  # autoDraw stimuli
+        self._frame = []  # stimuli drawn since the last flip
+        self._toCall = []
+
+    @property
+    def recordFrameIntervals(self):
+        return self._recordFrameIntervals
+
+    @recordFrameIntervals.setter
+    def recordFrameIntervals(self, value):
+        # As in psychopy, the first flip after turning it on has no interval
+        if value and not self._recordFrameIntervals:
+            self.lastFrameT = None
+        self._recordFrameIntervals = value
+
+    def flip(self, clearBuffer=True):
+        shown = self._toDraw + self._frame
+        t = self.session.next_frame()
+        if self.recordFrameIntervals and self.lastFrameT is not None:
+            self.frameIntervals.append(t - self.lastFrameT)
+        self.lastFrameT = t
+        for function, args, kwargs in self._toCall:
+            function(*args, **kwargs)
+        self._toCall = []
+        self.session.flips += 1
+        self.session.participant.on_flip(t, shown)
+        if clearBuffer:
+            self._frame = []
+        return t
+
+    def callOnFlip(self, function, *args, **kwargs):
+        self._toCall.append((function, args, kwargs))
+
+    def clearBuffer(self, color=True, depth=False, stencil=False):
+        self._frame = []
+
+    def getActualFrameRate(self, *args, **kwargs):
+        return 1.0 / self.session.frame_duration
+
+    def setMouseVisible(self, visibility, log=None):
+        self.mouseVisible = visibility
+
+    def close(self):
+        self._toDraw = []
+
+
+class NullStim:
+    """A stimulus that is only recorded by the window when drawn"""
+
+    def __init__(self, win=None, *args, **kwargs):
+        self.win = win
+        self.__dict__.update(kwargs)
+        self.pos = np.array(kwargs.get('pos') or (0, 0), float)
+        size = kwargs.get('size')
+        self.size = np.array(np.broadcast_to(1.0 if size is None else size, 2), float)
+        self.status = NOT_STARTED
+        self.autoDraw = False
+
+    def draw(self, win=None):
+        (win or self.win)._frame.append(self)
+
+    def setAutoDraw(self, value, log=None):
+        toDraw = self.win._toDraw
+        if value and self not in toDraw:
+            toDraw.append(self)
+            self.status = STARTED
+        elif not value and self in toDraw:
+            toDraw.remove(self)
+            self.status = STOPPED
+        self.autoDraw = value
+
+    def __getattr__(self, name):
+        # setText, setPos, ... just set the attribute
+        if name.startswith('set') and len(name) > 3:
+            attr = name[3].lower() + name[4:]
+            return lambda value, *args, **kwargs: setattr(self, attr, value)
+        raise AttributeError(name)
+
+
+class TextStim(NullStim):
+    pass
+
+
+class ImageStim(NullStim):
+    def __init__(self, win=None, *args, **kwargs):
+        NullStim.__init__(self, win, *args, **kwargs)
+        match = CUE_IMAGE.search(str(kwargs.get('image', '')))
+        self.condition = '.'.join(match.groups()) if match else None
+
+
+class Polygon(NullStim):
+    pass
+
+
+class BufferImageStim(NullStim):
+    pass
+
+
+# psychopy.constants, without importing psychopy before it is needed
+NOT_STARTED, STARTED, STOPPED = 0, 1, -1
+
+
+class HeadlessDialog:
+    """gui.DlgFromDict, filled in with the values given on the command line"""
+
+    def __init__(self, info, dictionary, title='', **kwargs):
+        for key in dictionary:
+            for name, value in info.items():
+                if key == name or key.startswith(name):
+                    dictionary[key] = value
+        self.OK = True
+        self.data = list(dictionary.values())
+
+
+class HeadlessPrompt:
+    """gui.Dlg, answered with the initial value of each field"""
+
+    OK = True
+
+    def __init__(self, *args, **kwargs):
+        self.data = []
+
+    def addText(self, *args, **kwargs):
+        pass
+
+    def addField(self, label, initial='', **kwargs):
+        self.data.append(initial)
+
+    def show(self):
+        return self.data
+
+
+class HeadlessSession:
+    """The simulated clock, window, participant and scanner of one run of a task script"""
+
+    def __init__(self, info, profile, frame_rate=60.0, tr=2.0, wait=1.0,
+                 answers=(), dropped_frame_rate=0.0, missed_ttl_rate=0.0,
+                 seed=None):
+        self.info = info
+        self.rng = random.Random(seed)
+        self.clock = VirtualClock()
+        self.frame_duration = 1.0 / frame_rate
+        self.dropped_frame_rate = dropped_frame_rate
+        self.wait = wait
+        self.answers = list(answers)
+        self.participant = SimulatedParticipant(profile, self.rng)
+        self.scanner = SimulatedScanner(self.clock, tr, missed_rate=missed_ttl_rate,
+                                        rng=self.rng)
+        self.flips = 0
+        self.prompts = []
+
+    def next_frame(self):
+        """Moves the clock to the next screen refresh (or the one after, if a frame is dropped)"""
+        n = math.floor(self.clock.now / self.frame_duration + 1e-6) + 1
+        if self.dropped_frame_rate and self.rng.random() < self.dropped_frame_rate:
+            n += 1
+        self.clock.now = n * self.frame_duration
+        return self.clock.now
+
+    def wait_keys(self, keyList=None, maxWait=float('inf'), timeStamped=False,
+                  clearEvents=True, **kwargs):
+        """event.waitKeys: the experimenter (or participant) answers right away"""
+        self.scanner.stop()
+        self.clock.advance(self.wait)
+        keyList = list(keyList or ['space'])
+        key = keyList[0]
+        for answer in self.answers:
+            if answer in keyList:
+                self.answers.remove(answer)
+                key = answer
+                break
+        self.prompts.append(key)
+        if timeStamped:
+            return [[key, self.clock.now]]
+        return [key]
+
+    def sleep(self, secs):
+        # The task only sleeps while it waits for a scanner trigger
+        self.scanner.start()
+        self.clock.advance(secs)
+
+    def quit(self):
+        # core.quit, without the windows and ioHub there is nothing to close
+        from psychopy import logging
+        logging.flush()
+        sys.exit(0)
+
+    def visual_module(self):
+        visual = types.ModuleType('psychopy.visual')
+        visual.__doc__ = "Null psychopy.visual installed by mid_headless"
+        visual.Window = lambda *args, **kwargs: NullWindow(self, *args, **kwargs)
+        visual.TextStim = visual.TextBox2 = TextStim
+        visual.ImageStim = ImageStim
+        visual.Polygon = visual.ShapeStim = visual.Rect = visual.Circle = Polygon
+        visual.BufferImageStim = BufferImageStim
+        return visual
+
+    def install(self, task_dir):
+        """Swaps the display, clock, dialogs and input devices for the simulated ones"""
+        global NOT_STARTED, STARTED, STOPPED
+        sys.path.insert(0, task_dir)
+
+        import psychopy
+        visual = self.visual_module()
+        sys.modules['psychopy.visual'] = visual
+        psychopy.visual = visual
+
+        from psychopy import clock, constants, core, event, gui
+        NOT_STARTED, STARTED, STOPPED = (constants.NOT_STARTED, constants.STARTED,
+                                         constants.STOPPED)
+        clock.getTime = self.clock.getTime
+        clock.monotonicClock._timeAtLastReset = 0.0
+        clock.wait = core.wait = lambda secs, hogCPUperiod=0.2: self.clock.advance(secs)
+        core.quit = self.quit
+
+        gui.DlgFromDict = lambda *args, **kwargs: HeadlessDialog(self.info, *args, **kwargs)
+        gui.Dlg = HeadlessPrompt
+        event.waitKeys = self.wait_keys
+        event.getKeys = lambda *args, **kwargs: []
+        event.clearEvents = lambda *args, **kwargs: None
+        event.Mouse = lambda *args, **kwargs: types.SimpleNamespace(
+            setVisible=lambda *a, **k: None, getPressed=lambda *a, **k: [0, 0, 0])
+
+        from psychopy.hardware import keyboard
+        keyboard.Keyboard = lambda *args, **kwargs: SimulatedKeyboard(self, **kwargs)
+
+        import mid_io
+        mid_io.time = types.SimpleNamespace(**{name: getattr(time, name)
+                                               for name in dir(time)
+                                               if not name.startswith('_')})
+        mid_io.time.sleep = self.sleep
+
+    def summary(self, real_time):
+        p = self.participant
+        return (f"{self.clock.now:.1f} s of task time in {real_time:.1f} s "
+                f"({self.clock.now / max(real_time, 1e-9):.0f}x real time), "
+                f"{self.flips} flips, {p.n_targets} targets, {p.n_presses} presses "
+                f"({p.n_lapses} lapses, {p.n_anticipations} anticipations), "
+                f"{self.scanner.n_sent} triggers, prompts answered: {''.join(self.prompts)!r}")
+
+
+def load_profile(fname=None, slow_mrt=False):
+    """DEFAULT_PARTICIPANT, updated with a profile file"""
+    profile = copy.deepcopy(DEFAULT_PARTICIPANT)
+    if fname:
+        with open(fname) as f:
+            custom = json.load(f)
+        profile['rt'].update(custom.pop('rt', {}))
+        profile.update(custom)
+    if slow_mrt:
+        profile['rt']['mrt'] = list(SLOW_MRT)
+    return profile
+
+
+def run(script, info, profile, session_class=HeadlessSession, **kwargs):
+    """Runs a task script in a HeadlessSession (or subclass); returns the session"""
+    script = os.path.abspath(script)
+    session = session_class(info, profile, **kwargs)
+    session.install(os.path.dirname(script))
+    sys.argv = [script]
+    t0 = time.perf_counter()
+    try:
+        runpy.run_path(script, run_name='__main__')
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            raise
+    print("headless: " + session.summary(time.perf_counter() - t0))
+    return session
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('script', help="task script to run, e.g. mid_BD2.py")
+    parser.add_argument('--participant', default='9999')
+    parser.add_argument('--session', default='1')
+    parser.add_argument('--start-run', help="first run (mid_BD2.py)")
+    parser.add_argument('--resume', choices=['yes', 'no'],
+                        help="resume the start run from its checkpoint (mid_BD2.py)")
+    parser.add_argument('--fmri', choices=['yes', 'no'])
+    parser.add_argument('--ttl', choices=['yes', 'no'], help="trigger on the TTL")
+    parser.add_argument('--info', nargs='*', default=[], metavar='FIELD=VALUE',
+                        help="any other dialog field (or the start of its name)")
+    parser.add_argument('--profile', help="participant profile (JSON)")
+    parser.add_argument('--slow-mrt', action='store_true',
+                        help=f"MRT targets answered slowly (mean RT above 0.350 s), "
+                             f"to go through the MRT rerun")
+    parser.add_argument('--answer', nargs='*', default=[], metavar='KEY',
+                        help="answers to prompts that accept them, in order, e.g. r "
+                             "to redo the practice run; other prompts get their first key")
+    parser.add_argument('--frame-rate', type=float, default=60.0)
+    parser.add_argument('--dropped-frames', type=float, default=0.0, metavar='RATE',
+                        help="fraction of flips that miss a refresh")
+    parser.add_argument('--tr', type=float, default=2.0, help="scanner TR (s)")
+    parser.add_argument('--missed-ttl', type=float, default=0.0, metavar='RATE',
+                        help="fraction of scanner triggers lost")
+    parser.add_argument('--wait', type=float, default=1.0,
+                        help="seconds taken to answer each prompt")
+    parser.add_argument('--seed', type=int, help="participant/scanner random seed "
+                                                 "(default: the participant number)")
+    args = parser.parse_args(argv)
+
+    info = {'participant': args.participant, 'session': args.session}
+    for name, value in (('start run', args.start_run), ('resume run', args.resume),
+                        ('fMRI?', args.fmri), ('fMRI trigger on TTL?', args.ttl)):
+        if value is not None:
+            info[name] = value
+    for field in args.info:
+        name, value = field.split('=', 1)
+        info[name] = value
+    seed = args.seed if args.seed is not None else int(args.participant)
+    run(args.script, info, load_profile(args.profile, args.slow_mrt),
+        frame_rate=args.frame_rate, tr=args.tr, wait=args.wait,
+        answers=args.answer, dropped_frame_rate=args.dropped_frames,
+        missed_ttl_rate=args.missed_ttl, seed=seed)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
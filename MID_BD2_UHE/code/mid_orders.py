@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+mid_orders.py
+
+Precomputed trial orders of the MID task runs (mid_BD2.py).
+
+An order library is a directory in stimuli/orders (e.g. mid36-v1, as written
+by optimize_design.py; a new version of a library is a new directory) with:
+    design-NN.csv - the trials of one run: trial, trial.type, fix_after_cue
+                    and fix_ITI (seconds)
+    slots.csv     - the design of each counterbalancing slot in each run:
+                    slot, run, file
+    manifest.json - how the designs were made (optional); its num_trials and
+                    fix_ITI settings give the run length the designs must have
+
+OrderLibrary.load() reads every design used in slots.csv and checks it
+against the run length: the number of trials, each condition the same number
+of times, the ITI total, and the fixations after cue within their range. All
+the problems found are raised together as an OrderError, before the task
+starts. The designs are indexed by (slot, run), and a subject's slot comes
+from their subject and session number, so picking the order of a run at run
+start is a dict lookup and nothing is parsed (and no pandas is used) between
+the trigger and the first trial.
+
+The parsed library is cached in a pickle (in cache_dir), keyed by the size and
+modification time of its files and the validation settings, so later
+launches skip the CSV parsing and validation.
+"""
+
+import collections
+import csv
+import json
+import os
+import pickle
+
+ORDER_FIELDS = ['trial', 'trial.type', 'fix_after_cue', 'fix_ITI']
+SLOT_FIELDS = ['slot', 'run', 'file']
+CACHE_VERSION = 1
+
+# The trials of one run, as tuples
+RunOrder = collections.namedtuple('RunOrder', ['file', 'trial_types', 'fix_after_cue',
+                                               'fix_ITI'])
+
+
+class OrderError(ValueError):
+    """An order library that does not match the run it is used for"""
+
+    def __init__(self, library, problems):
+        self.library = library
+        self.problems = problems
+        ValueError.__init__(self, f"{library}: " + '; '.join(problems))
+
+
+def read_design(fname):
+    """Returns the RunOrder in a design file"""
+    with open(fname, newline='') as f:
+        reader = csv.DictReader(f)
+        missing = [field for field in ORDER_FIELDS if field not in (reader.fieldnames or [])]
+        if missing:
+            raise ValueError(f"no {', '.join(missing)} column")
+        rows = list(reader)
+    if [int(row['trial']) for row in rows] != list(range(1, len(rows) + 1)):
+        raise ValueError("trials are not numbered 1, 2, ...")
+    return RunOrder(os.path.basename(fname),
+                    tuple(row['trial.type'] for row in rows),
+                    tuple(float(row['fix_after_cue']) for row in rows),
+                    tuple(float(row['fix_ITI']) for row in rows))
+
+
+def check_design(order, conditions, num_trials, iti_total=None, fix_after_cue_range=None):
+    """Problems of a RunOrder for a run of num_trials, as a list of strings"""
+    problems = []
+    n = len(order.trial_types)
+    if n != num_trials:
+        problems.append(f"{n} trials instead of {num_trials}")
+    unknown = sorted(set(order.trial_types) - set(conditions))
+    if unknown:
+        problems.append(f"unknown trial types {', '.join(unknown)}")
+    counts = collections.Counter(order.trial_types)
+    if n % len(conditions) or any(counts[cond] != n // len(conditions) for cond in conditions):
+        problems.append("conditions are not balanced (" +
+                        ', '.join(f"{cond} {counts[cond]}" for cond in conditions) + ")")
+    if any(iti <= 0 for iti in order.fix_ITI):
+        problems.append("ITIs must be positive")
+    if iti_total is not None and abs(sum(order.fix_ITI) - iti_total) > 1e-6:
+        problems.append(f"ITIs add up to {sum(order.fix_ITI):g} s instead of {iti_total:g} s")
+    if fix_after_cue_range is not None:
+        low, high = fix_after_cue_range
+        if any(not low - 1e-6 <= fix <= high + 1e-6 for fix in order.fix_after_cue):
+            problems.append(f"fixations after cue outside {low}-{high} s")
+    return [f"{order.file}: {problem}" for problem in problems]
+
+
+class OrderLibrary:
+    """The run orders of a library, indexed by (slot, run)"""
+
+    def __init__(self, name, num_trials, index):
+        self.name = name
+        self.num_trials = num_trials
+        self.index = index
+        self.slots = sorted({slot for slot, run in index})
+        self.runs = sorted({run for slot, run in index})
+
+    def slot(self, subject, session=1):
+        """Counterbalancing slot of a subject's session (the next slot for each later session)"""
+        return self.slots[(int(subject) + int(session) - 1) % len(self.slots)]
+
+    def select(self, slot, run):
+        """RunOrder of a slot's run"""
+        try:
+            return self.index[(slot, run)]
+        except KeyError:
+            raise KeyError(f"{self.name} has no order for slot {slot}, run {run}") from None
+
+    @classmethod
+    def parse(cls, path, conditions, num_trials=None, iti_total=None,
+              fix_after_cue_range=None):
+        """Reads and validates a library directory; raises OrderError on any problem"""
+        name = os.path.basename(os.path.normpath(path))
+        manifest = {}
+        if os.path.exists(os.path.join(path, 'manifest.json')):
+            with open(os.path.join(path, 'manifest.json')) as f:
+                manifest = json.load(f)
+        if num_trials is None:
+            num_trials = manifest.get('num_trials')
+        if iti_total is None and 'fix_ITI' in manifest.get('settings', {}):
+            iti_total = sum(manifest['settings']['fix_ITI'][:num_trials])
+
+        slots_file = os.path.join(path, 'slots.csv')
+        if not os.path.exists(slots_file):
+            raise OrderError(name, [f"no slots.csv in {path}"])
+        with open(slots_file, newline='') as f:
+            reader = csv.DictReader(f)
+            if reader.fieldnames != SLOT_FIELDS:
+                raise OrderError(name, [f"slots.csv columns must be {', '.join(SLOT_FIELDS)}"])
+            slots = [(int(row['slot']), int(row['run']), row['file']) for row in reader]
+
+        problems, designs, index = [], {}, {}
+        for slot, run, fname in slots:
+            if (slot, run) in index:
+                problems.append(f"slot {slot} has run {run} twice")
+            if fname not in designs:
+                try:
+                    designs[fname] = read_design(os.path.join(path, fname))
+                except (OSError, ValueError) as e:
+                    problems.append(f"{fname}: {e}")
+                    continue
+                if num_trials is None:
+                    num_trials = len(designs[fname].trial_types)
+                if iti_total is None:
+                    iti_total = sum(designs[fname].fix_ITI)
+                problems += check_design(designs[fname], conditions, num_trials,
+                                         iti_total, fix_after_cue_range)
+            if fname in designs:
+                index[(slot, run)] = designs[fname]
+        runs = {run for slot, run, fname in slots}
+        for slot in sorted({slot for slot, run, fname in slots}):
+            missing = sorted(run for run in runs if (slot, run) not in index)
+            if missing:
+                problems.append(f"slot {slot} has no order for run(s) {missing}")
+        if not slots:
+            problems.append("slots.csv is empty")
+        if problems:
+            raise OrderError(name, problems)
+        return cls(name, num_trials, index)
+
+    @classmethod
+    def load(cls, path, conditions, num_trials=None, iti_total=None,
+             fix_after_cue_range=None, cache_dir=None):
+        """
+        OrderLibrary.parse(), from the cache in cache_dir when the library
+        files and settings did not change since it was written.
+        """
+        key = [CACHE_VERSION, list(conditions), num_trials, iti_total,
+               list(fix_after_cue_range) if fix_after_cue_range else None,
+               sorted((name, st.st_size, st.st_mtime_ns) for name in os.listdir(path)
+                      for st in [os.stat(os.path.join(path, name))])]
+        cache_file = None
+        if cache_dir:
+            cache_file = os.path.join(cache_dir, 'orders-' +
+                                      os.path.basename(os.path.normpath(path)) + '.pkl')
+            if os.path.exists(cache_file):
+                try:
+                    with open(cache_file, 'rb') as f:
+                        cached = pickle.load(f)
+                    if cached['key'] == key:
+                        return cached['library']
+                except (OSError, pickle.UnpicklingError, EOFError, KeyError, AttributeError):
+                    pass
+
+        library = cls.parse(path, conditions, num_trials, iti_total, fix_after_cue_range)
+        if cache_file:
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp = cache_file+'.tmp'
+                with open(tmp, 'wb') as f:
+                    pickle.dump({'key': key, 'library': library}, f,
+                                protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, cache_file)
+            except OSError:
+                pass
+        return library
@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+mid_state.py
+
+Per-condition state of the adaptive target window used by the MID task
+scripts (mid_BD2.py, mid_practice.py).
+
+Each condition (e.g. 'reward.high') gets a fixed slot in small arrays holding
+its target window (in whole frames) and its hit counts, so the trial loop can
+read and update them in O(1) without any pandas indexing. The state is read
+from and written to the same _target_durs-*.csv files as before: one column
+per condition and a first row with the target window in seconds.
+
+The hit rate driving the adaptive window is estimated over a rolling window of
+the most recent trials of each condition (a fixed-size ring buffer), or as an
+exponentially weighted average, instead of cumulatively from the first trial,
+so early misses stop pulling the window longer once the subject has adapted.
+To carry this estimate across runs, the _target_durs-*.csv files have two more
+kinds of rows after the target windows: the current hit rate estimate, then
+the recent outcomes of each condition (1 = hit, 0 = miss), oldest first.
+Files with only the target window row are still read fine.
+
+mid_BD2.py also saves a checkpoint of its run state after every trial, so an
+interrupted run can be resumed from the next trial (see save_checkpoint).
+"""
+
+import csv
+import os
+import pickle
+from array import array
+
+
+class ConditionState:
+    """Fixed-slot target windows and hit counts for each trial condition"""
+
+    def __init__(self, conditions, frame_duration, min_frames=1,
+                 max_frames=None, step_frames=1, window=None, alpha=None):
+        self.conditions = list(conditions)
+        self.index = {cond: slot for slot, cond in enumerate(self.conditions)}
+        self.frame_duration = frame_duration
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.step_frames = step_frames
+
+        n = len(self.conditions)
+        self.frames = array('l', [min_frames] * n)  # target window, in frames
+        self.hits = array('l', [0] * n)
+        self.counts = array('l', [0] * n)
+
+        # Rolling window of the last outcomes of each condition, stored as one
+        # ring buffer of window slots per condition (-1 = empty)
+        self.window = window
+        self.alpha = alpha
+        if window:
+            self.ring = array('b', [-1] * (n * window))
+            self.ring_pos = array('l', [0] * n)
+            self.ring_filled = array('l', [0] * n)
+            self.ring_hits = array('l', [0] * n)
+        # Exponentially weighted hit rate (-1 = no trials yet)
+        self.ewma = array('d', [-1.0] * n)
+
+    def clip(self, frames):
+        """Keeps a target window within the min/max bounds"""
+        frames = max(frames, self.min_frames)
+        if self.max_frames is not None:
+            frames = min(frames, self.max_frames)
+        return frames
+
+    def set_duration(self, slot, duration):
+        """Sets the target window of a slot from a duration in seconds"""
+        self.frames[slot] = self.clip(int(round(duration / self.frame_duration)))
+
+    def set_all(self, duration):
+        """Sets the target window of every condition from a duration in seconds"""
+        for slot in range(len(self.conditions)):
+            self.set_duration(slot, duration)
+
+    def duration(self, slot):
+        """Target window of a slot, in seconds"""
+        return self.frames[slot] * self.frame_duration
+
+    def record(self, slot, hit):
+        """Adds the outcome of a trial and returns the condition's hit rate"""
+        hit = int(hit)
+        self.hits[slot] += hit
+        self.counts[slot] += 1
+        self._push(slot, hit)
+        if self.ewma[slot] < 0:
+            self.ewma[slot] = hit
+        elif self.alpha:
+            self.ewma[slot] += self.alpha * (hit - self.ewma[slot])
+        return self.hit_rate(slot)
+
+    def _push(self, slot, hit):
+        """Stores an outcome in the condition's ring buffer"""
+        if not self.window:
+            return
+        i = slot * self.window + self.ring_pos[slot]
+        if self.ring[i] >= 0:
+            self.ring_hits[slot] -= self.ring[i]
+        else:
+            self.ring_filled[slot] += 1
+        self.ring[i] = hit
+        self.ring_hits[slot] += hit
+        self.ring_pos[slot] = (self.ring_pos[slot] + 1) % self.window
+
+    def history(self, slot):
+        """Outcomes in the condition's rolling window, oldest first"""
+        if not self.window:
+            return []
+        start = slot * self.window
+        pos = self.ring_pos[slot]
+        ordered = self.ring[start + pos:start + self.window] + self.ring[start:start + pos]
+        return [hit for hit in ordered if hit >= 0]
+
+    def reset_history(self):
+        """Forgets all outcomes, keeping the target windows"""
+        for slot in range(len(self.conditions)):
+            self.hits[slot] = self.counts[slot] = 0
+            self.ewma[slot] = -1.0
+            if self.window:
+                self.ring_pos[slot] = self.ring_filled[slot] = self.ring_hits[slot] = 0
+        if self.window:
+            for i in range(len(self.ring)):
+                self.ring[i] = -1
+
+    def hit_rate(self, slot):
+        if self.alpha:
+            return max(self.ewma[slot], 0.0)
+        if self.window:
+            if self.ring_filled[slot] == 0:
+                return 0.0
+            return self.ring_hits[slot] / self.ring_filled[slot]
+        if self.counts[slot] == 0:
+            return 0.0
+        return self.hits[slot] / self.counts[slot]
+
+    def step(self, slot, direction):
+        """Lengthens (direction=1) or shortens (direction=-1) a target window"""
+        self.frames[slot] = self.clip(self.frames[slot] + direction * self.step_frames)
+        return self.frames[slot]
+
+    def average(self):
+        """Sets every condition to the mean target window across conditions"""
+        mean_frames = int(round(sum(self.frames) / len(self.frames)))
+        for slot in range(len(self.conditions)):
+            self.frames[slot] = self.clip(mean_frames)
+
+    def read_csv(self, fname):
+        """Loads the target windows and hit rate state from a _target_durs-*.csv file"""
+        with open(fname, newline='') as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            durations = next(reader)
+            rates = next(reader, None)
+            history = list(reader)
+        for col, cond in enumerate(header):
+            if cond not in self.index:
+                continue
+            slot = self.index[cond]
+            self.set_duration(slot, float(durations[col]))
+            if rates and rates[col] != '':
+                self.ewma[slot] = float(rates[col])
+            for row in history:
+                if row[col] != '':
+                    self._push(slot, int(row[col]))
+
+    def to_csv(self, fname):
+        """Writes the target windows (in seconds) and hit rate state to a _target_durs-*.csv file"""
+        slots = range(len(self.conditions))
+        histories = [self.history(slot) for slot in slots]
+        with open(fname, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(self.conditions)
+            writer.writerow([self.duration(slot) for slot in slots])
+            if not any(histories) and max(self.ewma) < 0:
+                return
+            writer.writerow([self.hit_rate(slot) if self.counts[slot] or
+                             self.ewma[slot] >= 0 else '' for slot in slots])
+            # Right-align the histories so the newest outcomes share the last row
+            n_rows = max(len(hist) for hist in histories)
+            for row in range(n_rows):
+                writer.writerow([hist[row - n_rows + len(hist)]
+                                 if row - n_rows + len(hist) >= 0 else ''
+                                 for hist in histories])
+
+
+def save_checkpoint(fname, state):
+    """
+    Pickles a checkpoint (a dict of run state) to fname. It is written to a
+    temporary file first and renamed into place, so fname always holds a
+    complete checkpoint, even if the task dies while saving.
+    """
+    tmp = fname+'.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fname)
+
+
+def load_checkpoint(fname):
+    """Returns the checkpoint saved in fname, or None if there is none"""
+    if not os.path.exists(fname):
+        return None
+    with open(fname, 'rb') as f:
+        return pickle.load(f)
@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+optimize_design.py
+
+Searches for trial orders and fixation timings of a MID run with a high fMRI
+design efficiency, and writes the best ones as a library of order files.
+
+mid_BD2.py shuffles the conditions and the ITIs of each run from a seed, so
+how well a run separates the conditions in the BOLD signal varies from
+subject to subject. Here a run design is:
+    - the order of the trial types (each condition num_trials/6 times)
+    - the ITI of each trial (a permutation of fix_ITI)
+    - the fixation after each cue (drawn from fix_after_cue_range)
+laid out with mid_timing.build_run_schedule() and the task's settings (read
+from the task script, as in simulate_adaptive.py), so the events are where
+the task puts them.
+
+The design matrix has an anticipation regressor per condition (cue onset to
+target onset), an outcome regressor per condition (feedback), a target
+regressor and cosine drift terms (high-pass filter), each convolved with the
+canonical (double gamma) HRF and sampled every TR. The efficiency of a
+contrast c is 1 / (c (X'X)^-1 c'), for:
+    gain_vs_neutral         - anticipation of reward.high + reward.low vs reward.neut
+    loss_vs_neutral         - anticipation of loss.high + loss.low vs loss.neut
+    anticipation_vs_outcome - all anticipation vs all outcome regressors
+and a design's score is the weighted geometric mean of these (--weights).
+
+The search runs independent restarts over a process pool: each restart
+starts from a random design and climbs by swapping two trials, two ITIs or
+redrawing a fixation after cue, keeping changes that raise the score (with
+at most --max-repeat trials of the same condition in a row). The best
+distinct designs of all restarts form the library:
+    <out>/design-01.csv, ...  - trial, trial.type, fix_after_cue, fix_ITI
+    <out>/slots.csv           - the design of each counterbalancing slot in
+        each run (see mid_orders.py), pairing better designs with worse ones
+        so the slots get about the same efficiency over a session
+    <out>/manifest.json       - settings, model, contrasts, and the
+        efficiencies of each design and of random (shuffled) designs
+
+Usage:
+    python optimize_design.py [--designs 24] [--restarts 48] [--iterations 2000]
+                              [--workers N] [--seed S] [--out ../stimuli/orders/mid36-v1]
+"""
+
+import argparse
+import concurrent.futures
+import csv
+import json
+import os
+import re
+import sys
+import time
+
+import numpy as np
+from scipy import stats
+
+import mid_timing
+import simulate_adaptive
+
+CONDITIONS = simulate_adaptive.CONDITIONS
+CONTRASTS = {
+    'gain_vs_neutral': {'anticipation': {'reward.high': 1, 'reward.low': 1, 'reward.neut': -2}},
+    'loss_vs_neutral': {'anticipation': {'loss.high': 1, 'loss.low': 1, 'loss.neut': -2}},
+    'anticipation_vs_outcome': {'anticipation': {cond: 1 for cond in CONDITIONS},
+                                'outcome': {cond: -1 for cond in CONDITIONS}},
+}
+DT = 0.1  # resolution of the neural time courses (s)
+TARGET_DUR = 0.25  # nominal target duration for the target regressor (s)
+ORDER_FIELDS = ['trial', 'trial.type', 'fix_after_cue', 'fix_ITI']
+
+
+def canonical_hrf(dt=DT, length=32.0):
+    """SPM's canonical double gamma HRF, sampled every dt"""
+    t = np.arange(0, length, dt)
+    hrf = stats.gamma.pdf(t, 6) - stats.gamma.pdf(t, 16) / 6.0
+    return hrf / hrf.sum()
+
+
+def drift_basis(n_scans, tr, cutoff=128.0):
+    """Discrete cosine basis of a high-pass filter (as in SPM), plus the constant"""
+    n = int(np.floor(2 * n_scans * tr / cutoff)) + 1
+    k = np.arange(n_scans)
+    return np.column_stack([np.cos(np.pi * (k + 0.5) * order / n_scans)
+                            for order in range(n)])
+
+
+class Model:
+    """Design matrix and contrast efficiencies of a run design"""
+
+    def __init__(self, settings, tr, weights, cutoff=128.0):
+        self.settings = settings
+        self.tr = tr
+        self.n_trials = settings['num_trials']
+        self.slot = {cond: slot for slot, cond in enumerate(CONDITIONS)}
+        self.run_length = (settings['initial_fix_duration'] + sum(settings['fix_ITI']) +
+                           self.n_trials * (settings['cue_time'] +
+                                            settings['isi_target_isi_time'] +
+                                            settings['feedback_time']))
+        self.n_scans = int(np.ceil(self.run_length / tr))
+        self.scan_index = np.round(np.arange(self.n_scans) * tr / DT).astype(int)
+        self.cum_hrf = np.concatenate([[0.0], np.cumsum(canonical_hrf())])
+        self.drift = drift_basis(self.n_scans, tr, cutoff)
+        self.n_reg = 2 * len(CONDITIONS) + 1  # anticipation, outcome, target
+
+        self.contrasts = np.zeros((len(CONTRASTS), self.n_reg + self.drift.shape[1]))
+        for row, contrast in enumerate(CONTRASTS.values()):
+            for part, offset in (('anticipation', 0), ('outcome', len(CONDITIONS))):
+                for cond, weight in contrast.get(part, {}).items():
+                    self.contrasts[row, offset + self.slot[cond]] = weight
+        self.weights = np.array([weights.get(name, 1.0) for name in CONTRASTS], float)
+
+    def schedule(self, order, fix_after_cue, fix_ITI):
+        s = self.settings
+        return mid_timing.build_run_schedule([CONDITIONS[slot] for slot in order],
+                                             fix_ITI, fix_after_cue, s['cue_time'],
+                                             s['isi_target_isi_time'], s['feedback_time'],
+                                             s['initial_fix_duration'])
+
+    def design_matrix(self, order, fix_after_cue, fix_ITI):
+        # A boxcar from a to b convolved with the HRF is the difference of the
+        # cumulative HRF at t - a and t - b, so each event adds that at the
+        # scan times (all times in steps of DT)
+        feedback = int(round(self.settings['feedback_time'] / DT))
+        target = int(round(TARGET_DUR / DT))
+        onsets = np.array([[planned['Cue'], planned['Tgt'], planned['Fb']]
+                           for planned in self.schedule(order, fix_after_cue, fix_ITI)])
+        cue, tgt, fb = np.round(onsets / DT).astype(int).T
+        starts = np.concatenate([cue, fb, tgt])
+        ends = np.concatenate([tgt, fb + feedback, tgt + target])
+        regs = np.concatenate([order, len(CONDITIONS) + order,
+                               np.full(len(order), self.n_reg - 1)])
+        lag = self.scan_index[None, :] - starts[:, None] + 1
+        n = len(self.cum_hrf) - 1
+        response = (self.cum_hrf[np.clip(lag, 0, n)] -
+                    self.cum_hrf[np.clip(lag - (ends - starts)[:, None], 0, n)])
+        events = np.zeros((self.n_reg, len(regs)))
+        events[regs, np.arange(len(regs))] = 1.0
+        X = events @ response
+        return np.column_stack([X.T, self.drift])
+
+    def efficiencies(self, order, fix_after_cue, fix_ITI):
+        X = self.design_matrix(order, fix_after_cue, fix_ITI)
+        cov = np.linalg.pinv(X.T @ X)
+        variance = np.einsum('ij,jk,ik->i', self.contrasts, cov, self.contrasts)
+        return 1.0 / variance
+
+    def score(self, efficiencies):
+        """Weighted geometric mean of the contrast efficiencies"""
+        return float(np.exp(np.sum(self.weights * np.log(efficiencies)) / self.weights.sum()))
+
+
+def max_run(order):
+    """Longest run of the same condition in a row"""
+    longest = current = 1
+    for a, b in zip(order, order[1:]):
+        current = current + 1 if a == b else 1
+        longest = max(longest, current)
+    return longest
+
+
+def random_design(rng, settings, max_repeat):
+    n_trials = settings['num_trials']
+    slots = np.tile(np.arange(len(CONDITIONS)), -(-n_trials // len(CONDITIONS)))[:n_trials]
+    while True:
+        order = rng.permutation(slots)
+        if max_run(order) <= max_repeat:
+            break
+    fix_ITI = rng.permutation(np.array(settings['fix_ITI'], float)[:n_trials])
+    low, high = settings['fix_after_cue_range']
+    fix_after_cue = np.round(rng.uniform(low, high, n_trials), 3)
+    return order, fix_after_cue, fix_ITI
+
+
+def climb(model, rng, design, n_iterations, max_repeat):
+    """Hill climbing from a design; returns the best design, its efficiencies and score"""
+    order, fix_after_cue, fix_ITI = (x.copy() for x in design)
+    eff = model.efficiencies(order, fix_after_cue, fix_ITI)
+    score = model.score(eff)
+    low, high = model.settings['fix_after_cue_range']
+    n = len(order)
+    for iteration in range(n_iterations):
+        new_order, new_cue, new_iti = order, fix_after_cue, fix_ITI
+        move = rng.integers(3)
+        i, j = rng.choice(n, 2, replace=False)
+        if move == 0:
+            if order[i] == order[j]:
+                continue
+            new_order = order.copy()
+            new_order[[i, j]] = new_order[[j, i]]
+            if max_run(new_order) > max_repeat:
+                continue
+        elif move == 1:
+            if fix_ITI[i] == fix_ITI[j]:
+                continue
+            new_iti = fix_ITI.copy()
+            new_iti[[i, j]] = new_iti[[j, i]]
+        else:
+            new_cue = fix_after_cue.copy()
+            new_cue[i] = round(rng.uniform(low, high), 3)
+        new_eff = model.efficiencies(new_order, new_cue, new_iti)
+        new_score = model.score(new_eff)
+        if new_score > score:
+            order, fix_after_cue, fix_ITI, eff, score = new_order, new_cue, new_iti, new_eff, new_score
+    return (order, fix_after_cue, fix_ITI), eff, score
+
+
+def search(task):
+    """Runs restarts of the hill climbing; returns their final designs"""
+    seed, n_restarts, n_iterations, settings, tr, weights, max_repeat = task
+    rng = np.random.default_rng(seed)
+    model = Model(settings, tr, weights)
+    results = []
+    for restart in range(n_restarts):
+        design, eff, score = climb(model, rng, random_design(rng, settings, max_repeat),
+                                   n_iterations, max_repeat)
+        results.append({'design': design, 'efficiency': eff, 'score': score})
+    return results
+
+
+def baseline(settings, tr, weights, n, seed):
+    """Efficiencies of n random designs, i.e. of shuffling as the task does"""
+    rng = np.random.default_rng(seed)
+    model = Model(settings, tr, weights)
+    effs = np.array([model.efficiencies(*random_design(rng, settings, len(settings['fix_ITI'])))
+                     for i in range(n)])
+    scores = [model.score(eff) for eff in effs]
+    return {'n': n, 'efficiency': dict(zip(CONTRASTS, effs.mean(axis=0).round(4).tolist())),
+            'score': round(float(np.mean(scores)), 4)}
+
+
+def next_library(orders_dir, num_trials):
+    """Next version of the library for runs of num_trials, e.g. mid36-v2"""
+    versions = [int(match[1]) for name in (os.listdir(orders_dir) if os.path.isdir(orders_dir) else [])
+                for match in [re.match(rf'mid{num_trials}-v(\d+)$', name)] if match]
+    return os.path.join(orders_dir, f"mid{num_trials}-v{max(versions, default=0) + 1}")
+
+
+def write_slots(out, n_designs, runs):
+    """
+    Writes slots.csv for designs sorted from best to worst: run r of slot s
+    takes the s-th design of the r-th group of designs, the groups going
+    alternately from best to worst and from worst to best.
+    """
+    n_slots = n_designs // len(runs)
+    with open(os.path.join(out, 'slots.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['slot', 'run', 'file'])
+        for slot in range(n_slots):
+            for group, run in enumerate(runs):
+                n = group * n_slots + (slot if group % 2 == 0 else n_slots - 1 - slot)
+                writer.writerow([slot + 1, run, f"design-{n + 1:02d}.csv"])
+
+
+def write_library(out, designs, manifest, runs):
+    os.makedirs(out, exist_ok=True)
+    manifest['designs'] = []
+    for n, result in enumerate(designs, 1):
+        order, fix_after_cue, fix_ITI = result['design']
+        fname = f"design-{n:02d}.csv"
+        with open(os.path.join(out, fname), 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(ORDER_FIELDS)
+            for trial, (slot, cue, iti) in enumerate(zip(order, fix_after_cue, fix_ITI), 1):
+                writer.writerow([trial, CONDITIONS[slot], f"{cue:.3f}", f"{iti:g}"])
+        manifest['designs'].append({
+            'file': fname, 'score': round(result['score'], 4),
+            'efficiency': dict(zip(CONTRASTS, np.round(result['efficiency'], 4).tolist()))})
+    write_slots(out, len(designs), runs)
+    with open(os.path.join(out, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('--script', default=os.path.join(here, 'mid_BD2.py'),
+                        help="task script to read the settings from (default: mid_BD2.py)")
+    parser.add_argument('--designs', type=int, default=24, help="designs in the library")
+    parser.add_argument('--runs', type=int, nargs='*', default=[1, 2],
+                        help="runs the library is for (the slots get one design per run)")
+    parser.add_argument('--restarts', type=int, default=48)
+    parser.add_argument('--iterations', type=int, default=2000, help="steps per restart")
+    parser.add_argument('--tr', type=float, help="default: scanner_TR of the task, or 2.0")
+    parser.add_argument('--weights', nargs='*', default=[], metavar='CONTRAST=WEIGHT',
+                        help=f"contrast weights in the score ({', '.join(CONTRASTS)}; default 1)")
+    parser.add_argument('--max-repeat', type=int, default=2,
+                        help="most trials of the same condition in a row")
+    parser.add_argument('--workers', type=int, help="processes (default: all cores)")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--out', help="library directory (default: the next "
+                                      "../stimuli/orders/mid<num_trials>-v<N>)")
+    args = parser.parse_args(argv)
+
+    settings = simulate_adaptive.read_settings(args.script)
+    tr = args.tr or settings.get('scanner_TR') or 2.0
+    weights = {}
+    for field in args.weights:
+        name, value = field.split('=', 1)
+        if name not in CONTRASTS:
+            parser.error(f"unknown contrast {name}")
+        weights[name] = float(value)
+    if len(settings['fix_ITI']) < settings['num_trials']:
+        parser.error("fix_ITI has fewer values than num_trials")
+
+    t0 = time.perf_counter()
+    workers = args.workers or os.cpu_count() or 1
+    seeds = np.random.SeedSequence(args.seed).spawn(workers + 1)
+    per_task = [len(part) for part in np.array_split(np.arange(args.restarts), workers)]
+    tasks = [(seed, n, args.iterations, settings, tr, weights, args.max_repeat)
+             for seed, n in zip(seeds[1:], per_task) if n]
+    if len(tasks) == 1:
+        results = search(tasks[0])
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            results = [result for part in pool.map(search, tasks) for result in part]
+
+    # Best distinct designs
+    results.sort(key=lambda result: -result['score'])
+    designs, seen = [], set()
+    for result in results:
+        key = tuple(result['design'][0]) + tuple(result['design'][2])
+        if key not in seen:
+            seen.add(key)
+            designs.append(result)
+    designs = designs[:args.designs]
+    if len(designs) < args.designs:
+        print(f"only {len(designs)} distinct designs, use more --restarts")
+
+    random_designs = baseline(settings, tr, weights, 200, seeds[0])
+    model = Model(settings, tr, weights)
+    out = args.out or next_library(os.path.join(here, '..', 'stimuli', 'orders'),
+                                   settings['num_trials'])
+    manifest = {
+        'created': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'generator': 'optimize_design.py',
+        'num_trials': settings['num_trials'],
+        'settings': {key: settings[key] for key in
+                     ('cue_time', 'fix_after_cue_range', 'isi_target_isi_time',
+                      'feedback_time', 'initial_fix_duration', 'fix_ITI')},
+        'model': {'tr': tr, 'n_scans': model.n_scans, 'hrf': 'canonical double gamma',
+                  'high_pass': 128.0, 'target_dur': TARGET_DUR},
+        'contrasts': CONTRASTS,
+        'weights': {name: weights.get(name, 1.0) for name in CONTRASTS},
+        'runs': args.runs,
+        'search': {'restarts': args.restarts, 'iterations': args.iterations,
+                   'max_repeat': args.max_repeat, 'seed': args.seed},
+        'random': random_designs,
+    }
+    write_library(out, designs, manifest, args.runs)
+
+    print(f"{len(designs)} designs written to {os.path.normpath(out)} "
+          f"in {time.perf_counter() - t0:.1f} s")
+    print(f"{'':12}" + ''.join(f"{name:>26}" for name in CONTRASTS) + f"{'score':>10}")
+    print(f"{'random':12}" + ''.join(f"{random_designs['efficiency'][name]:>26.3f}"
+                                     for name in CONTRASTS) +
+          f"{random_designs['score']:>10.3f}")
+    for name, design in zip(('best', 'worst kept'), (designs[0], designs[-1])):
+        print(f"{name:12}" + ''.join(f"{eff:>26.3f}" for eff in design['efficiency']) +
+              f"{design['score']:>10.3f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
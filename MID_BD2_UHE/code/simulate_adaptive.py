@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+"""
+simulate_adaptive.py
+
+Monte Carlo simulation of the adaptive target window of mid_BD2.py, to tune
+its parameters offline.
+
+Thousands of simulated subjects go through a session as the task runs it:
+the MRT run (rerun once if its mean RT is above 0.350 s), then runs 1 and 2,
+with:
+    - the target window of each condition stepped by single_speed_factor
+      after every trial, shorter if the condition's hit rate (over the last
+      hit_rate_window trials, or exponentially weighted) is >= 0.66, longer
+      otherwise; averaged across conditions after the MRT run
+    - the data.StairHandler(nUp=1, nDown=2) staircase of each condition,
+      which the task updates alongside (and logs the end values of)
+    - the earnings of runs 1 and 2, from trial_rewards
+Subjects are simulated in parallel as rows of NumPy arrays (one trial step
+for all of them at a time), in chunks spread over a process pool.
+
+Each subject's RTs are ex-Gaussian per condition, from a participant profile
+as used by mid_headless.py (its DEFAULT_PARTICIPANT, or --profile), shifted
+by a subject offset (--between-sd) and with tau scaled per subject
+(--tau-spread), plus lapses (no response) and anticipations (a press before
+the target, which counts as too fast).
+
+The task settings (target durations, speed factor, hit rate window, rewards,
+earnings goal, ...) are read from the task script, so the simulation follows
+the copy of the task it is run next to; --set overrides any of them.
+
+For each condition it reports how many of the condition's trials in runs 1
+and 2 the target window took to settle (stay within --band steps of the
+subject's threshold, the window that gives a 66% hit rate for their RT
+distribution), the hit rates, the end values of the staircases and how many
+of them ran out of trials, and the distribution of the session earnings
+against total_earnings_goal.
+
+Usage:
+    python simulate_adaptive.py [--subjects 10000] [--workers N] [--seed S]
+    python simulate_adaptive.py --set single_speed_factor=0.033 hit_rate_window=6
+    python simulate_adaptive.py --profile subject.json --json results.json
+"""
+
+import argparse
+import ast
+import concurrent.futures
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from scipy import stats
+
+import mid_headless
+
+CONDITIONS = ['reward.high', 'reward.low', 'reward.neut',
+              'loss.high', 'loss.low', 'loss.neut']
+TARGET_HIT_RATE = 0.66
+MRT_TRIALS = 15  # trials of the MRT run (all conditions, no cues)
+MRT_RERUN_RT = 0.350  # mean MRT above which the MRT run is done again (once)
+
+# Staircases, as made by make_stairs() in mid_BD2.py (in frames), with the
+# step sizes of a session started at the MRT run
+STAIRS = {'startVal': 15, 'minVal': 0, 'maxVal': 30, 'nUp': 1, 'nDown': 2,
+          'stepSizes': [6, 3, 3, 2, 2, 1, 1]}
+
+# Settings of the task script used by the simulation
+SETTINGS = ['num_runs', 'num_trials', 'min_target_dur', 'inital_target_dur',
+            'max_target_dur', 'single_speed_factor', 'hit_rate_window',
+            'hit_rate_alpha', 'trial_rewards', 'total_earnings_goal']
+
+
+def literal(node):
+    """Value of a literal, or of a sum or product of literals (e.g. [2, 4, 6] * 12)"""
+    if isinstance(node, ast.BinOp) and isinstance(node.op, (ast.Add, ast.Mult)):
+        left, right = literal(node.left), literal(node.right)
+        return left + right if isinstance(node.op, ast.Add) else left * right
+    return ast.literal_eval(node)
+
+
+def read_settings(script):
+    """Values of the module-level literal assignments of a task script"""
+    with open(script) as f:
+        tree = ast.parse(f.read(), script)
+    settings = {}
+    for node in tree.body:
+        if (isinstance(node, ast.Assign) and len(node.targets) == 1 and
+                isinstance(node.targets[0], ast.Name)):
+            try:
+                settings[node.targets[0].id] = literal(node.value)
+            except (ValueError, TypeError):
+                pass
+    return settings
+
+
+class TargetWindows:
+    """
+    mid_state.ConditionState for a population: the target window (in frames)
+    and hit rate state of each condition of each subject, as (subjects,
+    conditions) arrays. Methods take the rows (subjects) to update and the
+    condition slot of each of them.
+    """
+
+    def __init__(self, n, frame_duration, min_frames, max_frames, step_frames,
+                 window=None, alpha=None):
+        n_cond = len(CONDITIONS)
+        self.frame_duration = frame_duration
+        self.min_frames = min_frames
+        self.max_frames = max_frames
+        self.step_frames = step_frames
+        self.window = window
+        self.alpha = alpha
+        self.frames = np.full((n, n_cond), min_frames, dtype=np.int64)
+        self.hits = np.zeros((n, n_cond), dtype=np.int64)
+        self.counts = np.zeros((n, n_cond), dtype=np.int64)
+        self.ewma = np.full((n, n_cond), -1.0)
+        if window:
+            self.ring = np.full((n, n_cond, window), -1, dtype=np.int8)
+            self.ring_pos = np.zeros((n, n_cond), dtype=np.int64)
+
+    def clip(self, frames):
+        return np.clip(frames, self.min_frames, self.max_frames)
+
+    def set_all(self, rows, duration):
+        self.frames[rows] = self.clip(int(round(duration / self.frame_duration)))
+
+    def record(self, rows, slots, hit):
+        """Adds the outcome of a trial; returns the hit rates"""
+        hit = hit.astype(np.int64)
+        self.hits[rows, slots] += hit
+        self.counts[rows, slots] += 1
+        ewma = self.ewma[rows, slots]
+        if self.alpha:
+            ewma = np.where(ewma < 0, hit, ewma + self.alpha * (hit - ewma))
+        else:
+            ewma = np.where(ewma < 0, hit, ewma)
+        self.ewma[rows, slots] = ewma
+        if self.window:
+            pos = self.ring_pos[rows, slots]
+            self.ring[rows, slots, pos] = hit
+            self.ring_pos[rows, slots] = (pos + 1) % self.window
+        return self.hit_rate(rows, slots)
+
+    def hit_rate(self, rows, slots):
+        if self.alpha:
+            return np.maximum(self.ewma[rows, slots], 0.0)
+        if self.window:
+            ring = self.ring[rows, slots]
+            filled = (ring >= 0).sum(axis=1)
+            hits = np.where(ring > 0, ring, 0).sum(axis=1)
+            return np.where(filled > 0, hits / np.maximum(filled, 1), 0.0)
+        counts = self.counts[rows, slots]
+        return np.where(counts > 0, self.hits[rows, slots] / np.maximum(counts, 1), 0.0)
+
+    def step(self, rows, slots, direction):
+        self.frames[rows, slots] = self.clip(self.frames[rows, slots] +
+                                             direction * self.step_frames)
+
+    def average(self, rows):
+        """Sets every condition to the mean window across conditions"""
+        mean_frames = np.round(self.frames[rows].mean(axis=1)).astype(np.int64)
+        self.frames[rows] = self.clip(mean_frames)[:, None]
+
+    def reset_history(self, rows):
+        self.hits[rows] = self.counts[rows] = 0
+        self.ewma[rows] = -1.0
+        if self.window:
+            self.ring[rows] = -1
+            self.ring_pos[rows] = 0
+
+
+# Staircase directions
+START, UP, DOWN = 0, 1, -1
+
+
+class Staircases:
+    """
+    data.StairHandler (linear steps, applyInitialRule) for a population: one
+    staircase per condition of each subject, as (subjects, conditions) arrays.
+    """
+
+    def __init__(self, n, n_trials, startVal, minVal, maxVal, nUp, nDown, stepSizes):
+        shape = (n, len(CONDITIONS))
+        self.n_trials = n_trials
+        self.min_val = minVal
+        self.max_val = maxVal
+        self.n_up = nUp
+        self.n_down = nDown
+        self.step_sizes = np.array(stepSizes, float)
+        self.n_reversals = len(stepSizes)
+        self.value = np.full(shape, float(startVal))
+        self.last = np.full(shape, -1, dtype=np.int64)  # previous response
+        self.counter = np.zeros(shape, dtype=np.int64)  # correctCounter
+        self.direction = np.full(shape, START, dtype=np.int64)
+        self.reversals = np.zeros(shape, dtype=np.int64)
+        self.initial_rule = np.zeros(shape, dtype=bool)
+        self.trials = np.zeros(shape, dtype=np.int64)
+        self.finished = np.zeros(shape, dtype=bool)
+        self.ran_out = np.zeros(shape, dtype=bool)  # next() after finished
+
+    def next(self, rows, slots):
+        self.ran_out[rows, slots] |= self.finished[rows, slots]
+        self.trials[rows, slots] += 1
+        return self.value[rows, slots]
+
+    def add_response(self, rows, slots, result):
+        idx = (rows, slots)
+        correct = result == 1
+        same = self.last[idx] == result
+        counter = np.where(correct, np.where(same, self.counter[idx] + 1, 1),
+                           np.where(same, self.counter[idx] - 1, -1))
+        self.last[idx] = result
+        direction = self.direction[idx]
+        reversals = self.reversals[idx]
+
+        # 1-up/1-down until the first reversal, then nUp/nDown
+        initial = reversals == 0
+        down = np.where(initial, correct, counter >= self.n_down)
+        up = np.where(initial, ~correct, counter <= -self.n_up)
+        reversal = (down & (direction == UP)) | (up & (direction == DOWN))
+        direction = np.where(down, DOWN, np.where(up, UP, direction))
+        initial_rule = self.initial_rule[idx] | (reversal & initial)
+        reversals = reversals + reversal
+        self.finished[idx] = ((reversals >= self.n_reversals) &
+                              (self.trials[idx] >= self.n_trials))
+
+        step = self.step_sizes[np.minimum(reversals, len(self.step_sizes) - 1)]
+        use_initial = initial_rule | (reversals == 0)
+        go_down = np.where(use_initial, correct, counter >= self.n_down)
+        go_up = np.where(use_initial, ~correct, counter <= -self.n_up)
+        value = self.value[idx]
+        value = np.where(go_down, value - step, np.where(go_up, value + step, value))
+        self.value[idx] = np.clip(value, self.min_val, self.max_val)
+        self.counter[idx] = np.where(go_down | go_up, 0, counter)
+        self.initial_rule[idx] = initial_rule & ~use_initial
+        self.direction[idx] = direction
+        self.reversals[idx] = reversals
+
+
+def subject_rts(profile, n, rng, between_sd, tau_spread):
+    """
+    Ex-Gaussian parameters (mu, sigma, tau) of each subject, as (subjects,
+    conditions + 1) arrays; the last column is for the MRT run.
+    """
+    rts = profile['rt']
+    params = np.array([rts.get(cond, rts['default']) for cond in CONDITIONS] +
+                      [rts.get('mrt', rts['default'])], float)
+    offset = rng.normal(0.0, between_sd, (n, 1))
+    tau_scale = rng.lognormal(0.0, tau_spread, (n, 1))
+    return (params[:, 0] + offset, np.broadcast_to(params[:, 1], (n, len(params))),
+            params[:, 2] * tau_scale)
+
+
+def sample_rt(rng, mu, sigma, tau):
+    size = np.broadcast_shapes(np.shape(mu), np.shape(sigma), np.shape(tau))
+    return rng.normal(mu, sigma, size) + rng.exponential(np.maximum(tau, 1e-9), size)
+
+
+def thresholds(mu, sigma, tau, profile, frame_duration, max_frames):
+    """
+    Shortest target window (in frames, at most max_frames) giving each
+    subject a TARGET_HIT_RATE hit rate in each condition, given their RT
+    distribution (the ex-Gaussian CDF is scipy's exponnorm), lapses and
+    anticipations.
+    """
+    p_respond = (1 - profile['lapse_rate']) * (1 - profile['anticipation_rate'])
+    windows = np.arange(max_frames + 1) * frame_duration
+    thr = np.empty((mu.shape[0], len(CONDITIONS)))
+    for slot in range(len(CONDITIONS)):
+        s, t = sigma[:, slot, None], np.maximum(tau[:, slot, None], 1e-9)
+        p_hit = p_respond * stats.exponnorm.cdf(windows, t / s, mu[:, slot, None], s)
+        reached = p_hit >= TARGET_HIT_RATE
+        thr[:, slot] = np.where(reached.any(axis=1), reached.argmax(axis=1), max_frames)
+    return thr
+
+
+def trial_orders(rng, n, n_trials):
+    """Shuffled condition slots of each subject's run (stim_conds*reps, as the task)"""
+    reps = -(-n_trials // len(CONDITIONS))
+    slots = np.tile(np.arange(len(CONDITIONS)), reps)
+    keys = rng.random((n, len(slots)))
+    return slots[np.argsort(keys, axis=1)][:, :n_trials]
+
+
+def simulate(task):
+    """Simulates a chunk of subjects; returns their per-subject results"""
+    n, seed, settings, profile, options = task
+    rng = np.random.default_rng(seed)
+    fd = 1.0 / options['frame_rate']
+    to_frames = lambda duration: max(int(round(duration / fd)), 0)
+    windows = TargetWindows(n, fd, to_frames(settings['min_target_dur']),
+                            to_frames(settings['max_target_dur']),
+                            max(to_frames(settings['single_speed_factor']), 1),
+                            settings['hit_rate_window'], settings['hit_rate_alpha'])
+    stairs = Staircases(n, settings['num_runs'] * settings['num_trials'] / len(CONDITIONS),
+                        **STAIRS)
+    mu, sigma, tau = subject_rts(profile, n, rng, options['between_sd'],
+                                 options['tau_spread'])
+    thr = thresholds(mu, sigma, tau, profile, fd, 2 * windows.max_frames)
+    rewards = np.array([settings['trial_rewards'][cond] for cond in CONDITIONS])
+    reward_on_hit = np.array([cond.startswith('reward') for cond in CONDITIONS])
+
+    all_rows = np.arange(n)
+    n_main = settings['num_trials'] // len(CONDITIONS) * (settings['num_runs'] - 1)
+    trajectory = np.zeros((n, len(CONDITIONS), n_main + 1), dtype=np.int64)
+    main_trials = np.zeros((n, len(CONDITIONS)), dtype=np.int64)
+    main_hits = np.zeros((n, len(CONDITIONS), settings['num_runs']), dtype=np.int64)
+    main_counts = np.zeros((n, len(CONDITIONS), settings['num_runs']), dtype=np.int64)
+    earnings = np.zeros(n)
+    mrt = np.zeros((n, 2))
+    reruns = np.zeros(n, dtype=bool)
+
+    def run_trials(rows, run, n_trials):
+        """Runs the trials of a run for some subjects; returns their trial_RTs"""
+        order = trial_orders(rng, len(rows), n_trials)
+        trial_rts = np.zeros((len(rows), n_trials))
+        for trial in range(n_trials):
+            slots = order[:, trial]
+            stairs.next(rows, slots)
+            rt_col = slots if run > 0 else len(CONDITIONS)
+            rt = np.maximum(sample_rt(rng, mu[rows, rt_col], sigma[rows, rt_col],
+                                      tau[rows, rt_col]), profile['min_rt'])
+            responded = rng.random(len(rows)) >= profile['lapse_rate']
+            too_fast = np.zeros(len(rows), dtype=bool)
+            if run > 0:
+                too_fast = rng.random(len(rows)) < profile['anticipation_rate']
+            target_dur = windows.frames[rows, slots] * fd
+            hit = responded & ~too_fast & (rt <= target_dur)
+            response = np.where(too_fast, 2, hit.astype(np.int64))
+            stairs.add_response(rows, slots, response)
+            trial_rts[:, trial] = np.where(hit, rt, target_dur)
+
+            hit_rate = windows.record(rows, slots, hit)
+            windows.step(rows, slots, np.where(hit_rate >= TARGET_HIT_RATE, -1, 1))
+
+            if run > 0:
+                won = np.where(reward_on_hit[slots], hit, ~hit)
+                earnings[rows] += np.where(won, rewards[slots], 0.0)
+                main_hits[rows, slots, run] += hit
+                main_counts[rows, slots, run] += 1
+                main_trials[rows, slots] += 1
+                trajectory[rows, slots, main_trials[rows, slots]] = windows.frames[rows, slots]
+        return trial_rts
+
+    # MRT run, rerun once for the subjects that were too slow
+    windows.set_all(all_rows, settings['inital_target_dur'])
+    mrt[:, 0] = run_trials(all_rows, 0, MRT_TRIALS).mean(axis=1)
+    slow = all_rows[mrt[:, 0] > MRT_RERUN_RT]
+    reruns[slow] = True
+    if len(slow):
+        windows.set_all(slow, settings['inital_target_dur'])
+        mrt[slow, 1] = run_trials(slow, 0, MRT_TRIALS).mean(axis=1)
+    windows.average(all_rows)
+    windows.reset_history(all_rows)
+    trajectory[:, :, 0] = windows.frames
+
+    for run in range(1, settings['num_runs']):
+        run_trials(all_rows, run, settings['num_trials'])
+
+    return {'threshold': thr, 'trajectory': trajectory, 'hits': main_hits,
+            'counts': main_counts, 'earnings': earnings, 'mrt': mrt,
+            'rerun': reruns, 'stair_value': stairs.value,
+            'stair_ran_out': stairs.ran_out, 'final_frames': windows.frames.copy()}
+
+
+def convergence(trajectory, threshold, band):
+    """
+    Index of the condition trial from which the target window stays within
+    band frames of the threshold (0 = from the start of run 1), or -1 if it
+    never does.
+    """
+    within = np.abs(trajectory - threshold[:, :, None]) <= band
+    n = trajectory.shape[2]
+    # Last trial outside the band, counting from the end
+    outside_from_end = np.argmax(~within[:, :, ::-1], axis=2)
+    settled = np.where(within.all(axis=2), 0, n - outside_from_end)
+    return np.where(within[:, :, -1], settled, -1)
+
+
+def percentiles(x, q=(5, 50, 95)):
+    x = np.asarray(x, float)
+    if x.size == 0:
+        return {f"p{p}": None for p in q}
+    return {f"p{p}": round(float(np.percentile(x, p)), 4) for p in q}
+
+
+def summarize(results, settings, options):
+    """Summary statistics of the simulated population"""
+    fd = 1.0 / options['frame_rate']
+    step = max(int(round(settings['single_speed_factor'] / fd)), 1)
+    conv = convergence(results['trajectory'], results['threshold'], options['band'] * step)
+    n_cond_trials = results['trajectory'].shape[2] - 1
+    summary = {'subjects': int(len(results['earnings'])),
+               'settings': {key: settings[key] for key in SETTINGS},
+               'options': options,
+               'mrt': {'rerun_rate': round(float(results['rerun'].mean()), 4),
+                       'mean_rt': percentiles(results['mrt'][:, 0])},
+               'conditions': {}}
+    for slot, cond in enumerate(CONDITIONS):
+        hits = results['hits'][:, slot]
+        counts = results['counts'][:, slot]
+        c = conv[:, slot]
+        summary['conditions'][cond] = {
+            'threshold': percentiles(results['threshold'][:, slot] * fd),
+            'final_window': percentiles(results['final_frames'][:, slot] * fd),
+            'final_error': percentiles((results['final_frames'][:, slot] -
+                                        results['threshold'][:, slot]) * fd),
+            'hit_rate': {f"run{run}": round(float(hits[:, run].sum() /
+                                                  max(counts[:, run].sum(), 1)), 4)
+                         for run in range(1, hits.shape[1])},
+            'convergence_trial': percentiles(c[c >= 0], (50, 90)),
+            'never_converged': round(float((c < 0).mean()), 4),
+            'stair_end': percentiles(results['stair_value'][:, slot]),
+            'stair_ran_out': round(float(results['stair_ran_out'][:, slot].mean()), 4),
+        }
+    earnings = results['earnings']
+    goal = settings['total_earnings_goal']
+    summary['earnings'] = dict(percentiles(earnings), mean=round(float(earnings.mean()), 4),
+                               sd=round(float(earnings.std()), 4),
+                               reached_goal=round(float((earnings >= goal).mean()), 4))
+    summary['trials_per_condition'] = n_cond_trials
+    return summary
+
+
+def report(summary):
+    """Prints a summary as a table"""
+    settings = summary['settings']
+    fmt = lambda p: ' '.join('-' if v is None else f"{v:.3f}" for v in p.values())
+    print(f"{summary['subjects']} subjects, speed factor {settings['single_speed_factor']} s, "
+          f"hit rate window {settings['hit_rate_window']}, alpha {settings['hit_rate_alpha']}")
+    print(f"MRT: mean RT (p5 p50 p95) {fmt(summary['mrt']['mean_rt'])}, "
+          f"rerun {summary['mrt']['rerun_rate']:.1%}")
+    print(f"\nper condition ({summary['trials_per_condition']} trials in runs 1-2), "
+          f"times in s as p5 p50 p95:")
+    print(f"{'condition':12} {'threshold':>20} {'final window':>20} {'hit run1':>9} "
+          f"{'hit run2':>9} {'settled p50/p90':>16} {'never':>7} {'stair end':>20} {'ran out':>8}")
+    for cond, c in summary['conditions'].items():
+        conv = c['convergence_trial']
+        conv = '-' if conv['p50'] is None else f"{conv['p50']:.0f}/{conv['p90']:.0f}"
+        print(f"{cond:12} {fmt(c['threshold']):>20} {fmt(c['final_window']):>20} "
+              f"{c['hit_rate'].get('run1', 0):>9.1%} {c['hit_rate'].get('run2', 0):>9.1%} "
+              f"{conv:>16} {c['never_converged']:>7.1%} {fmt(c['stair_end']):>20} "
+              f"{c['stair_ran_out']:>8.1%}")
+    e = summary['earnings']
+    print(f"\nearnings (runs 1-2): mean {e['mean']:.2f}, sd {e['sd']:.2f}, "
+          f"p5 {e['p5']:.2f}, p50 {e['p50']:.2f}, p95 {e['p95']:.2f}; "
+          f"{e['reached_goal']:.1%} reached the goal of {settings['total_earnings_goal']}")
+
+
+def run(n_subjects, settings, profile, options, workers=None, chunk=2000, seed=None):
+    """Simulates n_subjects in chunks over a process pool; returns the merged results"""
+    sizes = [min(chunk, n_subjects - start) for start in range(0, n_subjects, chunk)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    tasks = [(size, s, settings, profile, options) for size, s in zip(sizes, seeds)]
+    if workers == 1 or len(tasks) == 1:
+        chunks = [simulate(task) for task in tasks]
+    else:
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            chunks = list(pool.map(simulate, tasks))
+    return {key: np.concatenate([c[key] for c in chunks]) for key in chunks[0]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1],
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    here = os.path.dirname(os.path.abspath(__file__))
+    parser.add_argument('--subjects', type=int, default=10000)
+    parser.add_argument('--script', default=os.path.join(here, 'mid_BD2.py'),
+                        help="task script to read the settings from (default: mid_BD2.py)")
+    parser.add_argument('--set', nargs='*', default=[], metavar='NAME=VALUE',
+                        help="override a task setting, e.g. single_speed_factor=0.033")
+    parser.add_argument('--profile', help="participant profile (JSON, as mid_headless.py)")
+    parser.add_argument('--between-sd', type=float, default=0.03,
+                        help="SD of the subject RT offset (s)")
+    parser.add_argument('--tau-spread', type=float, default=0.3,
+                        help="SD of the log of the subject tau scale")
+    parser.add_argument('--frame-rate', type=float, default=60.0)
+    parser.add_argument('--band', type=float, default=2,
+                        help="steps around the threshold a window has to stay within "
+                             "to count as settled")
+    parser.add_argument('--workers', type=int, help="processes (default: all cores)")
+    parser.add_argument('--chunk', type=int, default=2000, help="subjects per task")
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--json', help="also write the summary to this file")
+    args = parser.parse_args(argv)
+
+    settings = read_settings(args.script)
+    for field in args.set:
+        name, value = field.split('=', 1)
+        settings[name] = ast.literal_eval(value)
+    missing = [key for key in SETTINGS if key not in settings]
+    if missing:
+        parser.error(f"{args.script} does not set {', '.join(missing)}")
+    profile = mid_headless.load_profile(args.profile)
+    options = {'frame_rate': args.frame_rate, 'between_sd': args.between_sd,
+               'tau_spread': args.tau_spread, 'band': args.band}
+
+    t0 = time.perf_counter()
+    results = run(args.subjects, settings, profile, options, args.workers,
+                  args.chunk, args.seed)
+    summary = summarize(results, settings, options)
+    summary['profile'] = profile
+    report(summary)
+    print(f"\nsimulated in {time.perf_counter() - t0:.1f} s")
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(summary, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
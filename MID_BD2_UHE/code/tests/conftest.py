@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+"""Makes the task modules in code/ importable by the tests"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
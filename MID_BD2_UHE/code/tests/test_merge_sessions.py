@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Tests of the session merger (merge_sessions.py)"""
+
+import csv
+import json
+
+import merge_sessions
+
+
+def write_trials(fname, runs):
+    """Writes a data file with the given number of trials of each run"""
+    with open(fname, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['run', 'trial.number'])
+        for run, n in runs:
+            for trial in range(1, n + 1):
+                writer.writerow([run, trial])
+
+
+def merge(tmp_path, runs, session='MID1.1_fmri_0998_ses-1', **kwargs):
+    write_trials(tmp_path / (session+'.csv'), runs)
+    merge_sessions.merge_all(str(tmp_path), verbose=False, **kwargs)
+    with open(tmp_path / (session+'_merged.json')) as f:
+        return json.load(f)
+
+
+def test_single_aborted_segment_is_not_complete(tmp_path):
+    index = merge(tmp_path, [(0, 15), (1, 36), (2, 9)])
+    assert index['runs']['1']['complete'] is True
+    assert index['runs']['2']['complete'] is False
+    assert index['runs']['2']['expected_trials'] == 36
+    assert index['segments'][-1]['status'] == 'aborted'
+
+
+def test_truncated_mrt_practice_is_not_complete(tmp_path):
+    # mrt_practice.py has 15 trials in its run 0, mid_practice.py 6
+    index = merge(tmp_path, [(0, 9)], session='MRT1.1_practice_0998_ses-1')
+    assert index['runs']['0']['expected_trials'] == 15
+    assert index['runs']['0']['complete'] is False
+    index = merge(tmp_path, [(0, 6)], session='MID1.1_practice_0998_ses-1')
+    assert index['runs']['0']['complete'] is True
+
+
+def test_run_of_unknown_length_is_not_verifiable(tmp_path):
+    index = merge(tmp_path, [(3, 9)])
+    assert index['runs']['3']['complete'] is None
+    assert index['segments'][0]['status'] == 'unverified'
+    index = merge(tmp_path, [(3, 9)], trials_per_run={3: 9})
+    assert index['runs']['3']['complete'] is True